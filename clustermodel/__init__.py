@@ -4,13 +4,15 @@ import signal
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 __version__ = "0.13"
-from . import simulate
+# simulate and plotting (which imports matplotlib) are imported on demand.
 from . import clustermodel
 from . import feature
-from . import plotting
 
 from clustermodel import clustered_model
-from feature import feature_gen, ClusterFeature, cluster_to_dataframe
+from feature import feature_gen, ClusterFeature, SparseFeature, ClusterBatch, \
+        cluster_to_dataframe
 
 from multiprocessing import cpu_count
-CPUS = min(cpu_count(), 12)
+import os
+# processes (and R's mc.cores) for a run; `grid` sets this for each run.
+CPUS = int(os.environ.get("CLUSTERMODEL_CPUS", 0)) or min(cpu_count(), 12)
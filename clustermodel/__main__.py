@@ -1,78 +1,83 @@
 import sys
-import gzip
 import re
-from itertools import groupby, izip_longest
+from argparse import Namespace
+from itertools import groupby
 from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from aclust import mclust
-from .plotting import plot_dmr, plot_hbar, plot_continuous
-from . import feature_gen, cluster_to_dataframe, clustered_model, CPUS
-from .clustermodel import r
-
-xopen = lambda f: gzip.open(f) if f.endswith('.gz') else open(f)
-
-def is_numeric(pd_series):
-    if np.issubdtype(pd_series.dtype, int) or \
-        np.issubdtype(pd_series.dtype, float):
-        return len(pd_series.unique()) > 2
-    return False
+from . import feature_gen, clustered_model, ClusterBatch, CPUS
+from .feature import batches
+from .clustermodel import r, OUTLIERS, X_permutation
+from .output import open_writer, result_columns
+from . import instrument
+from .bgzf import open_input as xopen
 
 def run_model(clusters, covs, model, X, outlier_sds, combine, bumping, betareg,
-              gee_args, skat, counts):
-    # we turn the cluster list into a pandas dataframe with columns
-    # of samples and rows of probes. these must match our covariates
-    cluster_dfs = [cluster_to_dataframe(cluster, columns=covs.index)
-            for cluster in clusters]
-    if clusters[0][0].weights is not None:
-        weight_dfs = [cluster_to_dataframe(cluster, columns=covs.index,
-                                        weights=True)
-            for cluster in clusters]
-    else:
-        weight_dfs = None
-        # now we want to test a model on our clustered dataset.
-    res = clustered_model(covs, cluster_dfs, model, X=X, weights=weight_dfs,
+              gee_args, skat, counts, timing=False, engine='R', X_perms=None):
+    # `clusters` is a ClusterBatch (or a list of clusters) with columns of
+    # samples and rows of probes. these must match our covariates
+    if not isinstance(clusters, ClusterBatch):
+        with instrument.get_profiler().stage('to_dataframe'):
+            clusters = ClusterBatch.from_clusters(clusters)
+    assert clusters.n_samples == len(covs.index)
+    res = clustered_model(covs, clusters, model, X=X,
                           gee_args=gee_args, combine=combine, bumping=bumping,
                           betareg=betareg,
-                          skat=skat, counts=counts, outlier_sds=outlier_sds)
-    res['chrom'], res['start'], res['end'], res['n_probes'] = ("CHR", 1, 1, 0)
+                          skat=skat, counts=counts, outlier_sds=outlier_sds,
+                          timing=timing, engine=engine, X_perms=X_perms)
     if "cluster_id" in res.columns:
-        # start at 1 because we using 1:nclusters in R
-        for i, c in enumerate(clusters, start=1):
-            res.ix[res.cluster_id == i, 'chrom'] = c[0].group
-            res.ix[res.cluster_id == i, 'start'] = c[0].start
-            res.ix[res.cluster_id == i, 'end'] = c[-1].end
-            res.ix[res.cluster_id == i, 'n_probes'] = len(c)
+        # cluster_id starts at 1 because we use 1:nclusters in R. take the
+        # coordinates of the batch for each result.
+        idx = np.asarray(res['cluster_id'], dtype=int) - 1
     else:
         assert len(clusters) == 1
-        res['chrom'] = clusters[0][0].group
-        res['start'] = clusters[0][0].start
-        res['end'] = clusters[-1][-1].end
-        res['n_probes'] = len(clusters[0])
+        idx = np.zeros(len(res), dtype=int)
+    res['chrom'] = clusters.chrom[idx]
+    res['start'] = clusters.start[idx]
+    res['end'] = clusters.end[idx]
+    res['n_probes'] = clusters.sizes[idx]
     return res
 
-def distX(dmr, expr):
-    strand = str(expr.get('strand', '+'))
-    if strand not in "+-": strand = "+"
-    dmr['distance'] = 0
-    if dmr['end'] < expr['start']:
-        dmr['distance'] = expr['start'] - dmr['end']
-        # dmr is left of gene. that means it is upstream if strand is +
-        # we use "-" for upstream
-        if strand == "+":
-            dmr['distance'] *= -1
-
-    elif dmr['start'] > expr['end']:
-        dmr['distance'] = dmr['start'] - expr['end']
-        # dmr is right of gene. that is upstream if strand is -
-        # use - for upstream
-        if strand == "-":
-            dmr['distance'] *= -1
-    dmr['Xstart'], dmr['Xend'], dmr['Xstrand'] = expr['start'], expr['end'], expr['strand']
-    dmr['Xname'] = expr.get('name', expr.get('gene', dmr.get('X', 'NA')))
-    if dmr['chrom'] != expr['chrom']:
-        dmr['distance'] = np.nan
-
+def distX_frame(res, X_locs, X_dist=None):
+    """
+    add the distance to each X (negative for upstream of X) and the
+    X-location columns to a DataFrame of results and drops rows that are not on the same
+    chromosome or are more than `X_dist` away.
+    """
+    expr = X_locs.ix[list(res['X']), :]
+    xstart, xend = expr['start'].values, expr['end'].values
+    if 'strand' in expr.columns:
+        xstrand = expr['strand'].values
+    else:
+        xstrand = np.array(['+'] * len(expr))
+    strand = np.array([s if s in ('+', '-') else '+' for s in map(str, xstrand)])
+    start, end = res['start'].values, res['end'].values
+
+    distance = np.zeros(len(res))
+    # dmr is left of gene. that means it is upstream if strand is +
+    left = end < xstart
+    distance[left] = (xstart - end)[left] * np.where(strand[left] == "+", -1, 1)
+    # dmr is right of gene. that is upstream if strand is -
+    right = ~left & (start > xend)
+    distance[right] = (start - xend)[right] * np.where(strand[right] == "-", -1, 1)
+    distance[res['chrom'].values != expr['chrom'].values] = np.nan
+
+    res['Xstart'], res['Xend'], res['Xstrand'] = xstart, xend, xstrand
+    for name_col in ('name', 'gene'):
+        if name_col in expr.columns:
+            res['Xname'] = expr[name_col].values
+            break
+    else:
+        res['Xname'] = res['X']
+    res['distance'] = distance
+
+    keep = ~np.isnan(distance)
+    if X_dist is not None:
+        keep[keep] = np.abs(distance[keep]) <= X_dist
+    res = res[keep].copy()
+    res['distance'] = res['distance'].astype(int)
+    return res
 
 def clustermodel(fcovs, fmeth, model,
                  # clustering args
@@ -87,24 +92,38 @@ def clustermodel(fcovs, fmeth, model,
                  outlier_sds=None,
                  combine=False, bumping=False, betareg=False,
                  gee_args=(), skat=False,
-                 png_path=None):
+                 png_path=None, plot_procs=1, plot_skip_existing=False,
+                 plot_book=None, plot_book_size=None,
+                 frames=False, timing=False, engine='R', sparse=False,
+                 prefilter=None, float32=False, X_permute=None):
+    prof = instrument.get_profiler()
     # an iterable of feature objects
     # from here, weights are attached to the feature.
-    feature_iter = feature_gen(fmeth, rho_min=rho_min, weights=weights)
+    feature_iter = prof.timed('parse', feature_gen(fmeth, rho_min=rho_min,
+                                                   weights=weights,
+                                                   sparse=sparse,
+                                                   dtype=np.float32 if float32
+                                                         else np.float64))
+    if prefilter is not None:
+        feature_iter = prof.timed('prefilter', prefilter(feature_iter))
     assert min_clust_size >= 1
 
-    cluster_gen = (c for c in mclust(feature_iter,
+    cluster_gen = (c for c in prof.timed('cluster', mclust(feature_iter,
                                      max_dist=max_dist,
                                      linkage=linkage,
                                      merge_linkage=merge_linkage,
                                      max_merge_dist=max_merge_dist
-                                     )
+                                     ))
                     if len(c) >= min_clust_size)
     for res in clustermodelgen(fcovs, cluster_gen, model, sep=sep,
             X=X, X_locs=X_locs, X_dist=X_dist,
             outlier_sds=outlier_sds,
             combine=combine, bumping=bumping, betareg=betareg,
-            gee_args=gee_args, skat=skat, counts=counts, png_path=png_path):
+            gee_args=gee_args, skat=skat, counts=counts, png_path=png_path,
+            plot_procs=plot_procs, plot_skip_existing=plot_skip_existing,
+            plot_book=plot_book, plot_book_size=plot_book_size,
+            frames=frames, timing=timing, engine=engine,
+            X_permute=X_permute):
         yield res
 
 
@@ -120,27 +139,49 @@ def fix_name(name, patt=re.compile("-|:| ")):
     return re.sub(patt, ".", name)
 
 
-def groups_of(n, iterable):
-    args = [iter(iterable)] * n
-    for x in izip_longest(*args):
-        yield [v for v in x if v is not None]
-
-
 def clustermodelgen(fcovs, cluster_gen, model, sep="\t",
                     X=None, X_locs=None, X_dist=None,
                     outlier_sds=None,
                     combine=False, bumping=False,
                     betareg=False, gee_args=(), skat=False,
                     counts=False,
-                    png_path=None):
+                    png_path=None, plot_procs=1, plot_skip_existing=False,
+                    plot_book=None, plot_book_size=None,
+                    frames=False, timing=False, engine='R', X_permute=None):
+    """
+    run the model on each group of clusters from `cluster_gen` and generate
+    a dict for each result row or, if `frames` is True, a single DataFrame
+    for each group of clusters. if `timing` is True, each cluster is fit
+    separately in R and the results have r_start, r_wall, r_cpu and r_pid
+    columns. `engine` is 'R' or 'python' (see clustered_model).
+    `X_permute` is a list of seeds; each group of clusters is tested against
+    X with its samples permuted by each (see X_permutation) in place of X
+    and the seed is in the X_permute_seed column.
+    """
 
+    prof = instrument.get_profiler()
     covs = (pd.read_csv if fcovs.endswith(".csv") else pd.read_table)(fcovs, index_col=0)
     covariate = model.split("~")[1].split("+")[0].strip()
+    # start the plotting processes early, while this process is still small.
+    if png_path:
+        from .plotting import PlotPool
+    plotter = PlotPool(png_path, covs, covariate, procs=plot_procs,
+                       skip_existing=plot_skip_existing, book=plot_book,
+                       book_size=plot_book_size) if png_path else None
     Xvar = X
     if X is not None:
         # read in once in R, then subset by probes
         r('Xfull = readX("%s")' % X)
         Xvar = 'Xfull'
+        # the permutations are sent once and applied to each subset of X in
+        # R so no permuted copy of X is written or read.
+        if X_permute:
+            n_X = int(r['ncol(Xfull)'])
+            for i, seed in enumerate(X_permute):
+                r['XXperm%i' % i] = [int(j) + 1 for j in
+                                     X_permutation(n_X, seed)]
+            r('XXperms = list(%s)' % ", ".join('XXperm%i' % i for i in
+                                              range(len(X_permute))))
 
     # read expression into memory and pull out subsets as needed.
     if not X_locs is None:
@@ -155,9 +196,8 @@ def clustermodelgen(fcovs, cluster_gen, model, sep="\t",
         X_probes = set([fix_name(xi) for xi in Xi])
 
     # weights are attached to the feature
-    for clusters in groups_of(50 * CPUS if X is None else
-                              8 * CPUS if X_locs is not None
-                              else CPUS, cluster_gen):
+    for clusters in batches(cluster_gen, 50 * CPUS if X is None else
+                            8 * CPUS if X_locs is not None else CPUS):
 
         if not X_locs is None:
             probes = []
@@ -165,9 +205,8 @@ def clustermodelgen(fcovs, cluster_gen, model, sep="\t",
             # cluster and test it against all clusters. This tends to work out
             # because the clusters are sorted by location and it helps
             # parallelization.
-            for cluster in clusters:
-                chrom = cluster[0].group
-                start, end = cluster[0].start, cluster[-1].end
+            for chrom, start, end in zip(clusters.chrom, clusters.start,
+                                         clusters.end):
                 if X_dist is not None:
                     probe_locs = X_locs[((X_locs.ix[:, 0] == chrom) &
                              (X_locs.ix[:, 1] < (end + X_dist)) &
@@ -188,57 +227,65 @@ def clustermodelgen(fcovs, cluster_gen, model, sep="\t",
         if gee_args and isinstance(gee_args, basestring):
             gee_args = gee_args.split(",")
         res = run_model(clusters, covs, model, Xvar, outlier_sds, combine,
-                        bumping, betareg, gee_args, skat, counts)
-        j = 0
-        for i, row in res.iterrows():
-            row = dict(row)
-            if X_locs is not None:
-                distX(row, dict(X_locs.ix[row['X'], :]))
-                if np.isnan(row['distance']) or abs(row['distance']) > X_dist: continue
-            yield row
-            # blech. steal regions since we often want to plot everything.
-            if (row['p'] < 1e-4 or "--regions" in sys.argv) and png_path:
-                if 'X' in row and row['p'] > 1e-8: continue
-                cluster_df = cluster_to_dataframe(clusters[j], columns=covs.index)
-                weights_df = None
-                if clusters[j][0].weights is not None:
-                    weights_df = cluster_to_dataframe(clusters[j],
-                            columns=covs.index, weights=True)
-
-                plot_res(row, png_path, covs, covariate, cluster_df, weights_df)
-            j += 1
-
-
-def plot_res(res, png_path, covs, covariate, cluster_df, weights_df=None):
-    from matplotlib import pyplot as plt
-    from mpltools import style
-    style.use('ggplot')
-
-    region = "{chrom}_{start}_{end}".format(**res)
-    if png_path.endswith('show'):
-        png = None
-    elif png_path.endswith(('.png', '.pdf')):
-        png = "%s.%s%s" % (png_path[:-4], region, png_path[-4:])
-    elif png_path:
-        png = "%s.%s.png" % (png_path.rstrip("."), region)
-
-    if is_numeric(getattr(covs, covariate)):
-        f = plot_continuous(covs, cluster_df, covariate, res['chrom'], res, png)
-    else:
-        f = plt.figure(figsize=(11, 4))
-        ax = f.add_subplot(1, 1, 1)
-        if 'spaghetti' in png_path and cluster_df.shape[0] > 1:
-            plot_dmr(covs, cluster_df, covariate, res['chrom'], res, png,
-                    weights_df)
+                        bumping, betareg, gee_args, skat, counts, timing,
+                        engine, X_perms='XXperms' if X_permute else None)
+        if X_permute and len(res):
+            # the batch is sent to R once and fit against each permutation.
+            # R returns the results of each permutation in turn so put them
+            # back in the order of the clusters (which are sorted by
+            # location) keeping the order of the seeds for each cluster.
+            res['X_permute_seed'] = np.asarray(X_permute)[
+                                np.asarray(res['X_permute_i'], dtype=int) - 1]
+            del res['X_permute_i']
+            if 'cluster_id' in res.columns:
+                order = np.argsort(np.asarray(res['cluster_id']),
+                                   kind='mergesort')
+                res = res.iloc[order].reset_index(drop=True)
+        if prof.enabled:
+            method = Namespace(model=model, combine=combine, bumping=bumping,
+                               betareg=betareg, skat=skat,
+                               gee_args=gee_args or None)
+            if 'r_wall' in res.columns and 'cluster_id' in res.columns:
+                # the time of each fit from --timing or the python engine.
+                # a batch fit in a single call to R has no time for each
+                # cluster so none is recorded.
+                keys = [c for c in ('cluster_id', 'X_permute_seed')
+                        if c in res.columns]
+                latency = res.drop_duplicates(keys).groupby(
+                                        'cluster_id')['r_wall'].sum()
+                for i, n in enumerate(clusters.sizes, 1):
+                    if i in latency.index:
+                        prof.fit(get_method(method, n), n, latency[i])
+            prof.add('batches')
+        prof.add('clusters', len(clusters))
+        prof.add('probes', int(clusters.sizes.sum()))
+        if X_locs is not None:
+            res = distX_frame(res, X_locs, X_dist)
+
+        # blech. steal regions since we often want to plot everything.
+        if plotter is not None:
+            with prof.stage('plot'):
+                to_plot = res[(res['p'] < 1e-4) | ("--regions" in sys.argv)]
+                if 'X' in to_plot.columns:
+                    to_plot = to_plot[to_plot['p'] <= 1e-8]
+                for _, row in to_plot.iterrows():
+                    row = dict(row)
+                    if plotter.skip(row): continue
+                    j = int(row['cluster_id']) - 1 if 'cluster_id' in row else 0
+                    cluster_df = clusters.to_dataframe(j, columns=covs.index)
+                    weights_df = None
+                    if clusters.has_weights:
+                        weights_df = clusters.to_dataframe(j,
+                                columns=covs.index, weights=True)
+                    plotter.submit(row, cluster_df, weights_df)
+
+        if frames:
+            yield res
         else:
-            plot_hbar(covs, cluster_df, covariate, res['chrom'], res, png)
-        plt.title('p-value: %.3g %s: %.3f' % (res['p'], covariate, res['coef']))
-    f.set_tight_layout(True)
-    if png:
-        plt.savefig(png)
-    else:
-        plt.show()
-    plt.close()
+            for _, row in res.iterrows():
+                yield dict(row)
+    if plotter is not None:
+        plotter.close()
 
 
 def main_example():
@@ -266,6 +313,11 @@ def add_modelling_args(p):
     p.add_argument('--betareg', action="store_true",
             help="use beta-regression in which case `methylation` should be"
             " the ratio and --weights could be the read-depths.")
+    p.add_argument('--engine', choices=('R', 'python'), default='R',
+            help="fit models in R or, for methods with a python "
+            "implementation (--gee-args, random intercepts by CpG "
+            "and/or id, --betareg and --skat), in python. Other methods "
+            "and --X always use R.")
 
     p.add_argument('model',
                    help="model in R syntax, e.g. 'methylation ~ disease'")
@@ -286,12 +338,34 @@ def add_expression_args(p):
     ep.add_argument('--X-dist', type=int, help="only look at cis interactions"
             " between X and methylation sites with this as the maximum",
             default=None)
+    ep.add_argument('--X-permute-seed', type=int, nargs='+', metavar="SEED",
+            help="test against X with its samples permuted by each of these "
+            "seeds (in place of X) for a null distribution. The permutation "
+            "is done in R so no shuffled copy of X is written. Results have "
+            "an X_permute_seed column")
 
 def add_weight_args(p):
     wp = p.add_argument_group('weighted regression')
     wp.add_argument('--weights', help="matrix file with of shape probes * "
           "samples with values for weights in the regression. Likely these "
           "would be read-counts (depth) for BS-Seq data.")
+    wp.add_argument('--sparse', action='store_true', help="keep only the "
+          "samples with a value (and weight > 0) for each probe and cluster "
+          "on the correlation of samples that have values at both probes. "
+          "For bisulfite-seq data where most samples have no reads at most "
+          "sites.")
+
+def add_prefilter_args(p):
+    fp = p.add_argument_group('prefilter (drop probes before clustering)')
+    fp.add_argument('--max-nan', type=float, default=1.0,
+            help="drop probes with more than this fraction of missing values")
+    fp.add_argument('--min-samples', type=int, default=0,
+            help="drop probes with fewer than this many samples with a value "
+                 "(and weight > 0 with --weights)")
+    fp.add_argument('--min-var', type=float, default=0,
+            help="drop probes with a variance less than this")
+    fp.add_argument('--min-iqr', type=float, default=0,
+            help="drop probes with an inter-quartile range less than this")
 
 def add_clustering_args(p):
     cp = p.add_argument_group('clustering parameters')
@@ -319,7 +393,46 @@ def add_misc_args(p):
 a spaghetti plot, otherwise, it's a histogram plot""")
     p.add_argument('--outlier-sds', type=float, default=30,
             help="remove points that are more than this many standard "
-                 "deviations away from the mean")
+                 "deviations away from the mean. The number removed is "
+                 "reported to stderr")
+    p.add_argument('--float32', action='store_true',
+            help="keep the methylation and weights as float32 while parsing, "
+                 "clustering and sending to R (or the python engine). The "
+                 "models are fit with float64. Halves the memory used.")
+    p.add_argument('--out', default=None,
+            help="output file. Default is text to stdout. If this ends with "
+                 ".gz or .bgz, output is block-gzipped (bgzip compatible) "
+                 "and if it ends with .npz, output is columnar numpy arrays")
+    p.add_argument('--index', action='store_true',
+            help="write a tabix index (--out + '.tbi') for block-gzipped "
+                 "--out so it can be queried by region with: "
+                 "python -m clustermodel query $out chr1:1-2000000")
+    p.add_argument('--plot-procs', type=int, default=1,
+            help="number of background processes drawing --png-path plots. "
+                 "0 draws them in the main process")
+    p.add_argument('--plot-skip-existing', action='store_true',
+            help="don't re-draw plots that already exist")
+    p.add_argument('--plot-book', choices=('pdf', 'sheet'),
+            help="draw plots as pages of multi-page PDFs or tiles of PNG "
+                 "sheets named from --png-path instead of 1 file per region")
+    p.add_argument('--plot-book-size', type=int,
+            help="pages per PDF (default 500) or tiles per sheet (default 8) "
+                 "with --plot-book")
+    p.add_argument('--profile', metavar="JSON",
+            help="write time spent in each stage, bytes sent to and read "
+                 "from R and per-cluster fit latencies (with --timing or "
+                 "--engine python) to this file")
+    p.add_argument('--progress', type=float, nargs='?', const=10,
+            metavar="SECONDS",
+            help="report clusters/sec (and an ETA with --regions) to stderr "
+                 "every this many seconds (default 10)")
+    p.add_argument('--timing', action='store_true',
+            help="fit each cluster separately in R and add columns with "
+                 "the start (epoch seconds), wall and cpu time and R "
+                 "process of each fit")
+    p.add_argument('--trace', metavar="JSON",
+            help="write the time of each cluster fit (implies --timing) as "
+                 "trace events for chrome://tracing or ui.perfetto.dev")
 
 def get_method(a, n_probes=None):
     if a.gee_args is not None:
@@ -341,12 +454,20 @@ def get_method(a, n_probes=None):
         method = "lm"
     return method
 
+def set_method(a, res):
+    "vectorized version of get_method for a DataFrame of results"
+    res['method'] = np.where(res['n_probes'] == 1, get_method(a, 1),
+                             get_method(a, 2))
+    return res
+
 def gen_clusters_from_regions(feature_iter, regions):
     header = xopen(regions).next().split("\t")
     has_header = not (header[1].isdigit() and header[2].isdigit())
     regions = pd.read_table(regions, header=0 if has_header else False)
     regions.columns = 'chrom start end'.split() + list(regions.columns[3:])
 
+    # clusters are only made for regions with probes so this is an upper bound.
+    instrument.get_profiler().total = len(regions)
     regions['region'] = ['%s:%i-%i' % t for t in zip(regions['chrom'],
                                                      regions['start'],
                                                      regions['end'])]
@@ -380,8 +501,14 @@ def main(args=sys.argv[1:]):
     add_misc_args(p)
     add_expression_args(p)
     add_weight_args(p)
+    add_prefilter_args(p)
 
     a = p.parse_args(args)
+    from .prefilter import Prefilter
+    a.prefilter = Prefilter(max_nan=a.max_nan, min_samples=a.min_samples,
+                            min_var=a.min_var, min_iqr=a.min_iqr)
+    if not a.prefilter.active:
+        a.prefilter = None
     if a.gee_args:
         a.gee_args = a.gee_args.split(",")
     if a.betareg and not a.combine:
@@ -391,18 +518,48 @@ def main(args=sys.argv[1:]):
     if not "--regions" in args and a.max_merge_dist is None:
         a.max_merge_dist = 1.5 * a.max_dist
 
-    fmt = "{chrom}\t{start}\t{end}\t{coef}\t{p}\t{icoef}\t{n_probes}\t{model}\t{covariate}\t{method}"
-    if a.betareg:
-        fmt = "{chrom}\t{start}\t{end}\t{coef}\t{p}\t{n_probes}\t{model}\t{covariate}\t{method}"
-    if a.X_locs:
-        fmt += "\t{Xname}\t{Xstart}\t{Xend}\t{Xstrand}\t{distance}"
-    print("#" + fmt.replace("}", "").replace("{", ""))
-
+    if a.trace:
+        a.timing = True
+    if a.index and not (a.out or "").endswith((".gz", ".bgz")):
+        sys.stderr.write("--index requires --out ending in .gz or .bgz\n")
+        sys.exit(p.print_usage())
+    if a.X_permute_seed and a.X is None:
+        sys.stderr.write("--X-permute-seed requires --X\n")
+        sys.exit(p.print_usage())
+    writer = open_writer(a.out, result_columns(betareg=a.betareg,
+                                               X_locs=a.X_locs is not None,
+                                               timing=a.timing,
+                                               X_permute=bool(a.X_permute_seed)),
+                         index=a.index)
+    trace = instrument.TraceWriter(a.trace) if a.trace else None
+    prof = instrument.get_profiler()
+    if a.profile or a.progress is not None:
+        prof = instrument.enable(progress=a.progress)
+    try:
+        run_main(a, args, writer, prof, trace)
+        if OUTLIERS['masked']:
+            sys.stderr.write("set %i values more than %g SDs from the probe "
+                             "mean to NaN\n" % (OUTLIERS['masked'],
+                                                 a.outlier_sds))
+    finally:
+        if a.profile:
+            prof.write(a.profile)
+        if trace is not None:
+            trace.close()
+
+def run_main(a, args, writer, prof, trace=None):
     if "--regions" in args:
-        #     fmt = "{chrom}\t{start}\t{end}\t{coef}\t{p}\t{icoef}\t{n_probes}\t{model}\t{method}"
-        feature_iter = feature_gen(a.methylation, weights=a.weights)
-        cluster_gen = gen_clusters_from_regions(feature_iter, a.regions)
-        for c in clustermodelgen(a.covs, cluster_gen, a.model,
+        feature_iter = prof.timed('parse', feature_gen(a.methylation,
+                                                       weights=a.weights,
+                                                       sparse=a.sparse,
+                                                       dtype=np.float32
+                                                       if a.float32 else
+                                                       np.float64))
+        if a.prefilter is not None:
+            feature_iter = prof.timed('prefilter', a.prefilter(feature_iter))
+        cluster_gen = prof.timed('cluster',
+                          gen_clusters_from_regions(feature_iter, a.regions))
+        for res in clustermodelgen(a.covs, cluster_gen, a.model,
                           X=a.X,
                           X_locs=a.X_locs,
                           X_dist=a.X_dist,
@@ -413,11 +570,21 @@ def main(args=sys.argv[1:]):
                           gee_args=a.gee_args,
                           skat=a.skat,
                           counts=a.counts,
-                          png_path=a.png_path):
-            c['method'] = get_method(a,  c['n_probes'])
-            print(fmt.format(**c))
+                          png_path=a.png_path,
+                          plot_procs=a.plot_procs,
+                          plot_skip_existing=a.plot_skip_existing,
+                          plot_book=a.plot_book,
+                          plot_book_size=a.plot_book_size,
+                          frames=True,
+                          timing=a.timing,
+                          engine=a.engine,
+                          X_permute=a.X_permute_seed):
+            with prof.stage('write'):
+                writer.write(set_method(a, res))
+                if trace is not None:
+                    trace.add_clusters(res)
     else:
-        for c in clustermodel(a.covs, a.methylation, a.model,
+        for res in clustermodel(a.covs, a.methylation, a.model,
                           max_dist=a.max_dist,
                           linkage=a.linkage,
                           rho_min=a.rho_min,
@@ -435,9 +602,24 @@ def main(args=sys.argv[1:]):
                           X_dist=a.X_dist,
                           weights=a.weights,
                           outlier_sds=a.outlier_sds,
-                          png_path=a.png_path):
-            c['method'] = get_method(a,  c['n_probes'])
-            print(fmt.format(**c))
+                          png_path=a.png_path,
+                          plot_procs=a.plot_procs,
+                          plot_skip_existing=a.plot_skip_existing,
+                          plot_book=a.plot_book,
+                          plot_book_size=a.plot_book_size,
+                          frames=True,
+                          timing=a.timing,
+                          engine=a.engine,
+                          sparse=a.sparse,
+                          prefilter=a.prefilter,
+                          float32=a.float32,
+                          X_permute=a.X_permute_seed):
+            with prof.stage('write'):
+                writer.write(set_method(a, res))
+                if trace is not None:
+                    trace.add_clusters(res)
+    with prof.stage('write'):
+        writer.close()
 
 if __name__ == "__main__":
     import sys
@@ -446,6 +628,27 @@ if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "simulate":
         from . import simulate
         sys.exit(simulate.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        from . import tabix
+        sys.exit(tabix.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        from . import bench
+        sys.exit(bench.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "meth-matrix":
+        from . import methmatrix
+        sys.exit(methmatrix.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bgzip":
+        from . import bgzf
+        sys.exit(bgzf.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "sort":
+        from . import sortmatrix
+        sys.exit(sortmatrix.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "grid":
+        from . import grid
+        sys.exit(grid.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "evaluate":
+        from . import evaluate
+        sys.exit(evaluate.main(sys.argv[2:]))
 
     # want to specify existing regions, not use found ones.
     main()
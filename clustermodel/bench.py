@@ -0,0 +1,281 @@
+"""
+benchmark parsing, clustering and each modelling method on reproducible
+synthetic data generated with `simulate.gen_arma`:
+
+    python -m clustermodel bench --scales 2000,20000,100000 --out new.jsonl
+    python -m clustermodel bench --compare old.jsonl --out new.jsonl
+
+Each scale is run in its own process so that maxrss_mb is the peak memory of
+that scale only. Results are written as 1 JSON object per line per scale and
+step with the time taken and throughput. With --compare, steps that are
+slower or use more memory than in an earlier run (by more than --tolerance)
+are reported and the exit status is 1.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import platform
+import resource
+import traceback
+import multiprocessing
+from itertools import islice
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+MODEL = "methylation ~ disease"
+
+# name => kwargs to clustermodelgen. betareg uses the ratio and weights data
+# and X adds the expression files.
+METHODS = OrderedDict([
+    ('liptak', dict(combine='liptak')),
+    ('z-score', dict(combine='z-score')),
+    ('gee', dict(gee_args=('ex', 'CpG'))),
+    ('mixed', dict(model=MODEL + " + (1|CpG)")),
+    ('bumping', dict(bumping=True)),
+    ('betareg', dict(combine='liptak', betareg=True)),
+    ('X', dict(combine='liptak')),
+])
+
+def write_matrix(fname, index, columns, values, fmt="%.3f"):
+    df = pd.DataFrame(values, index=index, columns=columns)
+    df.to_csv(fname, sep="\t", index_label="probe", float_format=fmt)
+
+def make_data(prefix, n_probes, n_samples, corr=0.5, seed=42):
+    """
+    write reproducible synthetic data to files starting with `prefix`:
+    covariates, methylation (M-values), ratios with read-depth weights (for
+    beta-regression) and expression with locations (for X).
+    5% of probes, in blocks of 10, have a difference between cases and
+    controls. Returns a dict of file names. Existing files are re-used.
+    """
+    files = dict((k, "%s.%s" % (prefix, ext)) for k, ext in (
+                 ('covs', 'covs.txt'), ('meth', 'meth.txt'),
+                 ('ratio', 'ratio.txt'), ('weights', 'weights.txt'),
+                 ('X', 'X.txt'), ('X_locs', 'X-locs.bed.gz')))
+    if all(os.path.exists(f) for f in files.values()):
+        return files
+    from .simulate import gen_arma
+    np.random.seed(seed)
+
+    samples = ["s%i" % i for i in range(n_samples)]
+    disease = np.arange(n_samples) % 2 == 0
+    covs = pd.DataFrame({'disease': np.where(disease, 'T', 'F'),
+                         'gender': np.where(np.arange(n_samples) % 3 == 0, 'M', 'F'),
+                         'age': np.random.randint(20, 80, n_samples)},
+                        index=samples)[['disease', 'gender', 'age']]
+    covs.to_csv(files['covs'], sep="\t", index_label="sample_id")
+
+    meth = gen_arma(n_probes, n_samples, corr=corr)
+    dmr = np.zeros(n_probes, dtype=bool)
+    for i in np.random.choice(n_probes // 10, max(1, n_probes // 200),
+                              replace=False):
+        dmr[i * 10:(i + 1) * 10] = True
+    meth[np.ix_(dmr, disease)] += 0.5
+
+    # 2 chromosomes with gaps that give clusters of a few probes.
+    half = n_probes // 2
+    pos = np.cumsum(np.random.randint(10, 300, n_probes))
+    pos[half:] -= pos[half] - pos[0]
+    chroms = np.array(['chr1'] * half + ['chr2'] * (n_probes - half))
+    probes = ["%s:%i" % cp for cp in zip(chroms, pos)]
+    write_matrix(files['meth'], probes, samples, meth)
+
+    weights = np.random.poisson(20, size=meth.shape) + 1
+    ratio = np.round(weights / (1 + np.exp(-meth))) / weights
+    write_matrix(files['ratio'], probes, samples, ratio)
+    write_matrix(files['weights'], probes, samples, weights, fmt="%i")
+
+    # 1 expression probe every 50 methylation probes.
+    idx = np.arange(0, n_probes, 50)
+    genes = ["gene%i" % i for i in range(len(idx))]
+    expr = meth[idx] * 0.3 + np.random.randn(len(idx), n_samples)
+    write_matrix(files['X'], genes, samples, expr)
+    fh = gzip.open(files['X_locs'], "w")
+    fh.write("chrom\tstart\tend\tprobe\tstrand\tgene\n")
+    for g, i in zip(genes, idx):
+        fh.write("%s\t%i\t%i\t%s\t+\t%s\n" % (chroms[i], pos[i] + 500,
+                                             pos[i] + 2500, g, g))
+    fh.close()
+    return files
+
+def maxrss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def timed(fn):
+    "return (result, seconds) for fn()"
+    t = time.time()
+    res = fn()
+    return res, time.time() - t
+
+def run_scale(n_probes, n_samples, methods, max_clusters, data_dir, corr,
+              seed):
+    """
+    generate (or re-use) data of the given size and time each step. Returns
+    a list of result dicts.
+    """
+    from aclust import mclust
+    from . import feature_gen
+    from .__main__ import clustermodelgen
+
+    prefix = os.path.join(data_dir, "bench-%i-%i-%i" % (n_probes, n_samples,
+                                                        seed))
+    files = make_data(prefix, n_probes, n_samples, corr=corr, seed=seed)
+    results = []
+
+    def record(step, seconds, n, unit, error=None):
+        results.append(OrderedDict([('step', step), ('n_probes', n_probes),
+            ('n_samples', n_samples), ('seconds', seconds), ('n', n),
+            ('unit', unit),
+            ('per_second', n / seconds if seconds and not error else None),
+            ('maxrss_mb', maxrss_mb()), ('error', error)]))
+        sys.stderr.write("%s\t%i\t%s\t%.3fs\t%i %s\n" % (step, n_probes,
+                         error or "ok", seconds, n, unit))
+
+    features, secs = timed(lambda: list(feature_gen(files['meth'])))
+    record('parse', secs, len(features), 'probes')
+
+    clusters, secs = timed(lambda: list(mclust(iter(features), max_dist=200,
+                           linkage='complete', merge_linkage=0.24,
+                           max_merge_dist=300)))
+    record('cluster', secs, len(clusters), 'clusters')
+
+    ratio_clusters = None
+    for method in methods:
+        kwargs = dict(METHODS[method])
+        model = kwargs.pop('model', MODEL)
+        use = clusters
+        if method == 'betareg':
+            if ratio_clusters is None:
+                ratio_clusters = list(mclust(feature_gen(files['ratio'],
+                                      weights=files['weights']),
+                                      max_dist=200, linkage='complete',
+                                      merge_linkage=0.24, max_merge_dist=300))
+            use = ratio_clusters
+        elif method == 'X':
+            kwargs.update(X=files['X'], X_locs=files['X_locs'], X_dist=5000)
+        use = list(islice(use, max_clusters))
+        t = time.time()
+        try:
+            for res in clustermodelgen(files['covs'], iter(use), model,
+                                       outlier_sds=30, frames=True, **kwargs):
+                pass
+            error = None
+        except Exception, e:
+            traceback.print_exc()
+            error = "%s: %s" % (e.__class__.__name__, str(e)[:200])
+        record(method, time.time() - t, len(use), 'clusters', error)
+    return results
+
+def _run_scale_queue(queue, *args):
+    try:
+        queue.put(run_scale(*args))
+    except Exception, e:
+        traceback.print_exc()
+        queue.put(e)
+
+def run_isolated(*args):
+    "run_scale in a new process so memory use is for that scale alone"
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run_scale_queue, args=(queue,) + args)
+    p.start()
+    res = queue.get()
+    p.join()
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+def git_version():
+    try:
+        import subprocess
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(["git", "describe", "--always",
+                                        "--dirty"], cwd=here,
+                                        stderr=open(os.devnull, "w")).strip()
+    except Exception:
+        return None
+
+def read_results(fname):
+    return [json.loads(l) for l in open(fname) if l.strip()]
+
+def compare(old, new, tolerance=0.25):
+    """
+    return a list of strings describing the steps in `new` that are slower
+    or use more memory than in `old` by more than `tolerance` (a fraction).
+    """
+    key = lambda r: (r['step'], r['n_probes'], r['n_samples'])
+    old = dict((key(r), r) for r in old if not r.get('error'))
+    problems = []
+    for r in new:
+        o = old.get(key(r))
+        if o is None or r.get('error'): continue
+        if o['per_second'] and r['per_second'] < o['per_second'] * (1 - tolerance):
+            problems.append("%s at %i probes: %.1f %s/sec, was %.1f" % (
+                r['step'], r['n_probes'], r['per_second'], r['unit'],
+                o['per_second']))
+        if r['maxrss_mb'] > o['maxrss_mb'] * (1 + tolerance):
+            problems.append("%s at %i probes: maxrss %.0fMB, was %.0fMB" % (
+                r['step'], r['n_probes'], r['maxrss_mb'], o['maxrss_mb']))
+    return problems
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    import tempfile
+    from . import __version__
+    p = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--scales", default="2000,20000",
+                   help="comma-separated numbers of probes to simulate")
+    p.add_argument("--n-samples", type=int, default=80)
+    p.add_argument("--methods", default=",".join(METHODS),
+                   help="comma-separated subset of: %(default)s")
+    p.add_argument("--max-clusters", type=int, default=500,
+                   help="run each method on at most this many clusters")
+    p.add_argument("--corr", type=float, default=0.5,
+                   help="correlation between adjacent probes")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--data-dir", default=tempfile.gettempdir(),
+                   help="simulated data is written here and re-used")
+    p.add_argument("--out", help="write results (JSON lines) here. "
+                   "default is stdout")
+    p.add_argument("--compare", metavar="JSONL",
+                   help="results from an earlier run to compare against")
+    p.add_argument("--tolerance", type=float, default=0.25,
+                   help="with --compare, report steps that are this fraction "
+                   "slower or use this fraction more memory")
+    a = p.parse_args(argv)
+
+    methods = [m for m in a.methods.split(",") if m]
+    for m in methods:
+        if not m in METHODS:
+            p.error("unknown method: %s" % m)
+
+    info = dict(version=__version__, git=git_version(),
+                python=platform.python_version(), host=platform.node(),
+                date=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    results = []
+    for scale in map(int, a.scales.split(",")):
+        for r in run_isolated(scale, a.n_samples, methods, a.max_clusters,
+                              a.data_dir, a.corr, a.seed):
+            r.update(info)
+            results.append(r)
+
+    fh = open(a.out, "w") if a.out else sys.stdout
+    for r in results:
+        fh.write(json.dumps(r) + "\n")
+    if fh is not sys.stdout:
+        fh.close()
+
+    if a.compare:
+        problems = compare(read_results(a.compare), results, a.tolerance)
+        for problem in problems:
+            sys.stderr.write("regression: %s\n" % problem)
+        return int(bool(problems))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,473 @@
+"""
+minimal BGZF (blocked gzip) support. a BGZF file is a series of gzip members
+each holding at most 64KB of uncompressed data so it can be read by any gzip
+reader and by bgzip/tabix.
+
+Because the blocks are independent, `open_input` decompresses the blocks of
+a BGZF file on a pool of threads ahead of the caller (zlib releases the
+GIL). Plain gzip files are decompressed on a single helper thread instead.
+`bgzip` (python -m clustermodel bgzip) converts gzip to BGZF.
+"""
+import os
+import sys
+import struct
+import threading
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+# threads used to decompress (or compress in `bgzip`) blocks.
+THREADS = min(4, max(1, (os.sysconf('SC_NPROCESSORS_ONLN')
+                         if hasattr(os, 'sysconf') else 1) - 1))
+
+# blocks decompressed by each job; 16 * 64KB is ~1MB of text.
+BLOCKS_PER_JOB = 16
+
+# same as htslib so blocks never exceed 64KB even for incompressible data.
+MAX_BLOCK_SIZE = 0xff00
+
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_FOOTER = struct.Struct("<2I")
+
+EOF_BLOCK = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+             "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def compress_block(data, level=6):
+    """
+    return `data` (at most MAX_BLOCK_SIZE bytes) as a single BGZF block
+    """
+    assert len(data) <= MAX_BLOCK_SIZE, len(data)
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    # 18 bytes of header and 8 of footer. BSIZE is total size - 1
+    bsize = len(cdata) + 25
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize)
+    footer = _FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+
+class BgzfWriter(object):
+    """
+    file-like object that writes BGZF. if `threaded` is True, blocks are
+    compressed and written on a background thread so the caller can keep
+    formatting output while zlib (which releases the GIL) does its work.
+
+    `block_offsets` holds the compressed offset of every block written so
+    far; with `block_index` and `block_pos` this allows a caller to
+    calculate virtual offsets (see `virtual_offset`).
+    """
+
+    def __init__(self, fh, level=6, threaded=True, queue_size=64):
+        if isinstance(fh, basestring):
+            fh = open(fh, "wb")
+        self.fh = fh
+        self.level = level
+        self._buf = []
+        self._buf_len = 0
+        # number of blocks that have been queued for writing.
+        self.block_index = 0
+        self.block_offsets = []
+        self._offset = 0
+        self._error = None
+        self._thread = None
+        if threaded:
+            self._queue = Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._consume)
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def block_pos(self):
+        "offset of the next byte within the current (uncompressed) block"
+        return self._buf_len
+
+    def _consume(self):
+        while True:
+            data = self._queue.get()
+            if data is None: break
+            try:
+                self._write_block(data)
+            except Exception, e:
+                self._error = e
+                break
+
+    def _write_block(self, data):
+        block = compress_block(data, self.level)
+        self.block_offsets.append(self._offset)
+        self.fh.write(block)
+        self._offset += len(block)
+
+    def _emit(self, data):
+        if self._error is not None:
+            raise self._error
+        self.block_index += 1
+        if self._thread is None:
+            self._write_block(data)
+        else:
+            self._queue.put(data)
+
+    def write(self, data):
+        while data:
+            n = MAX_BLOCK_SIZE - self._buf_len
+            self._buf.append(data[:n])
+            self._buf_len += len(data[:n])
+            data = data[n:]
+            if self._buf_len == MAX_BLOCK_SIZE:
+                self.flush_block()
+
+    def flush_block(self):
+        "end the current block even if it is not full"
+        if self._buf_len == 0: return
+        self._emit("".join(self._buf))
+        self._buf, self._buf_len = [], 0
+
+    def virtual_offset(self, block_index, block_pos):
+        """
+        virtual offset of `block_pos` in block number `block_index`. only
+        valid for blocks that have already been written (e.g. after close).
+        """
+        if block_index == len(self.block_offsets):
+            # position at the very end of the file.
+            return self._offset << 16
+        return (self.block_offsets[block_index] << 16) | block_pos
+
+    def close(self):
+        if self.fh is None: return
+        self.flush_block()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_raw_block(fh):
+    """
+    read the next BGZF block from `fh` without decompressing it. returns
+    (compressed size, deflated data) with data of None at the end of the
+    file.
+    """
+    header = fh.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return 0, None
+    (id1, id2, cm, flg, mtime, xfl, os_, xlen, si1, si2, slen,
+            bsize) = _HEADER.unpack(header)
+    if (id1, id2, si1, si2) != (31, 139, 66, 67):
+        raise ValueError("not a BGZF file: %s" % getattr(fh, 'name', fh))
+    # only the BC extra field is expected but skip any others.
+    extra = xlen - 6
+    rest = fh.read(bsize + 1 - _HEADER.size)
+    return bsize + 1, rest[extra:-_FOOTER.size]
+
+def read_block(fh):
+    """
+    read the next BGZF block from `fh`. returns (compressed size, data) with
+    data of None at the end of the file.
+    """
+    size, cdata = read_raw_block(fh)
+    if cdata is None:
+        return 0, None
+    return size, zlib.decompress(cdata, -15)
+
+
+class BgzfReader(object):
+    """
+    read a BGZF file with support for seeking to and reporting virtual
+    offsets: (compressed block offset << 16) | offset within block.
+    """
+
+    def __init__(self, fh):
+        if isinstance(fh, basestring):
+            fh = open(fh, "rb")
+        self.fh = fh
+        self._block_start = 0
+        self._block_size = 0
+        self._data = ""
+        self._pos = 0
+        self._load(0)
+
+    def _load(self, coffset):
+        self.fh.seek(coffset)
+        self._block_start = coffset
+        self._block_size, data = read_block(self.fh)
+        self._data = data or ""
+        self._pos = 0
+
+    def seek(self, voffset):
+        coffset, pos = voffset >> 16, voffset & 0xffff
+        if coffset != self._block_start:
+            self._load(coffset)
+        self._pos = pos
+
+    def tell(self):
+        if self._pos == len(self._data) and self._block_size:
+            # at the end of this block is the same as the start of the next.
+            return (self._block_start + self._block_size) << 16
+        return (self._block_start << 16) | self._pos
+
+    def _next_block(self):
+        if self._block_size == 0: return False
+        self._load(self._block_start + self._block_size)
+        return True
+
+    def readline(self):
+        chunks = []
+        while True:
+            if self._pos == len(self._data):
+                if not self._next_block(): break
+                # EOF block or empty block.
+                if not self._data and self._block_size == 0: break
+                continue
+            i = self._data.find("\n", self._pos)
+            if i == -1:
+                chunks.append(self._data[self._pos:])
+                self._pos = len(self._data)
+                continue
+            chunks.append(self._data[self._pos:i + 1])
+            self._pos = i + 1
+            break
+        return "".join(chunks)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line: break
+            yield line
+
+    def close(self):
+        self.fh.close()
+
+
+def is_bgzf(fname):
+    "True if `fname` starts with a BGZF block"
+    with open(fname, "rb") as fh:
+        header = fh.read(_HEADER.size)
+    if len(header) < _HEADER.size: return False
+    h = _HEADER.unpack(header)
+    return (h[0], h[1], h[3], h[8], h[9]) == (31, 139, 4, 66, 67)
+
+def _inflate(cdatas):
+    return "".join([zlib.decompress(c, -15) for c in cdatas])
+
+def _deflate(datas, level=6):
+    return "".join([compress_block(d, level) for d in datas])
+
+def _ordered(pool, func, jobs, ahead):
+    """
+    yield func(job) for each of `jobs` in order with at most `ahead` jobs
+    running on `pool`. (pool.imap would read all of `jobs` at once)
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+class LineReader(object):
+    """
+    a read-only file-like object over an iterable of chunks of text (e.g.
+    decompressed blocks). supports iteration by line, readline and read.
+    """
+
+    def __init__(self, chunks, close=None):
+        self._chunks = iter(chunks)
+        # the unread text is self._buf[self._pos:].
+        self._buf = ""
+        self._pos = 0
+        self._close = close
+
+    def _more(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buf = self._buf[self._pos:] + chunk
+                self._pos = 0
+                return True
+        return False
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line: break
+            yield line
+
+    def next(self):
+        line = self.readline()
+        if not line: raise StopIteration
+        return line
+
+    def readline(self):
+        while True:
+            i = self._buf.find("\n", self._pos)
+            if i != -1:
+                line = self._buf[self._pos:i + 1]
+                self._pos = i + 1
+                return line
+            if not self._more():
+                line = self._buf[self._pos:]
+                self._buf, self._pos = "", 0
+                return line
+
+    def read(self, n=-1):
+        if n < 0:
+            data = [self._buf[self._pos:]] + list(self._chunks)
+            self._buf, self._pos = "", 0
+            return "".join(data)
+        while len(self._buf) - self._pos < n and self._more():
+            pass
+        data = self._buf[self._pos:self._pos + n]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def bgzf_chunks(fh, threads=THREADS, ahead=None):
+    """
+    the decompressed data of the BGZF file `fh` in chunks of BLOCKS_PER_JOB
+    blocks, decompressed on `threads` threads ahead of the caller.
+    """
+    def jobs():
+        job = []
+        while True:
+            _, cdata = read_raw_block(fh)
+            if cdata is None: break
+            job.append(cdata)
+            if len(job) == BLOCKS_PER_JOB:
+                yield job
+                job = []
+        if job: yield job
+
+    pool = ThreadPool(threads)
+    try:
+        for chunk in _ordered(pool, _inflate, jobs(), ahead or 4 * threads):
+            yield chunk
+    finally:
+        pool.terminate()
+        fh.close()
+
+def gzip_chunks(fh, size=1 << 20, queue_size=8):
+    """
+    the decompressed data of the (possibly multi-member) gzip file `fh`,
+    decompressed on a helper thread ahead of the caller in chunks of at
+    most `size` bytes so at most `queue_size` of those are waiting.
+    """
+    q = Queue(maxsize=queue_size)
+
+    def work():
+        try:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while True:
+                data = fh.read(size)
+                if not data: break
+                while data:
+                    q.put(d.decompress(data, size))
+                    # at the end of a member the rest is in both.
+                    data = d.unused_data or d.unconsumed_tail
+                    if d.unused_data:
+                        # the next gzip member.
+                        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # the rest of the last member.
+            q.put(d.flush())
+            q.put(None)
+        except Exception, e:
+            q.put(e)
+
+    t = threading.Thread(target=work)
+    t.daemon = True
+    t.start()
+    while True:
+        chunk = q.get()
+        if chunk is None: break
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+    fh.close()
+
+def open_input(fname, threads=THREADS):
+    """
+    open `fname` for reading lines: BGZF is decompressed on `threads`
+    threads and gzip on a helper thread. anything that is not a path to a
+    file (e.g. '-' or '|cmd' or an open file) is sent to toolshed.nopen.
+    """
+    if not isinstance(fname, basestring) or fname == "-" or \
+            fname.startswith(("|", "http://", "https://", "ftp://")):
+        from toolshed import nopen
+        return nopen(fname)
+    fname = os.path.expanduser(os.path.expandvars(fname))
+    with open(fname, "rb") as fh:
+        magic = fh.read(2)
+    if magic != "\x1f\x8b":
+        return open(fname)
+    fh = open(fname, "rb")
+    if threads > 0 and is_bgzf(fname):
+        return LineReader(bgzf_chunks(fh, threads))
+    return LineReader(gzip_chunks(fh))
+
+def bgzip(src, dst, threads=THREADS, level=6, chunk_blocks=BLOCKS_PER_JOB):
+    """
+    convert `src` (gzip or plain text) to BGZF in `dst`, compressing blocks
+    on `threads` threads. returns the number of bytes of text.
+    """
+    inp = open_input(src, threads)
+    n = [0]
+
+    def jobs():
+        while True:
+            data = inp.read(MAX_BLOCK_SIZE * chunk_blocks)
+            if not data: break
+            n[0] += len(data)
+            yield [data[i:i + MAX_BLOCK_SIZE]
+                   for i in range(0, len(data), MAX_BLOCK_SIZE)]
+
+    pool = ThreadPool(threads)
+    out = open(dst, "wb") if isinstance(dst, basestring) else dst
+    try:
+        for blocks in _ordered(pool, lambda d: _deflate(d, level), jobs(),
+                               4 * threads):
+            out.write(blocks)
+        out.write(EOF_BLOCK)
+    finally:
+        pool.terminate()
+        inp.close()
+        if out is not sys.stdout:
+            out.close()
+    return n[0]
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    p = argparse.ArgumentParser(description="convert a gzipped (or plain) "
+                                "text file to BGZF so that clustermodel can "
+                                "decompress it in parallel")
+    p.add_argument("--threads", type=int, default=THREADS,
+                   help="compression threads (default: %(default)s)")
+    p.add_argument("--level", type=int, default=6, help="compression level")
+    p.add_argument("input", help="gzipped or plain text file")
+    p.add_argument("output", nargs="?",
+                   help="output file. default is input with .bgz in place "
+                   "of .gz")
+    a = p.parse_args(argv)
+    out = a.output
+    if out is None:
+        out = (a.input[:-3] if a.input.endswith(".gz") else a.input) + ".bgz"
+    bgzip(a.input, out, a.threads, a.level)
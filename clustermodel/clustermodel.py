@@ -3,14 +3,140 @@ import sys
 import warnings
 import numpy as np
 import pandas as pd
-from .pyper import R
-from .send_bin import send_arrays
+from .pyper import R, TRANSFER
+from .send_bin import send_arrays, send_sparse_arrays, missing_fraction
+from .feature import ClusterBatch
+from . import instrument
 
 import tempfile
-r = R(max_len=5e7, return_err=False)
-#r('library(clustermodelr)')
-r('source("~/src/clustermodelr/R/clustermodelr.R");source("~/src/clustermodelr/R/combine.R")')
-#r('source("/usr/local/src/clustermodelr/R/clustermodelr.R");source("/usr/local/src/clustermodelr/R/combine.R")')
+
+# fit each cluster in its own mclapply job to record the time taken by each
+# fit. `fn` is mclust.lm or mclust.lm.X; arguments in ... are sent to it.
+R_TIMED = """
+timed.mclust = function(fn, formula, covs, meths, ..., weights=NULL, mc.cores=1){
+    res = parallel::mclapply(seq_along(meths), function(i){
+        start = as.numeric(Sys.time())
+        t0 = proc.time()
+        w = if(is.null(weights)) NULL else weights[i]
+        a = fn(formula, covs, meths[i], ..., weights=w, mc.cores=1)
+        t1 = proc.time() - t0
+        # rep so that a fit with no rows gets the (empty) columns too and
+        # can be rbind-ed with the others.
+        n = nrow(a)
+        a$cluster_id = rep(i, n)
+        a$r_start = rep(start, n)
+        a$r_wall = rep(t1[["elapsed"]], n)
+        a$r_cpu = rep(t1[["user.self"]] + t1[["sys.self"]], n)
+        a$r_pid = rep(Sys.getpid(), n)
+        a
+    }, mc.cores=mc.cores)
+    do.call(rbind, res)
+}
+"""
+
+# read the output of send_bin.send_arrays or send_sparse_arrays with the
+# tagged header (float32 and/or sparse). The values (only the observed ones
+# if sparse) are read directly into each matrix; the layout is that of
+# read.bin from clustermodelr: send_array sends the transpose (samples *
+# probes) flattened in row-major order.
+R_TAGGED = """
+read.tagged.bin = function(fname, fill=NaN){
+    fh = file(fname, "rb")
+    tag = readBin(fh, what="integer", size=8, n=1)
+    if(tag != -1){ close(fh); return(read.bin(fname)) }
+    size = readBin(fh, what="integer", size=8, n=1)
+    sparse = readBin(fh, what="integer", size=8, n=1)
+    n = readBin(fh, what="integer", size=8, n=1)
+    res = vector("list", n)
+    for(i in seq_len(n)){
+        shape = readBin(fh, what="integer", size=8, n=2)
+        if(sparse == 1){
+            nnz = readBin(fh, what="integer", size=8, n=1)
+            idx = readBin(fh, what="integer", size=4, n=nnz)
+            m = rep(as.double(fill), shape[1] * shape[2])
+            m[idx + 1] = readBin(fh, what="double", size=size, n=nnz)
+        } else {
+            m = readBin(fh, what="double", size=size, n=shape[1] * shape[2])
+        }
+        res[[i]] = matrix(m, nrow=shape[1], ncol=shape[2], byrow=TRUE)
+    }
+    close(fh)
+    res
+}
+"""
+
+# X (probes * samples) with the values of its samples in the order `perm`
+# but the same column names, for --X-permute-seed.
+R_PERMUTE = """
+permute.X = function(X, perm){
+    n = colnames(X)
+    X = X[, perm, drop=FALSE]
+    colnames(X) = n
+    X
+}
+
+# call `fit` with X permuted by each of `perms` so the clusters and
+# covariates are sent once for all permutations. the index of the
+# permutation is in the X_permute_i column of the result.
+permuted.fits = function(fit, X, perms){
+    res = lapply(seq_along(perms), function(i){
+        a = fit(permute.X(X, perms[[i]]))
+        a$X_permute_i = rep(i, nrow(a))
+        a
+    })
+    do.call(rbind, res)
+}
+"""
+
+def X_permutation(n, seed):
+    """
+    the (0-based) order of the `n` samples of X for a permutation by `seed`;
+    the same for every run.
+    >>> X_permutation(6, 42).tolist()
+    [0, 1, 5, 2, 4, 3]
+    """
+    return np.random.RandomState(seed).permutation(n)
+
+# send matrices with more than this fraction missing (NaN values or 0
+# weights) with send_sparse_arrays.
+SPARSE_MIN = 0.5
+
+class LazyR(object):
+    """
+    start R and source clustermodelr on first use (r(...), r['x'] or
+    r['x'] = y) so that importing clustermodel, --help and code that doesn't
+    call R do not pay for starting an R process.
+    """
+    def __init__(self, *args, **kwargs):
+        self._args, self._kwargs = args, kwargs
+        self._r = None
+
+    @property
+    def started(self):
+        return self._r is not None
+
+    def session(self):
+        if self._r is None:
+            r = R(*self._args, **self._kwargs)
+            #r('library(clustermodelr)')
+            r('source("~/src/clustermodelr/R/clustermodelr.R");source("~/src/clustermodelr/R/combine.R")')
+            #r('source("/usr/local/src/clustermodelr/R/clustermodelr.R");source("/usr/local/src/clustermodelr/R/combine.R")')
+            r(R_TIMED)
+            r(R_TAGGED)
+            r(R_PERMUTE)
+            self._r = r
+        return self._r
+
+    def __call__(self, *args, **kwargs):
+        return self.session()(*args, **kwargs)
+
+    def __getitem__(self, obj):
+        return self.session()[obj]
+
+    def __setitem__(self, obj, val):
+        self.session()[obj] = val
+
+r = LazyR(max_len=5e7, return_err=False)
 
 def ilogit(v):
     return 1 / (1 + np.exp(-v))
@@ -26,23 +152,51 @@ def kwargs_to_str(kwargs):
     return ", ".join("%s=%s"  % (k, convert(v))
                             for k, v in kwargs.iteritems())
 
+def get_result(prof):
+    "read the data.frame `a` back from R"
+    with prof.stage('decode'):
+        received = TRANSFER['received']
+        df = r['a']
+        prof.add('bytes_from_R', TRANSFER['received'] - received)
+    return df
+
+def send(arrays, bin_fh, fill, prof):
+    """
+    write `arrays` to `bin_fh` for R, as sparse if most values are `fill`
+    and as float32 if they are float32, and return the R expression that
+    reads them.
+    """
+    with prof.stage('send_arrays'):
+        dtype = np.float32 if len(arrays) and \
+                np.asarray(arrays[0]).dtype == np.float32 else np.float64
+        if missing_fraction(arrays, fill) > SPARSE_MIN:
+            send_sparse_arrays(arrays, bin_fh.file, fill, dtype)
+        else:
+            send_arrays(arrays, bin_fh.file, dtype)
+        prof.add('bytes_to_R', bin_fh.file.tell())
+    return 'read.tagged.bin("%s", fill=%s)' % (bin_fh.name,
+                                               "NaN" if fill != fill else fill)
+
 def rcall(cov, meths, model, X=None, weights=None, kwargs=None,
+        timing=False, X_perms=None,
         bin_fh=tempfile.NamedTemporaryFile(suffix='.cluster.bin'),
         weight_fh=tempfile.NamedTemporaryFile(suffix='.cluster.bin')):
     """
-    internal function to call R and return the result
+    internal function to call R and return the result. if `timing` is True,
+    each cluster is fit separately and the result has r_start (epoch
+    seconds), r_wall, r_cpu (seconds) and r_pid columns for each fit.
+    `X_perms` is the name of a list of permutations of the samples of X in
+    R; the clusters are fit against X permuted by each (see permuted.fits).
     """
     if kwargs is None: kwargs = {}
 
     # send the methylation arrays via binary. this is
     # much faster than relying on pyper to send large
     # matrices. send_arrays does a seek(0).
-    send_arrays(meths, bin_fh.file)
-    r('meths = read.bin("%s")' % bin_fh.name)
+    prof = instrument.get_profiler()
+    r('meths = %s' % send(meths, bin_fh, np.nan, prof))
     if weights is not None:
-
-        send_arrays(weights, weight_fh.file)
-        r('weights = read.bin("%s")' % weight_fh.name)
+        r('weights = %s' % send(weights, weight_fh, 0, prof))
     else:
         r('weights = NULL')
 
@@ -56,6 +210,7 @@ def rcall(cov, meths, model, X=None, weights=None, kwargs=None,
         fh = tempfile.NamedTemporaryFile()
         cov.to_csv(fh, index=False)
         fh.flush()
+        prof.add('bytes_to_R', fh.tell())
         cov = fh.name
 
     assert os.path.exists(cov), cov
@@ -63,10 +218,15 @@ def rcall(cov, meths, model, X=None, weights=None, kwargs=None,
     if X is None:
         kwargs_str = kwargs_to_str(kwargs)
         #print >>sys.stderr, "fclust.lm(cov, meths, '%s', %s)" % (model, kwargs_str)
-        r("a <- data.frame(p=NaN, coef=NaN, covariate=NA); a <- mclust.lm('%s', cov, meths, weights=weights, %s)"
-                % (model, kwargs_str))
+        with prof.stage('R'):
+            if timing:
+                r("a <- data.frame(p=NaN, coef=NaN, covariate=NA); a <- timed.mclust(mclust.lm, '%s', cov, meths, weights=weights, %s)"
+                        % (model, kwargs_str))
+            else:
+                r("a <- data.frame(p=NaN, coef=NaN, covariate=NA); a <- mclust.lm('%s', cov, meths, weights=weights, %s)"
+                        % (model, kwargs_str))
         try:
-            df = r['a']
+            df = get_result(prof)
         except Exception, e:
             sys.stderr.write("%s\n...\n%s" % (str(e)[:1000], str(e)[-1000:]))
             raise Exception('error getting data from R')
@@ -75,8 +235,19 @@ def rcall(cov, meths, model, X=None, weights=None, kwargs=None,
     else:
         kwargs_str = kwargs_to_str(kwargs)
         #print >>sys.stderr, "mclust.lm.X('%s', cov, meths, %s, %s)" % (model, X, kwargs_str)
-        r("a = data.frame(p=NaN, coef=NaN, covariate=NA); a <- mclust.lm.X('%s', cov, meths, %s, weights=weights, %s)" % (model, X, kwargs_str))
-        df = r['a']
+        if timing:
+            call = "timed.mclust(mclust.lm.X, '%s', cov, meths, %s, weights=weights, %s)"
+        else:
+            call = "mclust.lm.X('%s', cov, meths, %s, weights=weights, %s)"
+        if X_perms is not None:
+            # X is evaluated once and each permutation of it is bound to XX.
+            call = "permuted.fits(function(XX) %s, %s, %s)" % (
+                        call % (model, "XX", kwargs_str), X, X_perms)
+        else:
+            call = call % (model, X, kwargs_str)
+        with prof.stage('R'):
+            r("a = data.frame(p=NaN, coef=NaN, covariate=NA); a <- " + call)
+        df = get_result(prof)
 
     df['coef'] = df['coef'].astype(float)
     # since we're probably operating on logit transformed data
@@ -86,7 +257,7 @@ def rcall(cov, meths, model, X=None, weights=None, kwargs=None,
 
 def clustered_model(cov_df, cluster_dfs, model, X=None, weights=None, gee_args=(),
         combine=False, bumping=False, betareg=False, skat=False, counts=False,
-        outlier_sds=None):
+        outlier_sds=None, timing=False, engine='R', X_perms=None):
     """
     Given a cluster of (presumably) correlated CpG's. There are a number of
     methods one could employ to determine the association of the methylation
@@ -117,6 +288,10 @@ def clustered_model(cov_df, cluster_dfs, model, X=None, weights=None, gee_args=(
                      and index indicating the CpG (name or site) and columns
                      of sample ids. This function will use samples from the
                      intersection of cluster_df.columns and cov_df.index
+                     A list of these or a feature.ClusterBatch with columns
+                     in the order of cov_df.index may be used to fit many
+                     clusters at once. The weights of a ClusterBatch are
+                     used if `weights` is not given.
 
         model - model in R syntax with "methylation ~" as the RHS. Other
                 allowed covariates are any that appear in cov_df as well as
@@ -133,6 +308,10 @@ def clustered_model(cov_df, cluster_dfs, model, X=None, weights=None, gee_args=(
             this file--this is computationally intensive!! Or a data.frame
             or matrix already defined in R.
 
+        X_perms - the name of a list of permutations of the samples of X
+                  defined in R. Each cluster is tested against X permuted by
+                  each; the result has an X_permute_i column (1-based).
+
         gee_args - a 2-tuple of arguments to R's geepack::geeglm().
                    1) the corstr (one of "ex", "in", "ar")
                    2) the cluster variable. This will likely be "id" if
@@ -154,10 +333,32 @@ def clustered_model(cov_df, cluster_dfs, model, X=None, weights=None, gee_args=(
 
         skat - if set to True, use skat to test if modelling the CpG
                methylation better describes the dependent variable.
+
+        timing - if set to True, fit each cluster separately in R and add
+                 columns with the time taken for each (see `rcall`).
+
+        engine - 'R' or 'python'. With 'python', methods that have a python
+                 implementation (see pyengine.py) are fit in a pool of
+                 python processes instead of R. The result always has the
+                 timing columns. X is always done in R.
     """
 
     cov_df['id'] = np.arange(cov_df.shape[0]).astype(int)
     cov = cov_df
+    if isinstance(cluster_dfs, ClusterBatch):
+        if outlier_sds > 0:
+            # mask the whole batch matrix in place.
+            prof = instrument.get_profiler()
+            with prof.stage('outliers'):
+                if cluster_dfs.sparse is not None:
+                    n = mask_sparse_outliers(cluster_dfs.sparse, outlier_sds)
+                else:
+                    n = mask_outliers(cluster_dfs.values, outlier_sds)
+                prof.add('outliers_masked', n)
+            outlier_sds = None
+        if weights is None:
+            weights = cluster_dfs.arrays(weights=True)
+        cluster_dfs = cluster_dfs.arrays()
     meths = cluster_dfs if not isinstance(cluster_dfs, (pd.DataFrame,
                                                         pd.Series)) \
                         else [cluster_dfs]
@@ -166,44 +367,121 @@ def clustered_model(cov_df, cluster_dfs, model, X=None, weights=None, gee_args=(
                       else [weights]
 
     if outlier_sds > 0:
-        [set_outlier_nan(cluster_df, outlier_sds) for cluster_df in meths]
+        prof = instrument.get_profiler()
+        with prof.stage('outliers'):
+            meths, n = mask_batch(meths, outlier_sds)
+            prof.add('outliers_masked', n)
+
+    if engine == 'python' and X is None:
+        from . import pyengine
+        with instrument.get_profiler().stage('python'):
+            df = pyengine.clustered_model(cov, meths, model, weights=weights,
+                    gee_args=gee_args, combine=combine, bumping=bumping,
+                    betareg=betareg, skat=skat, counts=counts)
+        if df is not None:
+            df['icoef'] = ilogit(df['coef']) - 0.5
+            return df
 
     if betareg:
         assert weights is not None
         return rcall(cov, meths, model, X, weights=weights,
-                kwargs={'combine': combine, 'betareg': True})
+                kwargs={'combine': combine, 'betareg': True}, timing=timing,
+                X_perms=X_perms)
 
     if "|" in model:
         assert not any((skat, combine, bumping, gee_args))
-        return rcall(cov, meths, model, X, weights=weights, kwargs=dict(counts=counts))
+        return rcall(cov, meths, model, X, weights=weights,
+                     kwargs=dict(counts=counts), timing=timing,
+                     X_perms=X_perms)
 
     if skat:
-        return rcall(cov, meths, model, X, weights=weights, kwargs=dict(skat=True))
+        return rcall(cov, meths, model, X, weights=weights,
+                     kwargs=dict(skat=True), timing=timing,
+                     X_perms=X_perms)
     elif combine:
-        return rcall(cov, meths, model, X, weights=weights, kwargs=dict(combine=combine))
+        return rcall(cov, meths, model, X, weights=weights,
+                     kwargs=dict(combine=combine), timing=timing,
+                     X_perms=X_perms)
     elif bumping:
-        return rcall(cov, meths, model, X, weights=weights, kwargs=dict(bumping=True))
+        return rcall(cov, meths, model, X, weights=weights,
+                     kwargs=dict(bumping=True), timing=timing,
+                     X_perms=X_perms)
     elif gee_args:
         corr, col = gee_args
         assert corr[:2] in ('ex', 'ar', 'in', 'un')
         return rcall(cov, meths, model, X, weights=weights,
-                kwargs={"gee.corstr": corr, "gee.idvar": col, "counts": counts})
+                kwargs={"gee.corstr": corr, "gee.idvar": col, "counts": counts},
+                timing=timing, X_perms=X_perms)
     else:
         raise Exception('must specify one of skat/combine/bumping/gee_args'
                         ' or specify a mixed-effect model in lme4 syntax')
 
+# total number of values set to NaN by mask_outliers.
+OUTLIERS = {'masked': 0}
+
+def mask_outliers(values, n_sds):
+    """
+    set to nan (in place) any values in the 2D array `values` that are >
+    n_sds standard-deviations away from the mean of their row (probe).
+    returns the number of values that were masked.
+    >>> a = np.array([[1, 1, 1, 1, 1, 1, 1, 1, 1, 100.], [1, 2, 3, np.nan, 4, 5, 6, 7, 8, 9]])
+    >>> mask_outliers(a, 2), np.isnan(a).sum(axis=1).tolist()
+    (1, [1, 1])
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        m = np.nanmean(values, axis=1)[:, None]
+        s = n_sds * np.nanstd(values, axis=1, ddof=1)[:, None]
+        with np.errstate(invalid='ignore'):
+            out = (values < m - s) | (values > m + s)
+    n = int(out.sum())
+    values[out] = np.nan
+    OUTLIERS['masked'] += n
+    return n
+
+def mask_sparse_outliers(rows, n_sds):
+    """
+    `mask_outliers` for the observed values of a feature.SparseRows (in
+    place) without making the dense matrix. returns the number masked.
+    """
+    nrows = len(rows.indptr) - 1
+    row = np.repeat(np.arange(nrows), np.diff(rows.indptr))
+    data = rows.data
+    ok = ~np.isnan(data)
+    n = np.bincount(row[ok], minlength=nrows).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m = np.bincount(row[ok], data[ok], minlength=nrows) / n
+        d = np.abs(data - m[row])
+        s = n_sds * np.sqrt(np.bincount(row[ok], d[ok] ** 2,
+                                        minlength=nrows) / (n - 1))
+        out = d > s[row]
+    masked = int(out.sum())
+    data[out] = np.nan
+    OUTLIERS['masked'] += masked
+    return masked
+
 def set_outlier_nan(cluster_df, n_sds):
     """
     take cluster dataframe and set to nan
     any values where that are > n_sds standard-deviations away
-    from the mean for that probe
+    from the mean for that probe. returns the number masked.
     """
-    #imean, isd = cluster_df.mean(axis=1), cluster_df.std(axis=1,
-    #        skipna=True)
+    values = np.atleast_2d(np.asarray(cluster_df, dtype=float)).copy()
+    n = mask_outliers(values, n_sds)
+    if n:
+        cluster_df.iloc[:] = values.reshape(cluster_df.shape)
+    return n
 
-    for probe in cluster_df.index:
-        row = cluster_df.ix[probe, :]
-        rown = row[~np.isnan(row)]
-        m, s = rown.mean(), rown.std()
-        rng = (m - (n_sds * s)), (m + (n_sds * s))
-        row[((row < rng[0]) | (row > rng[1]))] = np.nan
+def mask_batch(meths, n_sds):
+    """
+    mask outliers in a batch of clusters (DataFrames or arrays) at once.
+    returns the clusters as arrays (of the same shapes) and the number of
+    values masked.
+    """
+    shapes = [np.shape(m) for m in meths]
+    values = np.vstack([np.atleast_2d(np.asarray(m, dtype=float))
+                        for m in meths])
+    n = mask_outliers(values, n_sds)
+    sizes = [shape[0] if len(shape) == 2 else 1 for shape in shapes]
+    return [v.reshape(shape) for v, shape in
+            zip(np.split(values, np.cumsum(sizes)[:-1]), shapes)], n
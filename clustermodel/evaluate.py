@@ -0,0 +1,163 @@
+"""
+summarize the results of methods run on simulated data (see simulate.py and
+grid.py):
+
+    python -m clustermodel evaluate sims/ns_*/rho_*/w_*/ > summary.txt
+
+For each result file (.bed, .bed.gz or .npz) the regions are read once,
+marked true if they overlap a simulated cluster with w > 0 (from the
+*.clusters.txt of the simulation) and counted for every cutoff in CUTOFFS
+and every n_probes. The table for each file is cached next to it in
+`file + '.summary.txt'` and is re-made only if the result or the clusters
+file is newer.
+"""
+import os
+import sys
+import os.path as op
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+# p-value cutoffs counted for every file; regions with p <= cutoff.
+CUTOFFS = np.array([0.05] + [float("1e-%i" % i) for i in range(1, 13)])
+SUFFIXES = (".bed", ".bed.gz", ".bgz", ".npz")
+COLUMNS = ["n_probes", "cutoff", "tp", "fp"]
+
+def read_regions(fname):
+    "chrom, start, end, p and n_probes of the regions in a result file"
+    if fname.endswith(".npz"):
+        from .output import read_npz
+        df = read_npz(fname)
+    else:
+        # pandas only infers gzip from .gz; open_writer also writes .bgz.
+        gz = fname.endswith((".gz", ".bgz"))
+        df = pd.read_csv(fname, sep="\t",
+                         usecols=["#chrom", "start", "end", "p", "n_probes"],
+                         dtype={"#chrom": str},
+                         compression="gzip" if gz else None)
+        df.rename(columns={"#chrom": "chrom"}, inplace=True)
+    return df[["chrom", "start", "end", "p", "n_probes"]]
+
+def read_truth(fname):
+    """
+    the simulated clusters with w > 0 as {chrom: (starts, running max of
+    ends)} sorted by start.
+    """
+    df = pd.read_csv(fname, sep="\t", usecols=["chrom", "start", "end", "w"],
+                     dtype={"chrom": str})
+    df = df[df["w"] > 0].sort_values(["chrom", "start"])
+    return dict((chrom, (g["start"].values,
+                         np.maximum.accumulate(g["end"].values)))
+                for chrom, g in df.groupby("chrom"))
+
+def overlaps(regions, truth):
+    """
+    True for each region that overlaps any interval of `truth` (from
+    `read_truth`).
+    >>> t = {'chr1': (np.array([10, 50]), np.array([20, 60]))}
+    >>> r = pd.DataFrame({'chrom': ['chr1'] * 3 + ['chr2'],
+    ...                   'start': [0, 25, 55, 10], 'end': [12, 40, 70, 20]})
+    >>> overlaps(r, t)
+    array([ True, False,  True, False])
+    """
+    res = np.zeros(len(regions), dtype=bool)
+    chroms = regions["chrom"].values
+    for chrom in np.unique(chroms):
+        if chrom not in truth: continue
+        starts, ends = truth[chrom]
+        idx = np.flatnonzero(chroms == chrom)
+        # the last interval that starts before each region ends.
+        j = np.searchsorted(starts, regions["end"].values[idx]) - 1
+        ok = j >= 0
+        res[idx[ok]] = ends[j[ok]] > regions["start"].values[idx[ok]]
+    return res
+
+def count_table(p, n_probes, true, cutoffs=CUTOFFS):
+    """
+    the number of true and false positives (p <= cutoff) for each
+    n_probes and cutoff.
+    >>> df = count_table(np.array([1e-6, 0.01, 0.2]), np.array([2, 2, 3]),
+    ...                  np.array([True, False, False]), np.array([0.05, 1e-5]))
+    >>> df[['n_probes', 'tp', 'fp']].values.tolist()
+    [[2, 1, 1], [2, 1, 0], [3, 0, 0], [3, 0, 0]]
+    """
+    cutoffs = np.asarray(cutoffs)
+    asc = np.sort(cutoffs)
+    sizes, stratum = np.unique(n_probes, return_inverse=True)
+    # each p passes asc[i:] where i is the number of cutoffs below it.
+    p = np.where(np.isnan(p), np.inf, p)
+    i = np.searchsorted(asc, p, side='left')
+    counts = np.zeros((len(sizes), 2, len(asc) + 1), dtype=np.int64)
+    np.add.at(counts, (stratum, true.astype(int), i), 1)
+    passing = counts.cumsum(axis=2)[:, :, np.searchsorted(asc, cutoffs)]
+    return pd.DataFrame({"n_probes": np.repeat(sizes, len(cutoffs)),
+                         "cutoff": np.tile(cutoffs, len(sizes)),
+                         "tp": passing[:, 1].ravel(),
+                         "fp": passing[:, 0].ravel()}, columns=COLUMNS)
+
+def find_truth(fname):
+    "the *.clusters.txt of the simulation in the directory of `fname` or above"
+    d = op.dirname(op.abspath(fname))
+    for _ in range(3):
+        found = sorted(glob(op.join(d, "*.clusters.txt")))
+        if found:
+            return found[0]
+        d = op.dirname(d)
+    raise ValueError("no *.clusters.txt found for %s" % fname)
+
+def summarize_file(fname, truth=None, cutoffs=CUTOFFS):
+    """
+    the count_table for the result file `fname` from its cache if that is
+    up to date.
+    """
+    truth = truth or find_truth(fname)
+    cache = fname + ".summary.txt"
+    if op.exists(cache) and op.getmtime(cache) >= max(op.getmtime(fname),
+                                                       op.getmtime(truth)):
+        df = pd.read_csv(cache, sep="\t", float_precision="round_trip")
+        if len(df) == 0 or np.array_equal(np.unique(df["cutoff"]),
+                                          np.unique(cutoffs)):
+            return df
+    regions = read_regions(fname)
+    df = count_table(regions["p"].values.astype(float),
+                     regions["n_probes"].values,
+                     overlaps(regions, read_truth(truth)), cutoffs)
+    df.to_csv(cache + ".tmp", sep="\t", index=False)
+    os.rename(cache + ".tmp", cache)
+    return df
+
+def result_files(path):
+    "the result files in (and below) the directory `path`"
+    found = []
+    for d in (path, op.join(path, "*")):
+        found.extend(f for f in glob(op.join(d, "*"))
+                     if f.endswith(SUFFIXES) and op.isfile(f)
+                     and not op.basename(f).startswith(".partial."))
+    return sorted(found)
+
+def summarize(paths, cutoffs=CUTOFFS):
+    """
+    the count tables of all result files in the directories `paths` in 1
+    DataFrame with the file, its directory and its method (the name of the
+    file up to the first '.').
+    """
+    frames = []
+    for path in paths:
+        for f in result_files(path):
+            df = summarize_file(f, cutoffs=cutoffs)
+            df.insert(0, "method", op.basename(f).split(".")[0])
+            df.insert(0, "file", f)
+            df.insert(0, "dir", path.rstrip("/"))
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["dir", "file", "method"] + COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    p = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("dirs", nargs="+", help="directories with results")
+    a = p.parse_args(argv)
+    summarize(a.dirs).to_csv(sys.stdout, sep="\t", index=False)
@@ -3,6 +3,7 @@ import numpy as np
 import scipy.stats as ss
 import pandas as pd
 from toolshed import reader
+from .bgzf import open_input
 
 class ClusterFeature(object):
     __slots__ = "group start end values rho_min weights".split()
@@ -29,6 +30,76 @@ class ClusterFeature(object):
         return "%s(%s:%s-%s [%i values])" % (c, self.group, self.start,
                                              self.end, len(self.values))
 
+class SparseFeature(ClusterFeature):
+    """
+    a feature that keeps only the samples with a value (e.g. the samples
+    with reads covering a CpG for bisulfite-seq): `idx` are the indexes of
+    those samples of `n` and `data` (and `wdata` for the weights) their
+    values. `values` and `weights` give the full arrays with NaN (and 0)
+    for the samples without a value. Correlation is over the samples that
+    have a value at both features.
+    """
+    __slots__ = "idx data wdata n".split()
+
+    # fewer samples than this with values at both features are never
+    # correlated.
+    min_shared = 5
+
+    def __init__(self, group, start, end, idx, data, n, rho_min=0.25,
+                 weights=None):
+        self.group, self.start, self.end = group, start, end
+        self.idx, self.data, self.n, self.wdata = idx, data, n, weights
+        self.rho_min = rho_min
+
+    @property
+    def values(self):
+        v = np.empty(self.n, dtype=self.data.dtype)
+        v.fill(np.nan)
+        v[self.idx] = self.data
+        return v
+
+    @property
+    def weights(self):
+        if self.wdata is None: return None
+        w = np.zeros(self.n, dtype=self.wdata.dtype)
+        w[self.idx] = self.wdata
+        return w
+
+    def is_correlated(self, other):
+        _, i, j = _intersect(self.idx, other.idx)
+        if len(i) < self.min_shared: return False
+        return _spearman(self.data[i], other.data[j]) > self.rho_min
+
+    def __repr__(self):
+        c = self.__class__.__name__
+        return "%s(%s:%s-%s [%i of %i values])" % (c, self.group, self.start,
+                                                   self.end, len(self.idx),
+                                                   self.n)
+
+def _intersect(a, b):
+    """
+    common values of sorted, unique a and b and their indexes in each
+    >>> _intersect(np.array([1, 3, 5, 7]), np.array([3, 4, 7]))
+    (array([3, 7]), array([1, 3]), array([0, 2]))
+    """
+    i = np.searchsorted(b, a)
+    i[i == len(b)] = 0
+    ia = np.where(b[i] == a)[0] if len(b) else np.array([], dtype=int)
+    return a[ia], ia, i[ia]
+
+def _spearman(a, b):
+    """
+    spearman's rho without the overhead of ss.spearmanr (nan if either is
+    constant).
+    >>> round(_spearman(np.array([1, 2, 3, 4.]), np.array([1, 3, 2, 5.])), 3)
+    0.8
+    """
+    x, y = ss.rankdata(a), ss.rankdata(b)
+    x -= x.mean()
+    y -= y.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x.dot(y) / np.sqrt(x.dot(x) * y.dot(y))
+
 def row_handler(tokens):
     try:
         chrom, pos = tokens[0].split(":" if ":" in tokens[0] else "_")
@@ -37,6 +108,54 @@ def row_handler(tokens):
     return (chrom, int(pos) - 1, int(pos), np.array([float(x or 'nan')
                                                      for x in tokens[1:]]))
 
+def sparse_row_handler(tokens):
+    """
+    like `row_handler` but returns chrom, start, end, the indexes of the
+    samples with values and those values.
+    >>> sparse_row_handler(['chr1:22', '', '0.5', 'nan', '1'])
+    ('chr1', 21, 22, array([1, 3], dtype=int32), array([0.5, 1. ]))
+    """
+    chrom, start, end, _ = row_handler(tokens[:1])
+    vals = tokens[1:]
+    idx = np.array([i for i, x in enumerate(vals) if x], dtype=np.int32)
+    data = np.array([float(vals[i]) for i in idx])
+    ok = ~np.isnan(data)
+    return chrom, start, end, idx[ok], data[ok]
+
+class SortCheck(object):
+    """
+    check that the rows of `fname` are sorted as they are parsed: each
+    chromosome in 1 block and positions increasing within it. calling it
+    with a row that is out of order raises a ValueError for that line.
+    >>> check = SortCheck('meth.txt')
+    >>> check(2, 'chr1', 9); check(3, 'chr2', 4); check(4, 'chr1', 19)
+    Traceback (most recent call last):
+    ...
+    ValueError: meth.txt line 4: chr1:20 after chr2:5; chr1 appeared before. sort with `python -m clustermodel sort`
+    """
+    __slots__ = ("fname", "chrom", "start", "seen")
+
+    def __init__(self, fname):
+        self.fname, self.chrom, self.start = fname, None, -1
+        self.seen = set()
+
+    def __call__(self, lineno, chrom, start):
+        if chrom == self.chrom:
+            if start >= self.start:
+                self.start = start
+                return
+            why = "positions decrease"
+        elif chrom in self.seen:
+            why = "%s appeared before" % chrom
+        else:
+            self.seen.add(chrom)
+            self.chrom, self.start = chrom, start
+            return
+        raise ValueError("%s line %i: %s:%i after %s:%i; %s. sort with "
+                         "`python -m clustermodel sort`"
+                         % (self.fname, lineno, chrom, start + 1, self.chrom,
+                            self.start + 1, why))
+
 def cluster_to_dataframe(cluster, columns=None, weights=False):
     if weights:
         df = pd.DataFrame([c.weights for c in cluster],
@@ -48,8 +167,200 @@ def cluster_to_dataframe(cluster, columns=None, weights=False):
         df.columns = columns
     return df
 
+class SparseRows(object):
+    """
+    the values (and weights) of rows of `SparseFeature`s as in a CSR matrix:
+    those of row k are data[indptr[k]:indptr[k + 1]] (and the same slice of
+    wdata) for the samples in that slice of idx out of `n`.
+    """
+    __slots__ = "indptr idx data wdata n".split()
+
+    def __init__(self, indptr, idx, data, wdata, n):
+        self.indptr, self.idx, self.data = indptr, idx, data
+        self.wdata, self.n = wdata, n
+
+    @classmethod
+    def from_features(cls, features, dtype=float):
+        indptr = np.concatenate(([0], np.cumsum([len(f.idx) for f in features])))
+        cat = lambda arrays: np.concatenate(arrays) if arrays else np.array([])
+        idx = cat([f.idx for f in features]).astype(np.int32)
+        data = cat([f.data for f in features]).astype(dtype)
+        wdata = None
+        if features and features[0].wdata is not None:
+            wdata = cat([f.wdata for f in features]).astype(dtype)
+        return cls(indptr, idx, data, wdata,
+                   features[0].n if features else 0)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def dense(self, s=0, e=None, weights=False):
+        """
+        rows s:e as a rows * n matrix with NaN for the missing values (0
+        for the missing weights).
+        """
+        if e is None: e = len(self)
+        src = self.wdata if weights else self.data
+        m = np.empty((e - s, self.n), dtype=self.data.dtype)
+        m.fill(0 if weights else np.nan)
+        lo, hi = self.indptr[s], self.indptr[e]
+        rows = np.repeat(np.arange(e - s), np.diff(self.indptr[s:e + 1]))
+        m[rows, self.idx[lo:hi]] = src[lo:hi]
+        return m
+
+class ClusterArrays(object):
+    """
+    the dense values (or weights) of each cluster in a sparse ClusterBatch.
+    each is filled in from the SparseRows as it is used so the whole batch
+    is never dense at once.
+    """
+    def __init__(self, rows, offsets, weights=False):
+        self.rows, self.offsets, self.weights = rows, offsets, weights
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        return self.rows.dense(self.offsets[i], self.offsets[i + 1],
+                               self.weights)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class ClusterBatch(object):
+    """
+    a batch of clusters in contiguous arrays: `values` (and `weights`) are
+    probes * samples for all probes of all clusters with cluster i in
+    rows offsets[i]:offsets[i + 1]. `chrom`, `start` and `end` are per
+    cluster and `pos` (the end of each probe) is per probe.
+    A batch of `SparseFeature`s keeps only the observed values in `sparse`
+    (SparseRows); `arrays` and `to_dataframe` fill in one cluster at a time
+    and `values` and `weights` make the dense matrices when used.
+    """
+    __slots__ = "_values _weights offsets chrom start end pos sparse".split()
+
+    def __init__(self, values, weights, offsets, chrom, start, end, pos,
+                 sparse=None):
+        self._values, self._weights, self.offsets = values, weights, offsets
+        self.chrom, self.start, self.end, self.pos = chrom, start, end, pos
+        self.sparse = sparse
+
+    @classmethod
+    def from_clusters(cls, clusters):
+        "make a batch from lists of ClusterFeatures (e.g. from aclust)"
+        features = [f for c in clusters for f in c]
+        if features and isinstance(features[0], SparseFeature):
+            values, weights = None, None
+            sparse = SparseRows.from_features(features, _dtype(features))
+        else:
+            values, weights = feature_arrays(features)
+            sparse = None
+        offsets = np.concatenate(([0], np.cumsum([len(c) for c in clusters])))
+        return cls(values, weights, offsets,
+                   np.array([c[0].group for c in clusters], dtype=object),
+                   np.array([c[0].start for c in clusters], dtype=np.int64),
+                   np.array([c[-1].end for c in clusters], dtype=np.int64),
+                   np.array([f.end for f in features], dtype=np.int64),
+                   sparse=sparse)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def values(self):
+        if self.sparse is None: return self._values
+        return self.sparse.dense()
+
+    @property
+    def weights(self):
+        if self.sparse is None: return self._weights
+        if self.sparse.wdata is None: return None
+        return self.sparse.dense(weights=True)
+
+    @property
+    def has_weights(self):
+        if self.sparse is None: return self._weights is not None
+        return self.sparse.wdata is not None
+
+    @property
+    def n_samples(self):
+        if self.sparse is None: return self._values.shape[1]
+        return self.sparse.n
+
+    @property
+    def sizes(self):
+        "number of probes in each cluster"
+        return np.diff(self.offsets)
+
+    def arrays(self, weights=False):
+        "views of the values (or weights) of each cluster"
+        if weights and not self.has_weights: return None
+        if self.sparse is not None:
+            return ClusterArrays(self.sparse, self.offsets, weights)
+        m = self._weights if weights else self._values
+        return [m[s:e] for s, e in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def to_dataframe(self, i, columns=None, weights=False):
+        "cluster `i` as from cluster_to_dataframe"
+        s, e = self.offsets[i], self.offsets[i + 1]
+        if self.sparse is not None:
+            m = self.sparse.dense(s, e, weights)
+        else:
+            m = (self._weights if weights else self._values)[s:e]
+        return pd.DataFrame(m, columns=columns,
+                            index=["%s:%i" % (self.chrom[i], p)
+                                   for p in self.pos[s:e]])
+
+def _dtype(features):
+    "float32 if the features are (see feature_gen) otherwise float64"
+    sparse = features and isinstance(features[0], SparseFeature)
+    return np.float32 if features and np.asarray(features[0].data if sparse
+                            else features[0].values).dtype == np.float32 \
+                      else float
+
+def feature_arrays(features):
+    """
+    the values and weights (or None) of a list of features as features *
+    samples matrices. these are float32 if the features are (see
+    feature_gen) otherwise float64.
+    """
+    dtype = _dtype(features)
+    if not (features and isinstance(features[0], SparseFeature)):
+        values = np.array([f.values for f in features], dtype=dtype)
+        weights = None
+        if features and features[0].weights is not None:
+            weights = np.array([f.weights for f in features], dtype=dtype)
+        return values, weights
+    rows = SparseRows.from_features(features, dtype)
+    return rows.dense(), (None if rows.wdata is None
+                          else rows.dense(weights=True))
+
+def batches(cluster_gen, n):
+    """
+    group the clusters (lists of ClusterFeatures) from `cluster_gen` into
+    ClusterBatches of `n` clusters so that the features can be freed.
+    """
+    from .instrument import get_profiler
+    prof = get_profiler()
+    clusters = []
+    for c in cluster_gen:
+        clusters.append(c)
+        if len(clusters) == n:
+            with prof.stage('to_dataframe'):
+                batch = ClusterBatch.from_clusters(clusters)
+            clusters = []
+            yield batch
+    if clusters:
+        with prof.stage('to_dataframe'):
+            batch = ClusterBatch.from_clusters(clusters)
+        yield batch
+
 def feature_gen(fname, row_handler=row_handler, feature_class=ClusterFeature, sep="\t",
-        rho_min=0.3, skip_first_row=True, weights=None):
+        rho_min=0.3, skip_first_row=True, weights=None, sparse=False,
+        dtype=np.float64):
     """
 
     Parameters
@@ -72,18 +383,65 @@ def feature_gen(fname, row_handler=row_handler, feature_class=ClusterFeature, se
     rho_min: float
         the minimum spearman's r between 2 sets of values for them to be
         considered as correlated
+
+    sparse: bool
+        yield `SparseFeature`s that keep only the samples with a value (and
+        with weight > 0 if `weights` is given). row_handler and
+        feature_class are not used.
+
+    dtype: numpy dtype
+        the values and weights of each feature are kept as this. np.float32
+        halves the memory of the features and of the batches made from them
+        (the model fits use float64).
     """
+    if sparse:
+        for f in sparse_feature_gen(fname, sep, rho_min, skip_first_row,
+                                    weights, dtype):
+            yield f
+        return
     if weights is not None:
-        weights = reader(weights, header=False, sep=sep)
-    for i, toks in enumerate(reader(fname, header=False, sep=sep)):
+        weights = reader(open_input(weights), header=False, sep=sep)
+    check = SortCheck(fname)
+    for i, toks in enumerate(reader(open_input(fname), header=False, sep=sep)):
         if i == 0 and skip_first_row:
             if weights is not None: next(weights)
             continue
         vals = row_handler(toks)
+        check(i + 1, vals[0], vals[1])
+        if dtype != np.float64:
+            vals = tuple(vals[:3]) + (np.asarray(vals[3], dtype=dtype),)
         if weights is not None:
             chrom, start, end, weight_vals = row_handler(next(weights))
             assert chrom == vals[0]
             assert start == vals[1], (vals[1], start)
+            if dtype != np.float64:
+                weight_vals = np.asarray(weight_vals, dtype=dtype)
         else:
             weight_vals = None
         yield feature_class(*vals, **{'rho_min': rho_min, 'weights':weight_vals} )
+
+
+def sparse_feature_gen(fname, sep="\t", rho_min=0.3, skip_first_row=True,
+                       weights=None, dtype=np.float64):
+    "see feature_gen(..., sparse=True)"
+    if weights is not None:
+        weights = reader(open_input(weights), header=False, sep=sep)
+    check = SortCheck(fname)
+    for i, toks in enumerate(reader(open_input(fname), header=False, sep=sep)):
+        if i == 0 and skip_first_row:
+            if weights is not None: next(weights)
+            continue
+        chrom, start, end, idx, data = sparse_row_handler(toks)
+        check(i + 1, chrom, start)
+        wdata = None
+        if weights is not None:
+            wtoks = next(weights)
+            wchrom, wstart, _, _ = row_handler(wtoks[:1])
+            assert wchrom == chrom
+            assert wstart == start, (start, wstart)
+            wdata = np.array([float(wtoks[j + 1] or 'nan') for j in idx])
+            ok = wdata > 0
+            idx, data, wdata = idx[ok], data[ok], wdata[ok].astype(dtype)
+        yield SparseFeature(chrom, start, end, idx, data.astype(dtype),
+                            len(toks) - 1,
+                            rho_min=rho_min, weights=wdata)
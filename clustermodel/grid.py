@@ -0,0 +1,186 @@
+"""
+run a grid of clustermodel methods on a local machine:
+
+    python -m clustermodel grid --cpus 24 spec.json
+
+spec.json has the data and the grid of methods * outlier-sds * real and
+shuffled X, e.g.:
+
+    {"model": "methylation ~ 1",
+     "data": [{"covs": "covs.txt", "meth": "meth.txt", "out": "results/"}],
+     "X": "expr.txt", "X_locs": "expr-locs.bed", "X_dist": 50000,
+     "outlier_sds": [0, 3], "cores": 4, "X_permute_seeds": [42],
+     "methods": {"both_intercept": {"model": "+ (1|CpG) + (1|id)"},
+                 "gee-ar-id": {"args": "--gee-args ar,id"},
+                 "combine-liptak": {"args": "--combine liptak"},
+                 "bumping": {"args": "--bumping", "outlier_sds": [30]}}}
+
+Each run writes {out}/{real,shuffled}/{method}-sds_{sds}.{group}.pvals.bed
+(just {out}/... without X) where group is the name of the covariates file.
+The shuffled runs use the same X with --X-permute-seed for each of
+"X_permute_seeds" (default [42]) so no shuffled copy of X is written.
+Runs are started as subprocesses while the sum of their cores (the R
+mc.cores of each, "cores" in the spec or a method, sent as
+CLUSTERMODEL_CPUS) fits in --cpus. Runs whose output exists are skipped so
+an interrupted grid can be resumed. The runs, their status and timings are
+written to --manifest (default: manifest.json in the first output
+directory) after each run finishes.
+
+--data covs meth out (repeated) replaces the data in the spec, e.g. for
+each point of a simulate grid.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import pipes
+import subprocess
+import os.path as op
+from collections import OrderedDict
+
+SUFFIX = ".pvals.bed"
+
+def _listify(v):
+    return v if isinstance(v, list) else [v]
+
+def runs(spec):
+    """
+    a list of runs (dicts with name, X, group, cmd, out and cores) for the
+    grid in `spec`.
+    """
+    model = spec.get("model", "methylation ~ 1")
+    sds = _listify(spec.get("outlier_sds", [30]))
+    cores = spec.get("cores", 1)
+    extra = shlex.split(spec.get("args", ""))
+    res = []
+    for data in spec["data"]:
+        group = op.splitext(op.basename(data["covs"]))[0]
+        if spec.get("X"):
+            kinds = spec.get("X_kinds", ["real", "shuffled"])
+        else:
+            kinds = [None]
+        for kind in kinds:
+            out = op.join(data["out"], kind or "")
+            xargs = []
+            if kind is not None:
+                xargs = ["--X", spec["X"]]
+                if kind == "shuffled":
+                    seeds = _listify(spec.get("X_permute_seeds", [42]))
+                    xargs += ["--X-permute-seed"] + map(str, seeds)
+                if spec.get("X_locs"):
+                    xargs += ["--X-locs", spec["X_locs"]]
+                if spec.get("X_dist"):
+                    xargs += ["--X-dist", str(spec["X_dist"])]
+            for method, m in sorted(spec["methods"].items()):
+                mmodel = model + " " + m["model"] if "model" in m else model
+                for sd in _listify(m.get("outlier_sds", sds)):
+                    name = "%s-sds_%s" % (method, sd)
+                    fout = op.join(out, "%s.%s%s" % (name, group,
+                                                     spec.get("suffix", SUFFIX)))
+                    cmd = ([sys.executable, "-m", "clustermodel", mmodel,
+                            data["covs"], data["meth"]]
+                           + shlex.split(m.get("args", "")) + extra
+                           + ["--outlier-sds", str(sd)] + xargs)
+                    res.append(OrderedDict([
+                        ("name", name), ("X", kind), ("group", group),
+                        ("out", fout), ("cores", m.get("cores", cores)),
+                        ("cmd", cmd)]))
+    return res
+
+def _partial(fout):
+    "the name a run writes to; it is renamed to `fout` when it succeeds"
+    return op.join(op.dirname(fout), ".partial." + op.basename(fout))
+
+def _start(run, cores):
+    d = op.dirname(run["out"])
+    logs = op.join(d or ".", "logs")
+    if not op.exists(logs):
+        os.makedirs(logs)
+    run["log"] = op.join(logs, op.basename(run["out"]) + ".err")
+    env = dict(os.environ, CLUSTERMODEL_CPUS=str(cores))
+    run["start"] = time.time()
+    return subprocess.Popen(run["cmd"] + ["--out", _partial(run["out"])],
+                            stdout=open(os.devnull, "w"),
+                            stderr=open(run["log"], "w"), env=env)
+
+def _write_manifest(path, runs, cpus):
+    d = op.dirname(path)
+    if d and not op.exists(d):
+        os.makedirs(d)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(dict(cpus=cpus, runs=runs), fh, indent=1)
+    os.rename(path + ".tmp", path)
+
+def run_grid(runs, cpus, manifest, force=False, poll=0.2, out=sys.stderr):
+    """
+    run each of `runs` (from `runs()`) with at most `cpus` cores in use.
+    returns the runs with their status ('done', 'skipped' or 'failed'),
+    returncode and seconds.
+    """
+    todo = []
+    for run in runs:
+        if not force and op.exists(run["out"]):
+            run["status"] = "skipped"
+        else:
+            run["status"] = "waiting"
+            todo.append(run)
+    _write_manifest(manifest, runs, cpus)
+    # biggest first so the large runs are not left for the end.
+    todo.sort(key=lambda r: -r["cores"])
+    running, used = [], 0
+    while todo or running:
+        for run in list(todo):
+            cores = min(run["cores"], cpus)
+            if used + cores <= cpus:
+                todo.remove(run)
+                run["status"] = "running"
+                running.append((run, _start(run, cores), cores))
+                used += cores
+        time.sleep(poll)
+        for item in list(running):
+            run, proc, cores = item
+            if proc.poll() is None: continue
+            running.remove(item)
+            used -= cores
+            run["seconds"] = round(time.time() - run["start"], 3)
+            run["returncode"] = proc.returncode
+            if proc.returncode == 0:
+                os.rename(_partial(run["out"]), run["out"])
+                run["status"] = "done"
+            else:
+                run["status"] = "failed"
+            out.write("%s %s (%.1fs): %s\n" % (run["status"], run["name"],
+                                                run["seconds"], run["out"]))
+            _write_manifest(manifest, runs, cpus)
+    return runs
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    from multiprocessing import cpu_count
+    p = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--cpus", type=int, default=int(os.environ.get(
+                   "CLUSTERMODEL_CPUS", 0)) or cpu_count(),
+                   help="cores to use for all runs (default: %(default)s)")
+    p.add_argument("--data", nargs=3, action="append",
+                   metavar=("COVS", "METH", "OUT"),
+                   help="data to run the grid on. replaces the spec's data")
+    p.add_argument("--manifest", help="default: OUT/manifest.json")
+    p.add_argument("--force", action="store_true",
+                   help="re-run even if the output exists")
+    p.add_argument("--dry-run", action="store_true",
+                   help="print the commands that would be run")
+    p.add_argument("spec", help="JSON grid specification")
+    a = p.parse_args(argv)
+    spec = json.load(open(a.spec))
+    if a.data:
+        spec["data"] = [dict(covs=c, meth=m, out=o) for c, m, o in a.data]
+    grid = runs(spec)
+    if a.dry_run:
+        for run in grid:
+            print " ".join(map(pipes.quote, run["cmd"] + ["--out", run["out"]]))
+        return
+    manifest = a.manifest or op.join(spec["data"][0]["out"], "manifest.json")
+    grid = run_grid(grid, a.cpus, manifest, a.force)
+    return int(any(r["status"] == "failed" for r in grid))
@@ -0,0 +1,206 @@
+"""
+record where the time goes in a run: cumulative (exclusive) time and calls
+for each stage, counters such as bytes sent to and read from R and
+histograms of per-cluster fit latency by method and n_probes.
+
+From python:
+
+    from clustermodel import instrument
+    prof = instrument.enable(progress=10)
+    for res in clustermodel(...): ...
+    print(prof.report())
+
+From the command-line, use --profile report.json and --progress.
+Everything is a no-op unless enabled.
+
+`TraceWriter` writes the per-cluster timings from --timing as trace events
+that can be opened in chrome://tracing or https://ui.perfetto.dev
+"""
+import sys
+import time
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
+# upper edges (in seconds) of the fit-latency histogram bins.
+LATENCY_BINS = (0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100)
+
+class Profiler(object):
+    """
+    stage times are exclusive: while a nested stage runs (e.g. parsing
+    inside clustering) its time is not charged to the outer stage.
+    """
+
+    def __init__(self, enabled=False, progress=None, total=None,
+                 out=sys.stderr):
+        self.enabled = enabled
+        # seconds between progress lines; None for no progress.
+        self.progress = progress
+        # total number of clusters, if known, to report an ETA.
+        self.total = total
+        self.out = out
+        self.start = time.time()
+        self.stages = defaultdict(lambda: [0.0, 0])
+        self.counters = defaultdict(int)
+        self.fits = defaultdict(lambda: [0] * (len(LATENCY_BINS) + 1))
+        self.fit_seconds = defaultdict(float)
+        self._stack = []
+        self._last_progress = self.start
+
+    def _push(self, name):
+        now = time.time()
+        if self._stack:
+            parent, t0 = self._stack[-1]
+            self.stages[parent][0] += now - t0
+        self._stack.append((name, now))
+
+    def _pop(self):
+        now = time.time()
+        name, t0 = self._stack.pop()
+        self.stages[name][0] += now - t0
+        self.stages[name][1] += 1
+        if self._stack:
+            self._stack[-1] = (self._stack[-1][0], now)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._push(name)
+        try:
+            yield
+        finally:
+            self._pop()
+
+    def timed(self, name, iterable):
+        """
+        wrap an iterable (e.g. feature_gen) so the time spent generating
+        each item is charged to `name`.
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed(name, iter(iterable))
+
+    def _timed(self, name, it):
+        while True:
+            self._push(name)
+            try:
+                item = next(it)
+            except StopIteration:
+                self._pop()
+                return
+            except:
+                self._pop()
+                raise
+            self._pop()
+            yield item
+
+    def add(self, counter, n=1):
+        if not self.enabled: return
+        self.counters[counter] += n
+        if counter == 'clusters' and self.progress is not None:
+            now = time.time()
+            if now - self._last_progress >= self.progress:
+                self._last_progress = now
+                self.out.write(self.progress_line(now) + "\n")
+
+    def fit(self, method, n_probes, seconds):
+        "record the latency of fitting a single cluster"
+        if not self.enabled: return
+        key = (method, n_probes)
+        i = sum(seconds > b for b in LATENCY_BINS)
+        self.fits[key][i] += 1
+        self.fit_seconds[key] += seconds
+
+    def progress_line(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        n = self.counters.get('clusters', 0)
+        rate = n / elapsed if elapsed > 0 else 0
+        line = "clusters: %i elapsed: %.1fs clusters/sec: %.2f" % (n, elapsed,
+                                                                  rate)
+        if self.total and rate > 0:
+            line += " ETA: %.1fs" % (max(0, self.total - n) / rate)
+        return line
+
+    def report(self):
+        elapsed = time.time() - self.start
+        fits = defaultdict(dict)
+        for (method, n_probes), counts in sorted(self.fits.items()):
+            fits[method][str(n_probes)] = dict(
+                    n=sum(counts),
+                    mean_seconds=self.fit_seconds[(method, n_probes)] / max(1, sum(counts)),
+                    bins=list(LATENCY_BINS) + ['inf'],
+                    counts=counts)
+        n = self.counters.get('clusters', 0)
+        return dict(
+            wall_seconds=elapsed,
+            clusters_per_second=n / elapsed if elapsed > 0 else 0,
+            stages=dict((k, dict(seconds=v[0], calls=v[1]))
+                        for k, v in self.stages.items()),
+            counters=dict(self.counters),
+            fit_latency=fits)
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            json.dump(self.report(), fh, indent=2, sort_keys=True)
+
+
+PROFILER = Profiler(enabled=False)
+
+def get_profiler():
+    return PROFILER
+
+def enable(progress=None, total=None):
+    """
+    start recording to a new profiler and return it.
+    """
+    global PROFILER
+    PROFILER = Profiler(enabled=True, progress=progress, total=total)
+    return PROFILER
+
+def disable():
+    global PROFILER
+    PROFILER = Profiler(enabled=False)
+
+
+class TraceWriter(object):
+    """
+    write per-cluster R timings (the r_start, r_wall, r_cpu and r_pid
+    columns added with timing=True) in the trace-event format: a JSON
+    array of complete ("X") events with times in microseconds. Each R
+    worker process is shown as a separate thread.
+    """
+
+    def __init__(self, path):
+        self.fh = open(path, "w")
+        self.fh.write("[")
+        self.n_events = 0
+        self.event(name="process_name", ph="M", pid=0, tid=0,
+                   args=dict(name="R"))
+
+    def event(self, **kwargs):
+        self.fh.write((",\n" if self.n_events else "\n") + json.dumps(kwargs))
+        self.n_events += 1
+
+    def add_clusters(self, res):
+        """
+        add an event for each cluster in `res`. with X, there are many rows
+        for each cluster; only the first is used.
+        """
+        if len(res) == 0: return
+        res = res.drop_duplicates(['chrom', 'start', 'end'])
+        methods = res['method'] if 'method' in res.columns else ['fit'] * len(res)
+        for (chrom, start, end, method, pid, r_start, r_wall, r_cpu, n_probes,
+                p) in zip(res['chrom'], res['start'], res['end'], methods,
+                          res['r_pid'], res['r_start'], res['r_wall'],
+                          res['r_cpu'], res['n_probes'], res['p']):
+            self.event(name="%s:%i-%i" % (chrom, start, end), cat=str(method),
+                       ph="X", pid=0, tid=int(pid), ts=r_start * 1e6,
+                       dur=r_wall * 1e6, args=dict(n_probes=int(n_probes),
+                                                   p=float(p),
+                                                   r_cpu=float(r_cpu)))
+
+    def close(self):
+        self.fh.write("\n]\n")
+        self.fh.close()
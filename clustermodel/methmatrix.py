@@ -0,0 +1,271 @@
+"""
+make the methylation, counts and methylated matrices from Bismark or
+bwa-meth style (tabulated) methylation files, one per sample:
+
+    python -m clustermodel meth-matrix --prefix data/ sample*.methylation.txt
+
+writes data/methylation.txt.gz, data/counts.txt.gz and data/methylated.txt.gz
+with a row for each site covered in at least --min-samples samples.
+
+This is done in 2 passes in --procs processes. First, the calls of each
+sample are read in chunks and saved as arrays of position, methylated and
+total reads for each chromosome. Then each window of --window bases is
+done separately: the positions of all samples in the window are merged with
+np.unique and each sample's calls are put in place with searchsorted. The
+3 matrices of each window are written (gzipped) by the process that made
+them and the pieces are concatenated in order at the end.
+
+With --store, the matrices are also saved as numpy arrays in that directory
+so they can be memory-mapped. See `read_store`.
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import shutil
+import tempfile
+import itertools
+import os.path as op
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from toolshed import nopen
+
+NAMES = ('methylation', 'counts', 'methylated')
+
+# rows of input read at once.
+CHUNKSIZE = 500000
+COMPRESSLEVEL = 6
+
+def sample_name(fname, name_re):
+    try:
+        return name_re.search(fname).groups(0)[0]
+    except AttributeError:
+        return op.basename(fname)
+
+def has_header(fname):
+    toks = nopen(fname).readline().rstrip("\r\n").split("\t")
+    return not (toks[1] + toks[2]).isdigit()
+
+def read_calls(fname, chunksize=CHUNKSIZE):
+    """
+    read the calls in `fname` in chunks. returns a dict of chrom => int32
+    array of (position, methylated, total reads) sorted by position.
+    """
+    chunks = pd.read_csv(fname, sep="\t", header=None, usecols=[0, 1, 4, 5],
+                         skiprows=int(has_header(fname)), dtype={0: str},
+                         chunksize=chunksize, compression='infer')
+    calls = defaultdict(list)
+    for df in chunks:
+        arr = np.empty((len(df), 3), dtype=np.int32)
+        arr[:, 0] = df[1].values
+        arr[:, 1] = df[4].values
+        arr[:, 2] = df[4].values + df[5].values
+        for chrom, idx in df.groupby(0).indices.items():
+            calls[chrom].append(arr[idx])
+    res = {}
+    for chrom, arrs in calls.items():
+        a = np.concatenate(arrs)
+        if (np.diff(a[:, 0]) < 0).any():
+            a = a[np.argsort(a[:, 0], kind='mergesort')]
+        res[chrom] = a
+    return res
+
+def _split_sample(args):
+    """
+    save the calls of 1 sample for each chromosome as a contiguous array of
+    positions (prefix.pos.npy) and one of methylated and total reads
+    (prefix.reads.npy).
+    """
+    i, fname, tmp = args
+    out = {}
+    for chrom, a in read_calls(fname).items():
+        prefix = op.join(tmp, "%i.%i" % (i, len(out)))
+        np.save(prefix + ".pos.npy", np.ascontiguousarray(a[:, 0]))
+        np.save(prefix + ".reads.npy", a[:, 1:])
+        out[chrom] = (prefix, int(a[-1, 0]))
+    return out
+
+def load_calls(prefix):
+    "the (positions, reads) saved by _split_sample, memory-mapped"
+    return (np.load(prefix + ".pos.npy", mmap_mode='r'),
+            np.load(prefix + ".reads.npy", mmap_mode='r'))
+
+def merge_window(calls, start, end):
+    """
+    `calls` is a list (1 per sample) of (positions, reads) with reads the
+    (methylated, total) of each position, or None. returns the positions in
+    [start, end) covered in any sample and the methylated and total reads
+    of each as positions * samples.
+    """
+    parts = []
+    for c in calls:
+        if c is None:
+            parts.append((np.empty(0, dtype=np.int32),
+                          np.empty((0, 2), dtype=np.int32)))
+            continue
+        positions, reads = c
+        # keys of the same type so numpy doesn't copy (and cast) positions.
+        s, e = np.searchsorted(positions, np.array([start, end],
+                                                   dtype=positions.dtype))
+        parts.append((positions[s:e], reads[s:e]))
+    pos = np.unique(np.concatenate([p for p, _ in parts]))
+    meth = np.zeros((len(pos), len(calls)), dtype=np.int32)
+    total = np.zeros_like(meth)
+    for j, (p, reads) in enumerate(parts):
+        idx = np.searchsorted(pos, p)
+        meth[idx, j] = reads[:, 0]
+        total[idx, j] = reads[:, 1]
+    return pos, meth, total
+
+def format_rows(index, values, fmt):
+    """
+    tab-delimited lines of `index` and `values` formatted with `fmt` ('' for
+    NaN). The values of a window repeat a lot (read counts and their ratios)
+    so each distinct value is formatted once.
+    >>> format_rows(['a', 'b'], np.array([[0.5, np.nan], [1, 0.5]]), '%.3f')
+    'a\\t0.500\\t\\nb\\t1.000\\t0.500\\n'
+    """
+    missing = np.isnan(values) if values.dtype.kind == 'f' else None
+    if missing is not None:
+        values = np.where(missing, 0, values)
+    u, inv = np.unique(values, return_inverse=True)
+    labels = np.array([fmt % v for v in u] + [''], dtype=object)
+    if missing is not None:
+        inv[missing.ravel()] = len(u)
+    strs = labels[inv].reshape(values.shape)
+    return "".join("%s\t%s\n" % (i, "\t".join(r))
+                   for i, r in zip(index, strs.tolist()))
+
+def _write_part(path, chrom, pos, values, fmt):
+    index = ["%s:%i" % (chrom, p) for p in pos]
+    # compress in 1 call. level 9 is very slow on the long runs of tabs for
+    # missing sites.
+    fh = gzip.open(path, 'wb', COMPRESSLEVEL)
+    fh.write(format_rows(index, values, fmt))
+    fh.close()
+
+def _do_window(args):
+    """
+    merge the calls of all samples in 1 window of 1 chromosome, filter
+    by `min_samples` and write the matrices to gzipped parts.
+    """
+    k, chrom, start, end, paths, min_samples, tmp, store = args
+    calls = [load_calls(p) if p else None for p in paths]
+    pos, meth, total = merge_window(calls, start, end)
+    keep = (total > 0).sum(axis=1) >= min_samples
+    pos, meth, total = pos[keep], meth[keep], total[keep]
+    if len(pos) == 0:
+        return k, 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(total > 0, meth / total.astype(float), np.nan)
+
+    for name, m, fmt in zip(NAMES, (ratio, total, meth), ('%.3f', '%i', '%i')):
+        _write_part(op.join(tmp, "%i.%s.gz" % (k, name)), chrom, pos, m, fmt)
+    if store is not None:
+        np.save(op.join(store, "%05i.pos.npy" % k), pos)
+        for name, m in zip(NAMES, (ratio.astype(np.float32), total, meth)):
+            np.save(op.join(store, "%05i.%s.npy" % (k, name)), m)
+    return k, len(pos)
+
+def windows(chroms, window):
+    "(chrom, start, end) of each window in order for {chrom: max position}"
+    for chrom in sorted(chroms):
+        for start in range(0, chroms[chrom] + 1, window):
+            yield chrom, start, start + window
+
+def read_store(path, name='methylation', mmap_mode='r'):
+    """
+    yield (chrom, positions, matrix) for each block of the `name` matrix
+    ('methylation', 'counts' or 'methylated') in a --store directory. The
+    matrices are sites * samples; the samples are in
+    json.load(open(path + '/index.json'))['samples'].
+    """
+    index = json.load(open(op.join(path, "index.json")))
+    for block in index['blocks']:
+        pre = op.join(path, block['file'])
+        yield (block['chrom'], np.load(pre + ".pos.npy", mmap_mode=mmap_mode),
+               np.load("%s.%s.npy" % (pre, name), mmap_mode=mmap_mode))
+
+def meth_matrix(fnames, prefix, name_re=r".+/(.+?).methylation.txt$",
+                min_samples=2, procs=1, window=2000000, store=None):
+    """
+    write the 3 matrices for the methylation files in `fnames` and return
+    the number of sites written.
+    """
+    name_re = re.compile(name_re)
+    samples = [sample_name(f, name_re) for f in fnames]
+    if not prefix.endswith((".", "/")): prefix += "."
+    d = op.dirname(prefix)
+    if d and not op.exists(d):
+        os.makedirs(d)
+    if store is not None and not op.exists(store):
+        os.makedirs(store)
+
+    tmp = tempfile.mkdtemp(dir=d or ".", suffix=".meth-matrix")
+    pool = multiprocessing.Pool(procs) if procs > 1 else None
+    imap = pool.imap if pool is not None else itertools.imap
+    try:
+        split = list(imap(_split_sample, [(i, f, tmp) for i, f in
+                                          enumerate(fnames)]))
+        chroms = {}
+        for s in split:
+            for chrom, (_, end) in s.items():
+                chroms[chrom] = max(chroms.get(chrom, 0), end)
+
+        tasks = [(k, chrom, start, end,
+                  [s[chrom][0] if chrom in s else None for s in split],
+                  min_samples, tmp, store)
+                 for k, (chrom, start, end) in enumerate(windows(chroms, window))]
+        n_sites = dict(imap(_do_window, tasks))
+
+        header = "probe\t%s\n" % "\t".join(samples)
+        for name in NAMES:
+            fname = "%s%s.txt.gz" % (prefix, name)
+            fh = gzip.open(fname, 'wb')
+            fh.write(header)
+            fh.close()
+            # gzip members can be concatenated.
+            with open(fname, 'ab') as out:
+                for t in tasks:
+                    if n_sites[t[0]] == 0: continue
+                    with open(op.join(tmp, "%i.%s.gz" % (t[0], name)), 'rb') as fh:
+                        shutil.copyfileobj(fh, out)
+        if store is not None:
+            blocks = [dict(chrom=t[1], file="%05i" % t[0], n=n_sites[t[0]])
+                      for t in tasks if n_sites[t[0]]]
+            with open(op.join(store, "index.json"), "w") as fh:
+                json.dump(dict(samples=samples, blocks=blocks), fh)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(tmp)
+    return sum(n_sites.values())
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    from . import CPUS
+    p = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--prefix", required=True, help="output prefix")
+    p.add_argument("--name-re", default=r".+/(.+?).methylation.txt$",
+                   help="regexp to convert file name to sample name")
+    p.add_argument("--min-samples", type=int, default=2,
+                   help="skip sites where fewer files than this have coverage")
+    p.add_argument("--procs", type=int, default=CPUS,
+                   help="number of processes (default: %(default)s)")
+    p.add_argument("--window", type=int, default=2000000,
+                   help="bases of each chromosome done at once (default: "
+                   "%(default)s)")
+    p.add_argument("--store", metavar="DIR",
+                   help="also save the matrices as numpy arrays in DIR")
+    p.add_argument("methylation_files", nargs="+")
+    a = p.parse_args(argv)
+    n = meth_matrix(a.methylation_files, a.prefix, a.name_re, a.min_samples,
+                    a.procs, a.window, a.store)
+    sys.stderr.write("wrote %i sites for %i samples\n"
+                     % (n, len(a.methylation_files)))
@@ -0,0 +1,231 @@
+"""
+write batches of results (pandas.DataFrames) to disk all at once rather than
+formatting each row as a dict.
+
+    BedWriter - tab-delimited text in the original column order
+    BgzfBedWriter - same text, block-compressed (bgzip) on a background thread
+    IndexedBedWriter - BgzfBedWriter that also writes a tabix (.tbi) index
+    NpzWriter - binary columnar output; one array per chunk and column in
+                an .npz
+"""
+import sys
+import zipfile
+from cStringIO import StringIO
+import numpy as np
+import pandas as pd
+
+from .bgzf import BgzfWriter, MAX_BLOCK_SIZE
+from .tabix import TabixIndex
+
+BASE_COLUMNS = "chrom start end coef p icoef n_probes model covariate method"
+X_COLUMNS = "Xname Xstart Xend Xstrand distance"
+TIMING_COLUMNS = "r_start r_wall r_cpu r_pid"
+
+# str(float) in python2 gives 12 significant digits. match that so values
+# are the same as when each row was sent through str.format
+FLOAT_FORMAT = "%.12g"
+
+def result_columns(betareg=False, X_locs=False, timing=False, X_permute=False):
+    """
+    the columns (in order) of the output.
+    >>> result_columns()[:4]
+    ['chrom', 'start', 'end', 'coef']
+    >>> 'icoef' in result_columns(betareg=True)
+    False
+    >>> result_columns(X_locs=True)[-1]
+    'distance'
+    >>> result_columns(timing=True)[-1]
+    'r_pid'
+    >>> result_columns(X_permute=True)[-1]
+    'X_permute_seed'
+    """
+    cols = BASE_COLUMNS.split()
+    if betareg:
+        cols.remove('icoef')
+    if X_locs:
+        cols.extend(X_COLUMNS.split())
+    if timing:
+        cols.extend(TIMING_COLUMNS.split())
+    if X_permute:
+        cols.append('X_permute_seed')
+    return cols
+
+def header_line(columns):
+    return "#" + "\t".join(columns) + "\n"
+
+
+class BedWriter(object):
+    """
+    write result DataFrames to `fh` as tab-delimited text
+    """
+    def __init__(self, fh, columns):
+        if fh is None or fh == "-":
+            fh = sys.stdout
+        elif isinstance(fh, basestring):
+            fh = open(fh, "w")
+        self.fh = fh
+        self.columns = list(columns)
+        self.n_written = 0
+        self._write(header_line(self.columns))
+
+    def _write(self, text):
+        self.fh.write(text)
+
+    def format(self, df):
+        "format all rows of `df` to a single string"
+        s = StringIO()
+        df.to_csv(s, sep="\t", header=False, index=False,
+                  columns=self.columns, float_format=FLOAT_FORMAT,
+                  na_rep="nan")
+        return s.getvalue()
+
+    def write(self, df):
+        if len(df) == 0: return
+        self._write(self.format(df))
+        self.n_written += len(df)
+
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BgzfBedWriter(BedWriter):
+    """
+    write result DataFrames as bgzip-compatible text. Compression and
+    writing happen on a background thread.
+    """
+    def __init__(self, fh, columns, level=6):
+        self.bgzf = BgzfWriter(fh, level=level, threaded=True)
+        super(BgzfBedWriter, self).__init__(self.bgzf, columns)
+
+    def close(self):
+        self.bgzf.close()
+
+
+class IndexedBedWriter(BgzfBedWriter):
+    """
+    write block-gzipped output (see `BgzfBedWriter`) and, at close,
+    a tabix index to `fname + ".tbi"`. Rows must be sorted by chrom, start;
+    each chunk is checked and indexed as it is written.
+    """
+
+    def __init__(self, fname, columns, level=6):
+        self.fname = fname
+        # uncompressed offset of the next byte written.
+        self._uoffset = 0
+        # records are indexed by uncompressed offset; these are converted to
+        # virtual offsets when the index is written after the blocks are.
+        self.index = TabixIndex()
+        super(IndexedBedWriter, self).__init__(fname, columns, level=level)
+
+    def _write(self, text):
+        self.bgzf.write(text)
+        self._uoffset += len(text)
+
+    def write(self, df):
+        if len(df) == 0: return
+        text = self.format(df)
+        lens = np.array([len(l) + 1 for l in text[:-1].split("\n")], dtype=np.int64)
+        assert len(lens) == len(df), ("can't index output with newlines in"
+                                      " values")
+        uends = self._uoffset + np.cumsum(lens)
+        ustarts = uends - lens
+        chroms = np.asarray(df['chrom']).astype(str)
+        starts = np.asarray(df['start'], dtype=np.int64)
+        ends = np.asarray(df['end'], dtype=np.int64)
+        add = self.index.add
+        # raises (before the chunk is written) if the rows are out of order.
+        for i in range(len(df)):
+            add(chroms[i], int(starts[i]), int(ends[i]), int(ustarts[i]),
+                int(uends[i]))
+        self._write(text)
+        self.n_written += len(df)
+
+    def close(self):
+        self.bgzf.close()
+        voff = lambda u: self.bgzf.virtual_offset(u // MAX_BLOCK_SIZE,
+                                                  u % MAX_BLOCK_SIZE)
+        self.index.write(self.fname + ".tbi", voffset=voff)
+
+
+class NpzWriter(object):
+    """
+    columnar binary output in an npz archive. each chunk of each column is
+    written to the archive as a numpy array when it arrives (strings as
+    fixed-width) so no chunks are kept in memory. Read back with `read_npz`.
+    """
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.n_written = 0
+        self.n_chunks = 0
+        # uncompressed, as from np.savez.
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED,
+                                   allowZip64=True)
+
+    def _save(self, name, a):
+        s = StringIO()
+        np.lib.format.write_array(s, np.asanyarray(a))
+        self.zip.writestr(name + ".npy", s.getvalue())
+
+    def write(self, df):
+        if len(df) == 0: return
+        for c in self.columns:
+            a = np.asarray(df[c])
+            if a.dtype == object:
+                a = a.astype(str)
+            self._save("%s.%i" % (c, self.n_chunks), a)
+        self.n_chunks += 1
+        self.n_written += len(df)
+
+    def close(self):
+        if self.zip is None: return
+        self._save("__columns__", np.array(self.columns))
+        self._save("__chunks__", np.array(self.n_chunks))
+        self.zip.close()
+        self.zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_npz(path):
+    """
+    read the output of `NpzWriter` into a DataFrame
+    """
+    d = np.load(path)
+    columns = list(d['__columns__'])
+    n = int(d['__chunks__'])
+    cols = dict((c, np.concatenate([d["%s.%i" % (c, i)] for i in range(n)])
+                    if n else np.array([])) for c in columns)
+    return pd.DataFrame(cols)[columns]
+
+
+def open_writer(path, columns, index=False):
+    """
+    choose a writer based on the extension of `path`:
+        None or '-' => text to stdout
+        .gz or .bgz => BgzfBedWriter (IndexedBedWriter if `index` is True)
+        .npz => NpzWriter
+        other => BedWriter
+    """
+    if index and not (path or "").endswith((".gz", ".bgz")):
+        raise ValueError("can only index block-gzipped output (.gz or .bgz)")
+    if path is None or path == "-":
+        return BedWriter(sys.stdout, columns)
+    if path.endswith((".gz", ".bgz")):
+        return (IndexedBedWriter if index else BgzfBedWriter)(path, columns)
+    if path.endswith(".npz"):
+        return NpzWriter(path, columns)
+    return BedWriter(path, columns)
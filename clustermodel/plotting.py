@@ -1,4 +1,7 @@
 # from: http://nbviewer.ipython.org/urls/raw.github.com/EnricoGiampieri/dataplot/master/statplot.ipynb
+import os.path as op
+from glob import glob
+import multiprocessing
 import matplotlib
 matplotlib.use('Agg')
 import numpy as np
@@ -52,9 +55,9 @@ def hbar_plot(data1, classes=None, data2=None, chrom='', **kwargs):
         except TypeError:
             d1, d2 = data1[pos], data2[pos]
         shape1 = half_horizontal_bar(d1, pos, True, facecolor=COLORS[0], dmin=dmin,
-                dmax=dmax)
+                dmax=dmax, ax=ax)
         shape2 = half_horizontal_bar(d2, pos, False, facecolor=COLORS[3], dmin=dmin,
-                dmax=dmax)
+                dmax=dmax, ax=ax)
 
     #ax.set_ylim(dmin, dmax)
     ax.set_xticks(positions)
@@ -69,12 +72,12 @@ def hbar_plot(data1, classes=None, data2=None, chrom='', **kwargs):
             rotation=15 if len(classes) > 8 else 0)
     return shape1, shape2
 
-def plot_hbar(covs, cluster_df, covariate, chrom, res, png):
+def plot_hbar(covs, cluster_df, covariate, chrom, res, png, ax=None):
     from matplotlib import pyplot as plt
     group = getattr(covs, covariate)
     grps = sorted(list(set(group)))
 
-    ax = plt.gca()
+    ax = ax or plt.gca()
     cdf = cluster_df.T
     #cdf = 1 / (1 + np.exp(-cdf))
 
@@ -88,11 +91,20 @@ def plot_hbar(covs, cluster_df, covariate, chrom, res, png):
               "%s - %s" % (covariate, grps[1])),
               loc='upper left')
 
-def plot_continuous(covs, cluster_df, covariate, chrom, res, png):
+def plot_continuous(covs, cluster_df, covariate, chrom, res, png, ax=None):
     from matplotlib import pyplot as plt
+    cdf = cluster_df.T
+    if ax is not None:
+        # all probes on a single axis.
+        for c in cdf.columns:
+            ax.plot(cdf[c], getattr(covs, covariate), marker='o', ls='none',
+                    label="%s:%s" % (chrom, "{:,}".format(c)))
+        ax.set_ylabel(covariate)
+        ax.set_xlabel('methylation')
+        ax.legend(loc='upper left', fontsize='small')
+        return ax.figure
 
     fig, axes = plt.subplots(ncols=cluster_df.shape[0])
-    cdf = cluster_df.T
     #cdf.columns = ['%s:%s' % (chrom, "{:,}".format(p)) for p in cdf.columns]
 
     for i, c in enumerate(cdf.columns):
@@ -105,7 +117,8 @@ def plot_continuous(covs, cluster_df, covariate, chrom, res, png):
     return fig
 
 
-def plot_dmr(covs, cluster_df, covariate, chrom, res, png, weights_df=None):
+def plot_dmr(covs, cluster_df, covariate, chrom, res, png, weights_df=None,
+             ax=None):
     from matplotlib import pyplot as plt
     from pandas.tools.plotting import parallel_coordinates
     colors = ('#e41a1c', '#377eb8', '#4daf4a')
@@ -120,7 +133,7 @@ def plot_dmr(covs, cluster_df, covariate, chrom, res, png, weights_df=None):
     mmin = cdf.min().min()
     cdf['group'] = getattr(covs, covariate)
 
-    ax = plt.gca()
+    ax = ax or plt.gca()
 
     if cdf.group.dtype == float:
         ax = parallel_coordinates(cdf, 'group', ax=ax)
@@ -163,3 +176,261 @@ def plot_dmr(covs, cluster_df, covariate, chrom, res, png, weights_df=None):
     if 0 <= mmin <= mmax <= 1:
         vals = ax.get_ylim()
         ax.set_ylim(max(0, vals[0]), min(1, vals[1]))
+
+
+def is_numeric(pd_series):
+    if np.issubdtype(pd_series.dtype, int) or \
+        np.issubdtype(pd_series.dtype, float):
+        return len(pd_series.unique()) > 2
+    return False
+
+def plot_path(res, png_path):
+    """
+    the file to which the plot for `res` is saved. None means show the plot.
+    """
+    region = "{chrom}_{start}_{end}".format(**res)
+    if png_path.endswith('show'):
+        return None
+    elif png_path.endswith(('.png', '.pdf')):
+        return "%s.%s%s" % (png_path[:-4], region, png_path[-4:])
+    return "%s.%s.png" % (png_path.rstrip("."), region)
+
+def draw_res(ax, res, png_path, covs, covariate, cluster_df, weights_df=None,
+             title=''):
+    "draw the plot for a single region onto `ax`"
+    if is_numeric(getattr(covs, covariate)):
+        plot_continuous(covs, cluster_df, covariate, res['chrom'], res, None,
+                        ax=ax)
+    elif 'spaghetti' in png_path and cluster_df.shape[0] > 1:
+        plot_dmr(covs, cluster_df, covariate, res['chrom'], res, None,
+                weights_df, ax=ax)
+    else:
+        plot_hbar(covs, cluster_df, covariate, res['chrom'], res, None, ax=ax)
+    ax.set_title(title + 'p-value: %.3g %s: %.3f' % (res['p'], covariate,
+                                                     res['coef']))
+
+def plot_res(res, png_path, covs, covariate, cluster_df, weights_df=None,
+             skip_existing=False):
+    from matplotlib import pyplot as plt
+    from mpltools import style
+    style.use('ggplot')
+
+    png = plot_path(res, png_path)
+    if skip_existing and png is not None and op.exists(png):
+        return
+
+    if is_numeric(getattr(covs, covariate)):
+        f = plot_continuous(covs, cluster_df, covariate, res['chrom'], res, png)
+    else:
+        f = plt.figure(figsize=(11, 4))
+        ax = f.add_subplot(1, 1, 1)
+        draw_res(ax, res, png_path, covs, covariate, cluster_df, weights_df)
+    f.set_tight_layout(True)
+    if png:
+        plt.savefig(png)
+    else:
+        plt.show()
+    plt.close()
+
+def book_prefix(png_path):
+    "strip any extension from png_path to get the prefix for PlotBook files"
+    if png_path.endswith(('.png', '.pdf')):
+        return png_path[:-4]
+    return png_path.rstrip(".")
+
+def read_book_index(prefix):
+    """
+    read all index files written by PlotBooks with this prefix into a dict
+    of region => (file, page)
+    """
+    done = {}
+    for f in glob(prefix + "*index.txt"):
+        for line in open(f):
+            region, fname, page = line.rstrip("\r\n").split("\t")
+            done[region] = (fname, int(page))
+    return done
+
+class PlotBook(object):
+    """
+    draw many regions into a few files while re-using a single figure and
+    its axes:
+
+        mode='pdf' - one region per page of multi-page PDFs with `size` pages
+                     per file: prefix.1.pdf, prefix.2.pdf, ...
+        mode='sheet' - `size` regions tiled (in 2 columns) on each PNG:
+                     prefix.1.png, prefix.2.png, ...
+
+    `prefix + '.index.txt'` gets a line of region, file, page for each region
+    (for sheets the page is the tile number). With skip_existing, regions
+    already in any index with this prefix are not drawn again and file
+    numbering continues after the existing files.
+    """
+    def __init__(self, prefix, png_path, covs, covariate, mode='pdf',
+                 size=None, skip_existing=False):
+        from matplotlib import pyplot as plt
+        from mpltools import style
+        style.use('ggplot')
+        assert mode in ('pdf', 'sheet'), mode
+        self.prefix, self.png_path, self.mode = prefix, png_path, mode
+        self.covs, self.covariate = covs, covariate
+        self.size = size or (500 if mode == 'pdf' else 8)
+
+        self.done = {}
+        if skip_existing:
+            self.done = read_book_index(book_prefix(png_path))
+        existing = [f for f, _ in self.done.values() if f.startswith(prefix)]
+        self.n_files = max([int(f.rsplit(".", 2)[-2]) for f in existing] or [0])
+        self.index = open(prefix + ".index.txt", "a" if skip_existing else "w")
+
+        if mode == 'pdf':
+            self.fig = plt.figure(figsize=(11, 4))
+            self.axes = [self.fig.add_subplot(1, 1, 1)]
+        else:
+            nrows = int(np.ceil(self.size / 2.0))
+            self.fig, axes = plt.subplots(nrows=nrows, ncols=2,
+                                          figsize=(22, 4 * nrows), squeeze=False)
+            self.axes = list(axes.flat)
+        self.fig.set_tight_layout(True)
+        self._pdf, self._fname, self._n = None, None, 0
+
+    def skip(self, res):
+        return "{chrom}:{start}-{end}".format(**res) in self.done
+
+    def _next_file(self):
+        self.n_files += 1
+        self._fname = "%s.%i.%s" % (self.prefix, self.n_files,
+                                    "pdf" if self.mode == "pdf" else "png")
+        if self.mode == "pdf":
+            from matplotlib.backends.backend_pdf import PdfPages
+            self._pdf = PdfPages(self._fname)
+        self._n = 0
+
+    def _end_file(self):
+        if self._fname is None: return
+        if self.mode == "pdf":
+            self._pdf.close()
+        else:
+            for ax in self.axes[self._n:]:
+                ax.set_visible(False)
+            self.fig.savefig(self._fname)
+            for ax in self.axes:
+                ax.cla()
+                ax.set_visible(True)
+        self._fname = None
+        self.index.flush()
+
+    def add(self, res, cluster_df, weights_df=None):
+        if self.skip(res): return
+        if self._fname is None:
+            self._next_file()
+        region = "{chrom}:{start}-{end}".format(**res)
+        ax = self.axes[0] if self.mode == "pdf" else self.axes[self._n]
+        ax.cla()
+        draw_res(ax, res, self.png_path, self.covs, self.covariate,
+                 cluster_df, weights_df, title=region + " ")
+        self._n += 1
+        if self.mode == "pdf":
+            self._pdf.savefig(self.fig)
+        self.index.write("%s\t%s\t%i\n" % (region, self._fname, self._n))
+        if self._n == self.size:
+            self._end_file()
+
+    def close(self):
+        from matplotlib import pyplot as plt
+        self._end_file()
+        self.index.close()
+        plt.close(self.fig)
+
+def _plot_worker(queue, png_path, covs, covariate, skip_existing, book=None):
+    if book is not None:
+        book = PlotBook(covs=covs, covariate=covariate, png_path=png_path,
+                        skip_existing=skip_existing, **book)
+    while True:
+        job = queue.get()
+        if job is None: break
+        res, cluster_df, weights_df = job
+        try:
+            if book is not None:
+                book.add(res, cluster_df, weights_df)
+            else:
+                plot_res(res, png_path, covs, covariate, cluster_df, weights_df,
+                         skip_existing=skip_existing)
+        except Exception, e:
+            import sys
+            sys.stderr.write("error plotting %s: %s\n" % (
+                plot_path(res, png_path), e))
+    if book is not None:
+        book.close()
+
+class PlotPool(object):
+    """
+    render plots from `plot_res` in `procs` background processes so the
+    modelling does not wait on matplotlib. Only the row, the cluster (and
+    weights) DataFrames are sent for each plot; the covariate is sent once
+    when the workers start. `submit` blocks when `max_pending` plots are
+    waiting so memory use is bounded.
+
+    With procs=0 (or when png_path is 'show'), plots are drawn inline.
+
+    If `book` is 'pdf' or 'sheet', regions are drawn into a few multi-page
+    PDFs or tiled PNGs (see `PlotBook`) with `book_size` pages or tiles per
+    file. Each worker writes its own files and index.
+    """
+    def __init__(self, png_path, covs, covariate, procs=1, max_pending=None,
+                 skip_existing=False, book=None, book_size=None):
+        self.png_path = png_path
+        self.covs = covs[[covariate]]
+        self.covariate = covariate
+        self.skip_existing = skip_existing
+        self.workers = []
+        self.book = None
+        self.done = {}
+        if png_path.endswith('show'):
+            procs, book = 0, None
+        prefix = book_prefix(png_path)
+        if book is not None and skip_existing:
+            self.done = read_book_index(prefix)
+        if procs > 0:
+            self.queue = multiprocessing.Queue(max_pending or 4 * procs)
+            for i in range(procs):
+                book_args = None
+                if book is not None:
+                    book_args = dict(mode=book, size=book_size, prefix=prefix
+                                     if procs == 1 else "%s.w%i" % (prefix, i))
+                w = multiprocessing.Process(target=_plot_worker,
+                        args=(self.queue, png_path, self.covs, covariate,
+                              skip_existing, book_args))
+                w.daemon = True
+                w.start()
+                self.workers.append(w)
+        elif book is not None:
+            self.book = PlotBook(prefix, png_path, self.covs, covariate,
+                                 mode=book, size=book_size,
+                                 skip_existing=skip_existing)
+
+    def skip(self, res):
+        "True if the plot for `res` is already done and can be skipped"
+        if not self.skip_existing: return False
+        if self.done:
+            return "{chrom}:{start}-{end}".format(**res) in self.done
+        png = plot_path(res, self.png_path)
+        return png is not None and op.exists(png)
+
+    def submit(self, res, cluster_df, weights_df=None):
+        if self.workers:
+            self.queue.put((res, cluster_df, weights_df))
+        elif self.book is not None:
+            self.book.add(res, cluster_df, weights_df)
+        else:
+            plot_res(res, self.png_path, self.covs, self.covariate,
+                     cluster_df, weights_df, skip_existing=self.skip_existing)
+
+    def close(self):
+        for w in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+        if self.book is not None:
+            self.book.close()
+            self.book = None
@@ -0,0 +1,97 @@
+"""
+drop probes that can not give a signal before they are clustered and
+modelled: those with too many missing values, too few samples with a value
+(or with weight > 0 if there are weights) or too little variation. The
+features from feature_gen are checked in chunks with numpy and the ones
+that pass are yielded in order:
+
+    pf = Prefilter(max_nan=0.2, min_var=0.01)
+    for feature in pf(feature_gen(fmeth)):
+        ...
+
+The number dropped for each reason is in `pf.counts` and is written to
+stderr when the features are exhausted. A probe is counted only for the
+first reason (in the order of REASONS) that it fails.
+"""
+import sys
+import warnings
+from collections import OrderedDict
+import numpy as np
+
+from .feature import feature_arrays
+from .instrument import get_profiler
+
+REASONS = ('nan', 'samples', 'var', 'iqr')
+
+class Prefilter(object):
+
+    def __init__(self, max_nan=1.0, min_samples=0, min_var=0, min_iqr=0,
+                 chunksize=5000, out=sys.stderr):
+        self.max_nan, self.min_samples = max_nan, min_samples
+        self.min_var, self.min_iqr = min_var, min_iqr
+        self.chunksize, self.out = chunksize, out
+        self.counts = OrderedDict((k, 0) for k in ('seen',) + REASONS)
+
+    @property
+    def active(self):
+        return (self.max_nan < 1 or self.min_samples > 0 or self.min_var > 0
+                or self.min_iqr > 0)
+
+    def reasons(self, values, weights=None):
+        """
+        the index (1-based) in REASONS of the first test that each row of
+        `values` fails or 0 to keep it.
+        >>> Prefilter(max_nan=0.5, min_var=0.1).reasons(np.array([
+        ...      [1, 2, 3, np.nan], [1, np.nan, np.nan, np.nan], [1, 1, 1, 1.1]]))
+        array([0, 1, 3])
+        """
+        res = np.zeros(len(values), dtype=int)
+        n = values.shape[1]
+        missing = np.isnan(values)
+        tests = []
+        if self.max_nan < 1:
+            tests.append((1, lambda: missing.sum(axis=1) > self.max_nan * n))
+        if self.min_samples > 0:
+            has = ~missing if weights is None else ~missing & (weights > 0)
+            tests.append((2, lambda: has.sum(axis=1) < self.min_samples))
+        if self.min_var > 0:
+            tests.append((3, lambda: ~(np.nanvar(values, axis=1, ddof=1)
+                                       >= self.min_var)))
+        if self.min_iqr > 0:
+            def iqr():
+                q = np.nanpercentile(values, [25, 75], axis=1)
+                return ~(q[1] - q[0] >= self.min_iqr)
+            tests.append((4, iqr))
+        with warnings.catch_warnings():
+            # all-NaN rows
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for code, test in tests:
+                res[(res == 0) & test()] = code
+        return res
+
+    def _chunk(self, features):
+        values, weights = feature_arrays(features)
+        codes = self.reasons(values, weights)
+        self.counts['seen'] += len(features)
+        for code, n in zip(*np.unique(codes[codes > 0], return_counts=True)):
+            self.counts[REASONS[code - 1]] += n
+        get_profiler().add('prefiltered', int((codes > 0).sum()))
+        return [f for f, c in zip(features, codes) if c == 0]
+
+    def __call__(self, features):
+        chunk = []
+        for f in features:
+            chunk.append(f)
+            if len(chunk) == self.chunksize:
+                for f in self._chunk(chunk): yield f
+                chunk = []
+        if chunk:
+            for f in self._chunk(chunk): yield f
+        if self.out is not None:
+            self.out.write(self.summary() + "\n")
+
+    def summary(self):
+        dropped = sum(self.counts[k] for k in REASONS)
+        return "prefilter: dropped %i of %i probes (%s)" % (dropped,
+                self.counts['seen'], ", ".join("%s: %i" % (k, self.counts[k])
+                                               for k in REASONS))
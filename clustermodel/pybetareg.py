@@ -0,0 +1,184 @@
+"""
+beta-regression for --betareg with --engine python.
+
+Every site in a batch of clusters has the same design so, instead of a call
+to betareg for each site, all sites are fit at once with Fisher scoring
+(as betareg does after its optimizer) on arrays of sites * samples. The
+starting values are from the (weighted) linear regression of logit(y) as
+in Ferrari and Cribari-Neto (2004). Each site gives a coefficient and a
+Wald p-value for the first covariate; these are combined for each cluster
+with `combine` and the site weights (the total read-depth of each site).
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import gammaln, digamma, polygamma
+
+from .pyengine import Design, split_model, r_types, batch_frame
+
+MAX_ITER = 100
+TOL = 1e-8
+
+def squeeze(y):
+    """
+    move values of 0 and 1 inside (0, 1) (Smithson and Verkuilen, 2006)
+    >>> squeeze(np.array([[0., 0.5, 1.]])).round(3)
+    array([[0.167, 0.5  , 0.833]])
+    """
+    n = np.isfinite(y).sum(axis=1)[:, None].astype(float)
+    return (y * (n - 1) + 0.5) / n
+
+def _parts(X, y, w, beta, phi):
+    """
+    log-likelihood, score and expected information of every site. `y` and
+    `w` are sites * samples and beta is sites * covariates.
+    """
+    eta = beta.dot(X.T)
+    mu = 1 / (1 + np.exp(-eta))
+    mu = np.clip(mu, 1e-10, 1 - 1e-10)
+    p = phi[:, None]
+    a, b = mu * p, (1 - mu) * p
+    ystar = np.log(y) - np.log1p(-y)
+    mustar = digamma(a) - digamma(b)
+    dmu = mu * (1 - mu)
+
+    ll = (w * (gammaln(p) - gammaln(a) - gammaln(b) + (a - 1) * np.log(y)
+               + (b - 1) * np.log1p(-y))).sum(axis=1)
+
+    score_beta = (p * w * dmu * (ystar - mustar)).dot(X)
+    score_phi = (w * (mu * (ystar - mustar) + np.log1p(-y) - digamma(b)
+                      + digamma(p))).sum(axis=1)
+
+    ta, tb, tp = polygamma(1, a), polygamma(1, b), polygamma(1, p)
+    W = w * p * (ta + tb) * dmu ** 2
+    c = w * p * (ta * mu - tb * (1 - mu)) * dmu
+    d = w * (ta * mu ** 2 + tb * (1 - mu) ** 2 - tp)
+
+    k = X.shape[1]
+    info = np.empty((len(y), k + 1, k + 1))
+    info[:, :k, :k] = p[:, :, None] * np.einsum('si,ij,ik->sjk', W, X, X)
+    info[:, :k, k] = info[:, k, :k] = c.dot(X)
+    info[:, k, k] = d.sum(axis=1)
+    score = np.column_stack((score_beta, score_phi))
+    return ll, score, info
+
+def start(X, y, w):
+    "starting values from the weighted regression of logit(y) on X"
+    z = np.log(y) - np.log1p(-y)
+    XtWX = np.einsum('si,ij,ik->sjk', w, X, X)
+    XtWz = (w * z).dot(X)
+    beta = np.linalg.solve(XtWX, XtWz[:, :, None])[:, :, 0]
+    eta = beta.dot(X.T)
+    mu = 1 / (1 + np.exp(-eta))
+    n = (w > 0).sum(axis=1)
+    resid = ((z - eta) ** 2 * (w > 0)).sum(axis=1) / np.maximum(n - X.shape[1], 1)
+    sigma2 = resid[:, None] * (mu * (1 - mu)) ** 2
+    phi = ((mu * (1 - mu) / sigma2 - 1) * (w > 0)).sum(axis=1) / n
+    return beta, np.maximum(phi, 1e-3)
+
+def fit(X, y, w):
+    """
+    fit beta-regression with a logit link and constant precision to each
+    row of `y` (with prior weights `w`, 0 for missing). Returns beta, its
+    standard error and the number of iterations.
+    """
+    beta, phi = start(X, y, w)
+    k = X.shape[1]
+    ll = _parts(X, y, w, beta, phi)[0]
+    active = np.ones(len(y), dtype=bool)
+    for it in range(MAX_ITER):
+        idx = np.where(active)[0]
+        if len(idx) == 0: break
+        _, score, info = _parts(X, y[idx], w[idx], beta[idx], phi[idx])
+        step = np.linalg.solve(info, score[:, :, None])[:, :, 0]
+        # halve the step for sites where it decreases the likelihood or
+        # makes phi negative.
+        scale = np.ones(len(idx))
+        for _ in range(30):
+            nb = beta[idx] + scale[:, None] * step[:, :k]
+            nphi = phi[idx] + scale * step[:, k]
+            bad = nphi <= 0
+            nphi = np.where(bad, phi[idx], nphi)
+            nll = _parts(X, y[idx], w[idx], nb, nphi)[0]
+            bad |= ~(nll >= ll[idx] - 1e-10)
+            if not bad.any(): break
+            scale[bad] /= 2.
+        change = np.abs(nll - ll[idx])
+        beta[idx], phi[idx], ll[idx] = nb, nphi, nll
+        active[idx[(change < TOL * (np.abs(ll[idx]) + TOL))
+                   | (scale < 1e-8)]] = False
+    info = _parts(X, y, w, beta, phi)[2]
+    se = np.sqrt(np.abs(np.array([np.diag(np.linalg.pinv(i)) for i in info])))
+    return beta, se[:, :k], it + 1
+
+def combine_p(pvalues, weights, sigma, method):
+    """
+    combine the p-values of correlated sites. 'liptak' is Stouffer-Liptak
+    with the correlation `sigma`; 'z-score' uses the mean correlation as
+    in the BiSeq paper. `weights` gives sites with more reads more weight.
+    >>> round(combine_p(np.array([0.01, 0.02]), np.ones(2), np.eye(2), 'liptak'), 5)
+    0.00098
+    """
+    z = stats.norm.isf(np.clip(pvalues, 1e-300, 1 - 1e-16))
+    w = weights / weights.sum()
+    if method == 'liptak':
+        var = w.dot(sigma).dot(w)
+    else:
+        n = len(w)
+        rho = (sigma.sum() - np.trace(sigma)) / (n * (n - 1)) if n > 1 else 0
+        var = (w ** 2).sum() + rho * (w.sum() ** 2 - (w ** 2).sum())
+    if not var > 0:
+        var = (w ** 2).sum()
+    return stats.norm.sf(w.dot(z) / np.sqrt(var))
+
+def clustered_model(covs, meths, model, weights, combine='z-score'):
+    """
+    beta-regression of each site in each cluster of `meths` (ratios) with
+    read-depths in `weights`. returns a DataFrame like the one from R.
+    """
+    t0, c0 = time.time(), os.times()
+    lhs, fixed, random = split_model(model)
+    design = Design(r_types(covs), fixed, 1)
+    rows = design.rows
+
+    y = [np.atleast_2d(np.asarray(m, dtype=float))[:, rows] for m in meths]
+    sizes = np.array([len(m) for m in y])
+    y = np.vstack(y)
+    w = np.vstack([np.atleast_2d(np.asarray(m, dtype=float))[:, rows]
+                   for m in weights])
+    missing = np.isnan(y) | np.isnan(w) | (w <= 0)
+    w = np.where(missing, 0, w)
+    y = squeeze(np.where(missing, np.nan, np.clip(y, 0, 1)))
+    y = np.where(missing, 0.5, y)
+
+    # sparse (bisulfite) data can leave a site with too few samples or with
+    # no samples at some level of a covariate.
+    X = design.X
+    ok = ((w > 0).sum(axis=1) > X.shape[1] + 1) & (y.std(axis=1) > 0)
+    ok &= np.abs(np.linalg.det(np.einsum('si,ij,ik->sjk', (w > 0).astype(float),
+                                         X, X))) > 1e-8
+    beta = np.nan * np.ones((len(y), X.shape[1]))
+    se = beta.copy()
+    if ok.any():
+        with np.errstate(all='ignore'):
+            beta[ok], se[ok], _ = fit(X, y[ok], w[ok])
+    coef = beta[:, 1]
+    p = 2 * stats.norm.sf(np.abs(coef / se[:, 1]))
+
+    res = []
+    ends = np.cumsum(sizes)
+    for i, (s, e) in enumerate(zip(ends - sizes, ends)):
+        cp, cc, cw = p[s:e], coef[s:e], w[s:e].sum(axis=1)
+        good = np.isfinite(cp) & (cw > 0)
+        if not good.any():
+            res.append(dict(coef=np.nan, p=np.nan))
+            continue
+        vals = np.where(missing[s:e], np.nan, y[s:e])[good]
+        sigma = pd.DataFrame(vals.T).corr().fillna(0).values
+        np.fill_diagonal(sigma, 1)
+        res.append(dict(coef=np.average(cc[good], weights=cw[good]),
+                        p=combine_p(cp[good], cw[good], sigma, combine)))
+    return batch_frame(pd.DataFrame(res, columns=['coef', 'p']),
+                       design.covariate, model, t0, c0)
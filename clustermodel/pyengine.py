@@ -0,0 +1,298 @@
+"""
+fit models in python instead of R (--engine python).
+
+A pool of worker processes is started once with the covariates and model and
+is re-used for every batch of clusters. Each worker builds (and caches) the
+design matrix for each cluster size so only the methylation values and
+weights are sent for each cluster. Results have the same columns as those
+from R.
+
+Methods without a python implementation are sent to R. GEE is in pygee.py
+and random-intercept models in pylmm.py. Beta-regression (pybetareg.py) and
+SKAT (pyskat.py) do all clusters of a batch at once in this process instead of
+using the pool.
+"""
+import os
+import re
+import sys
+import time
+import atexit
+import warnings
+import multiprocessing
+from itertools import izip
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+R_LOGICAL = {'T': True, 'TRUE': True, 'True': True, 'true': True,
+             'F': False, 'FALSE': False, 'False': False, 'false': False}
+
+def r_types(covs):
+    """
+    convert columns of T/F (or TRUE/FALSE) to bool as R's read.csv would so
+    that the covariate names match those from R.
+    >>> r_types(pd.DataFrame({'d': ['T', 'F'], 'g': ['M', 'F']}))['d'].tolist()
+    [True, False]
+    """
+    covs = covs.copy()
+    for c in covs.columns:
+        if covs[c].dtype != object: continue
+        vals = set(covs[c].dropna())
+        if vals and vals.issubset(R_LOGICAL):
+            covs[c] = [R_LOGICAL[v] if v in R_LOGICAL else np.nan
+                       for v in covs[c]]
+    return covs
+
+def r_name(name):
+    """
+    R's name for a column of the design matrix
+    >>> r_name('disease[T.True]'), r_name('gender[T.M]'), r_name('age')
+    ('diseaseTRUE', 'genderM', 'age')
+    """
+    m = re.match(r"^(.+)\[T\.(.+)\]$", name)
+    if m is None: return name
+    level = {'True': 'TRUE', 'False': 'FALSE'}.get(m.group(2), m.group(2))
+    return m.group(1) + level
+
+def split_model(model):
+    """
+    split an R (lme4) model into the response, the fixed-effects formula
+    and the grouping variables of any random intercepts.
+    >>> split_model('methylation ~ disease + (1|CpG) + (1 | id)')
+    ('methylation', 'disease', ['CpG', 'id'])
+    """
+    lhs, rhs = [x.strip() for x in model.split("~", 1)]
+    random = re.findall(r"\(\s*1\s*\|\s*([^)\s]+)\s*\)", rhs)
+    fixed = re.sub(r"\+?\s*\([^)]*\|[^)]*\)", "", rhs).strip().strip("+").strip()
+    return lhs, fixed or "1", random
+
+
+class Design(object):
+    """
+    the fixed-effects design for a cluster of `n_probes` probes in long
+    format: probe 0 for every sample, then probe 1, ... (the order of
+    `values.ravel()` for an n_probes * n_samples array).
+    Rows with missing covariates are dropped as R does.
+    """
+
+    def __init__(self, covs, fixed, n_probes):
+        import patsy
+        n_samples = len(covs)
+        long = pd.concat([covs] * n_probes, ignore_index=True)
+        long['CpG'] = np.repeat(["CpG%i" % i for i in range(n_probes)],
+                                n_samples)
+        if 'id' not in covs.columns:
+            long['id'] = np.tile(np.arange(n_samples), n_probes)
+        X = patsy.dmatrix(fixed, long, NA_action='drop',
+                          return_type='dataframe')
+        self.n_probes, self.n_samples = n_probes, n_samples
+        self.rows = np.asarray(X.index, dtype=int)
+        self.X = np.asarray(X, dtype=float)
+        self.columns = [r_name(c) for c in X.columns]
+        self.covariate = self.columns[1] if len(self.columns) > 1 else None
+        self.cpg = self.rows // n_samples
+        self.sample = self.rows % n_samples
+
+    def take(self, values, weights=None):
+        """
+        return y, X, CpG, sample (and weights) for `values` of shape
+        n_probes * n_samples with rows of missing y or weights removed.
+        """
+        y = np.asarray(values, dtype=float).ravel()[self.rows]
+        keep = ~np.isnan(y)
+        w = None
+        if weights is not None:
+            w = np.asarray(weights, dtype=float).ravel()[self.rows]
+            keep &= ~np.isnan(w)
+            w = w[keep]
+        return y[keep], self.X[keep], self.cpg[keep], self.sample[keep], w
+
+
+def fit_lm(y, X, weights=None, counts=False):
+    """
+    (coef, p) for the 2nd column of X with (weighted) least squares and a
+    t-test as R's lm, or a poisson glm if `counts`.
+    """
+    if counts:
+        import statsmodels.api as sm
+        res = sm.GLM(y, X, family=sm.families.Poisson(),
+                     freq_weights=weights).fit()
+        return res.params[1], res.pvalues[1]
+    if weights is not None:
+        sw = np.sqrt(weights)
+        y, X = y * sw, X * sw[:, None]
+    beta, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+    df = len(y) - rank
+    resid = y - X.dot(beta)
+    sigma2 = resid.dot(resid) / df
+    se = np.sqrt(sigma2 * np.linalg.pinv(X.T.dot(X))[1, 1])
+    t = beta[1] / se
+    return beta[1], 2 * stats.t.sf(abs(t), df)
+
+
+# state in each worker process; set by _init_worker.
+_STATE = {}
+
+def _init_worker(state):
+    _STATE.clear()
+    _STATE.update(state)
+    _STATE['designs'] = {}
+
+def design(n_probes):
+    "the (cached) Design for a cluster of n_probes in this process"
+    designs = _STATE['designs']
+    if not n_probes in designs:
+        designs[n_probes] = Design(_STATE['covs'], _STATE['fixed'], n_probes)
+    return designs[n_probes]
+
+def _run(task):
+    values, weights = task
+    start, t0, pid = time.time(), os.times(), os.getpid()
+    d = design(len(values))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            coef, p = _STATE['fit'](d, values, weights, **_STATE['kwargs'])
+    except (np.linalg.LinAlgError, ValueError, ZeroDivisionError):
+        coef, p = np.nan, np.nan
+    t1 = os.times()
+    return dict(covariate=d.covariate, coef=coef, p=p, r_start=start,
+                r_wall=time.time() - start,
+                r_cpu=(t1[0] - t0[0]) + (t1[1] - t0[1]), r_pid=pid)
+
+
+def _floats(m):
+    m = np.atleast_2d(np.asarray(m))
+    return m if m.dtype.kind == 'f' else m.astype(float)
+
+
+class EnginePool(object):
+    """
+    long-lived worker processes that call `fit(design, values, weights,
+    **kwargs)` for each cluster. with procs <= 1, clusters are fit in this
+    process.
+    """
+
+    def __init__(self, covs, model, fit, kwargs=None, procs=1):
+        lhs, fixed, random = split_model(model)
+        state = dict(covs=r_types(covs), fixed=fixed, random=random,
+                     fit=fit, kwargs=kwargs or {})
+        self.procs = procs
+        if procs > 1:
+            self.pool = multiprocessing.Pool(procs, _init_worker, (state,))
+        else:
+            self.pool = None
+            _init_worker(state)
+
+    def map(self, meths, weights=None):
+        if weights is None:
+            weights = [None] * len(meths)
+        # float32 batches are sent to the workers as is; the fits use
+        # float64.
+        # a generator so clusters of a sparse batch (feature.ClusterArrays)
+        # are made dense one at a time.
+        tasks = ((_floats(m), None if w is None else _floats(w))
+                 for m, w in izip(meths, weights))
+        if self.pool is None:
+            return [_run(t) for t in tasks]
+        chunksize = max(1, len(meths) // (4 * self.procs))
+        return list(self.pool.imap(_run, tasks, chunksize=chunksize))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+# the pool is kept between batches as long as the covariates, model and
+# method are the same.
+_POOL = {'key': None, 'pool': None}
+
+def get_pool(covs, model, fit, kwargs, procs):
+    key = (model, fit.__module__, fit.__name__, sorted(kwargs.items()), procs,
+           covs.shape, int(pd.util.hash_pandas_object(covs).sum()))
+    if _POOL['key'] != key:
+        close_pool()
+        _POOL['pool'] = EnginePool(covs, model, fit, kwargs, procs)
+        _POOL['key'] = key
+    return _POOL['pool']
+
+def close_pool():
+    if _POOL['pool'] is not None:
+        _POOL['pool'].close()
+    _POOL['key'] = _POOL['pool'] = None
+
+atexit.register(close_pool)
+
+
+def get_fit(model, weights, gee_args, combine, bumping, betareg, skat,
+            counts):
+    """
+    the fit function and its kwargs for these options or (None, None) if
+    there is no python implementation.
+    """
+    if gee_args and not betareg:
+        from . import pygee
+        corstr, idvar = gee_args
+        if not pygee.supported(corstr, idvar, counts, weights is not None):
+            return None, None
+        return pygee.fit, dict(corstr=corstr, idvar=idvar, counts=counts)
+    if "|" in model and not any((combine, bumping, betareg, skat)):
+        from . import pylmm
+        random = tuple(split_model(model)[2])
+        if not pylmm.supported(random, counts, weights is not None):
+            return None, None
+        return pylmm.fit, dict(random=random, counts=counts)
+    return None, None
+
+def batch_frame(res, covariate, model, start, times):
+    """
+    DataFrame of `res` (dicts or columns) for a batch of clusters fit at once
+    in this process since `start` (time.time()) and `times` (os.times()).
+    The time is split evenly between the clusters.
+    """
+    df = pd.DataFrame(res)
+    n = max(len(df), 1)
+    t1 = os.times()
+    df['covariate'] = covariate
+    df['r_start'] = start
+    df['r_wall'] = (time.time() - start) / n
+    df['r_cpu'] = ((t1[0] - times[0]) + (t1[1] - times[1])) / n
+    df['r_pid'] = os.getpid()
+    df['cluster_id'] = np.arange(1, len(df) + 1)
+    df['model'] = model
+    return df
+
+_warned = set()
+
+def clustered_model(cov, meths, model, weights=None, gee_args=(),
+                    combine=False, bumping=False, betareg=False, skat=False,
+                    counts=False, procs=None):
+    """
+    fit `model` to each cluster in `meths` (DataFrames or arrays of
+    n_probes * n_samples). returns None if the options are not implemented
+    in python. Otherwise, a DataFrame like the one from R.
+    """
+    if betareg and combine in ('liptak', 'z-score') and weights is not None:
+        from . import pybetareg
+        return pybetareg.clustered_model(cov, meths, model, weights, combine)
+    if skat and weights is None and not "|" in model:
+        from . import pyskat
+        return pyskat.clustered_model(cov, meths, model)
+    fit, kwargs = get_fit(model, weights, gee_args, combine, bumping,
+                          betareg, skat, counts)
+    if fit is None:
+        if not model in _warned:
+            _warned.add(model)
+            sys.stderr.write("no python engine for these options; using R\n")
+        return None
+    if procs is None:
+        from . import CPUS as procs
+    pool = get_pool(cov, model, fit, kwargs, procs)
+    df = pd.DataFrame(pool.map(meths, weights))
+    df['cluster_id'] = np.arange(1, len(df) + 1)
+    df['model'] = model
+    df['p'] = df['p'].astype(float)
+    df['coef'] = df['coef'].astype(float)
+    return df
@@ -0,0 +1,131 @@
+"""
+GEE with statsmodels in place of geepack::geeglm for --gee-args with
+--engine python.
+
+As with geeglm, the data is grouped by `id` (each sample is a group of its
+CpGs) or by `CpG` (each CpG is a group of samples) and the p-value is from
+the robust (sandwich) Wald test of the first covariate. Weights are prior
+(observation) weights; for the gaussian family they are applied by scaling
+each row by sqrt(weight) which gives the same estimating equations as
+geeglm. Clusters of 1 probe are fit with `pyengine.fit_lm` as in R.
+"""
+import numpy as np
+
+from .pyengine import fit_lm
+
+CORSTRS = ('ex', 'ar', 'in', 'un')
+
+def supported(corstr, idvar, counts, weighted):
+    # statsmodels only has group-level weights so can't do weighted poisson.
+    return corstr[:2] in CORSTRS and idvar in ('id', 'CpG') and not (
+                counts and weighted)
+
+def cov_struct(corstr):
+    from statsmodels.genmod import cov_struct as cs
+    corstr = corstr[:2]
+    if corstr == 'ex': return cs.Exchangeable()
+    if corstr == 'ar': return _ar1()
+    if corstr == 'in': return cs.Independence()
+    if hasattr(cs, 'Unstructured'): return cs.Unstructured()
+    return _unstructured()
+
+def _ar1():
+    """
+    AR-1 working correlation with the lag-1 moment estimator used by geepack.
+    statsmodels' Autoregressive fails to converge with few groups (e.g. 3
+    CpGs of 60 samples when grouped by CpG).
+    """
+    from statsmodels.genmod.cov_struct import CovStruct
+
+    class AR1(CovStruct):
+
+        def initialize(self, model):
+            super(AR1, self).initialize(model)
+            self.dep_params = 0.
+
+        def update(self, params):
+            varfunc = self.model.family.variance
+            num, n, ss, N = 0., 0, 0., 0
+            for i in range(self.model.num_group):
+                expval, _ = self.model.cached_means[i]
+                resid = (self.model.endog_li[i] - expval) / np.sqrt(varfunc(expval))
+                num += resid[1:].dot(resid[:-1])
+                n += len(resid) - 1
+                ss += resid.dot(resid)
+                N += len(resid)
+            if n == 0 or ss == 0: return
+            scale = ss / (N - len(params))
+            self.dep_params = float(np.clip(num / (n * scale), -0.999, 0.999))
+
+        def covariance_matrix(self, expval, index):
+            t = np.arange(len(expval))
+            return self.dep_params ** np.abs(t[:, None] - t[None, :]), True
+
+        def summary(self):
+            return "AR-1 working correlation: %.3f" % self.dep_params
+
+    return AR1()
+
+def _unstructured():
+    """
+    unstructured working correlation (for statsmodels without one). The
+    `time` of each observation is its position in the group.
+    """
+    from statsmodels.genmod.cov_struct import CovStruct
+
+    class Unstructured(CovStruct):
+
+        def initialize(self, model):
+            super(Unstructured, self).initialize(model)
+            self.dim = int(max(t.max() for t in model.time_li)) + 1
+            self.dep_params = np.eye(self.dim)
+
+        def update(self, params):
+            varfunc = self.model.family.variance
+            num = np.zeros((self.dim, self.dim))
+            n = np.zeros((self.dim, self.dim))
+            for i in range(self.model.num_group):
+                expval, _ = self.model.cached_means[i]
+                resid = (self.model.endog_li[i] - expval) / np.sqrt(varfunc(expval))
+                ix = self.model.time_li[i][:, 0].astype(int)
+                num[np.ix_(ix, ix)] += np.outer(resid, resid)
+                n[np.ix_(ix, ix)] += 1
+            cov = num / np.maximum(n, 1)
+            sd = np.sqrt(np.diag(cov))
+            sd[sd == 0] = 1
+            self.dep_params = cov / np.outer(sd, sd)
+            np.fill_diagonal(self.dep_params, 1)
+
+        def covariance_matrix(self, expval, index):
+            ix = self.model.time_li[index][:, 0].astype(int)
+            return self.dep_params[np.ix_(ix, ix)], True
+
+        def summary(self):
+            return "Unstructured working correlation"
+
+    return Unstructured()
+
+def fit(design, values, weights=None, corstr='ex', idvar='CpG', counts=False):
+    """
+    fit a GEE to a single cluster. returns (coef, p) of the first covariate
+    """
+    import statsmodels.api as sm
+    y, X, cpg, sample, w = design.take(values, weights)
+    if design.n_probes == 1:
+        return fit_lm(y, X, w, counts)
+
+    if idvar == 'id':
+        groups, wave = sample, cpg
+    else:
+        groups, wave = cpg, sample
+    # geeglm expects the data sorted by group.
+    order = np.lexsort((wave, groups))
+    y, X, groups, wave = y[order], X[order], groups[order], wave[order]
+    if w is not None:
+        sw = np.sqrt(w[order])
+        y, X = y * sw, X * sw[:, None]
+
+    family = sm.families.Poisson() if counts else sm.families.Gaussian()
+    res = sm.GEE(y, X, groups, time=wave, family=family,
+                 cov_struct=cov_struct(corstr)).fit()
+    return res.params[1], res.pvalues[1]
@@ -0,0 +1,133 @@
+"""
+random-intercept mixed models, e.g. `methylation ~ disease + (1|CpG)`, for
+--engine python in place of lme4::lmer.
+
+For random intercepts by CpG and/or id, the covariance of a cluster is
+
+    V = sigma^2 * (I + Z D Z')
+
+where Z holds the 0/1 columns of the CpG (and id) groups and D is diagonal
+with the variance ratio of each random effect. By Woodbury and the
+determinant lemma, everything the REML likelihood needs comes from the
+per-group sums Z'X and Z'y, the group sizes and, with both random effects,
+the probes * samples table of observed values:
+
+    X'V^-1 X = X'X - (D^1/2 Z'X)' W^-1 (D^1/2 Z'X)
+    log|V / sigma^2| = log|W|,  W = I + D^1/2 Z'Z D^1/2
+
+With 1 random effect W is diagonal. With both, the block of the larger
+group is diagonal and is eliminated so only a (smaller groups)^2 Schur
+complement is factored. The sums are computed once for each cluster so an
+evaluation of the likelihood does not depend on the number of
+observations and missing values cost nothing extra. The REML likelihood
+with sigma^2 profiled out is optimized over just the variance ratio(s).
+
+As with lmer and multcomp::glht in R, the fit is by REML and the p-value is
+from the Wald (z) test of the first covariate.
+"""
+import numpy as np
+from scipy import optimize, stats
+
+from .pyengine import fit_lm
+
+RANDOM = ('CpG', 'id')
+
+# log of the variance ratio is searched in this range.
+LOG_BOUNDS = (-12., 10.)
+
+def supported(random, counts, weighted):
+    return bool(random) and set(random).issubset(RANDOM) and len(set(random)) \
+            == len(random) and not counts and not weighted
+
+class GroupSums(object):
+    """
+    the sufficient statistics of a cluster for the random intercepts by the
+    group codes in `groups` (1 array per random effect).
+    """
+
+    def __init__(self, y, X, groups):
+        Xy = np.column_stack((X, y))
+        self.k = X.shape[1]
+        self.n = len(y)
+        self.gram = Xy.T.dot(Xy)
+        self.counts, self.sums, codes = [], [], []
+        for g in groups:
+            u, g = np.unique(g, return_inverse=True)
+            self.counts.append(np.bincount(g, minlength=len(u)).astype(float))
+            s = np.zeros((len(u), Xy.shape[1]))
+            np.add.at(s, g, Xy)
+            self.sums.append(s)
+            codes.append(g)
+        self.order = [0]
+        if len(groups) == 2:
+            # eliminate the larger (diagonal) block; factor the smaller.
+            self.order = [0, 1] if len(self.counts[0]) <= len(self.counts[1]) \
+                    else [1, 0]
+            a, b = self.order
+            self.cross = np.zeros((len(self.counts[a]), len(self.counts[b])))
+            np.add.at(self.cross, (codes[a], codes[b]), 1)
+
+    def reduced(self, ratios):
+        """
+        [X y]' V^-1 [X y] (times sigma^2) and log|V / sigma^2| for these
+        variance ratios.
+        """
+        if len(self.order) == 1:
+            d, c, s = ratios[0], self.counts[0], self.sums[0]
+            w = 1 + d * c
+            G = (s * (d / w)[:, None]).T.dot(s)
+            return self.gram - G, np.log(w).sum()
+        a, b = self.order
+        da, db = ratios[a], ratios[b]
+        sa, sb = self.sums[a] * np.sqrt(da), self.sums[b] * np.sqrt(db)
+        wb = 1 + db * self.counts[b]
+        T = self.cross * np.sqrt(da * db)
+        # Schur complement of the diagonal block b.
+        S = np.diag(1 + da * self.counts[a]) - (T / wb).dot(T.T)
+        L = np.linalg.cholesky(S)
+        ra = sa - (T / wb).dot(sb)
+        La = np.linalg.solve(L, ra)
+        G = (sb / wb[:, None]).T.dot(sb) + La.T.dot(La)
+        logdet = np.log(wb).sum() + 2 * np.log(np.diag(L)).sum()
+        return self.gram - G, logdet
+
+    def reml(self, ratios):
+        """
+        -2 * REML log-likelihood (without constants) for these variance
+        ratios. Also returns beta and its covariance.
+        """
+        P, logdet = self.reduced(ratios)
+        k = self.k
+        XtHX_inv = np.linalg.pinv(P[:k, :k])
+        beta = XtHX_inv.dot(P[:k, k])
+        dof = self.n - k
+        sigma2 = (P[k, k] - beta.dot(P[:k, k])) / dof
+        _, logdetX = np.linalg.slogdet(P[:k, :k])
+        ll = dof * np.log(sigma2) + logdet + logdetX
+        return ll, beta, sigma2 * XtHX_inv
+
+def fit(design, values, weights=None, random=('CpG',), counts=False):
+    """
+    fit a random-intercept model to a single cluster. returns (coef, p) of
+    the first covariate.
+    """
+    y, X, cpg, sample, w = design.take(values, weights)
+    if design.n_probes == 1:
+        # a random intercept with 1 level (or 1 observation per level)
+        return fit_lm(y, X, w, counts)
+
+    sums = GroupSums(y, X, [cpg if r == 'CpG' else sample for r in random])
+
+    def objective(log_ratios):
+        return sums.reml(np.exp(np.atleast_1d(log_ratios)))[0]
+
+    if len(random) == 1:
+        best = optimize.minimize_scalar(objective, bounds=LOG_BOUNDS,
+                                        method='bounded').x
+    else:
+        best = optimize.minimize(objective, np.zeros(len(random)),
+                                 method='L-BFGS-B',
+                                 bounds=[LOG_BOUNDS] * len(random)).x
+    _, beta, cov = sums.reml(np.exp(np.atleast_1d(best)))
+    z = beta[1] / np.sqrt(cov[1, 1])
+    return beta[1], 2 * stats.norm.sf(abs(z))
@@ -87,6 +87,9 @@ from types import *
 
 __version__ = '1.1.1'
 
+# characters of commands sent to and output read from all R sessions.
+TRANSFER = {'sent': 0, 'received': 0}
+
 if sys.version < '2.3': # actually python >= 2.3 is required by tempfile.mkstemp used in this module !!!
     set = frozenset = tuple
     basestring = str
@@ -613,6 +616,7 @@ class R(object): # "del r.XXX" fails on FePy-r7 (IronPython 1.1 on .NET 2.0.5072
         #CMD = (use_try and 'try({%s})%s%s' or '%s%s%s') % (CMD, newline, tail_cmd)
         CMD = (use_try and 'try({%s})%s%s' or '%s%s%s') % (CMD.replace('\\', '\\\\'), newline, tail_cmd)
         sendAll(self.prog, CMD)
+        TRANSFER['sent'] += len(CMD)
         rlt = ''
         while not re_tail.search(rlt): 
             try:
@@ -622,6 +626,7 @@ class R(object): # "del r.XXX" fails on FePy-r7 (IronPython 1.1 on .NET 2.0.5072
         else: 
             rlt = re_tail.sub('', rlt)
             if rlt.startswith('> '): rlt = rlt[2:]
+        TRANSFER['received'] += len(rlt)
         if fn is not None:
             os.unlink(fn)
         return rlt
@@ -0,0 +1,209 @@
+"""
+SKAT for --skat with --engine python.
+
+With --skat, the model is the null model, e.g. `disease ~ age`, and the
+methylation of each cluster is the set of variables that is tested. The
+null model is the same for every cluster so it is fit once (and kept for
+the run) with its residuals and the projection that removes the
+covariates. For each cluster the statistic (linear kernel) is
+
+    Q = res' Z Z' res / (2 * sigma^2)
+
+and its p-value is from the mixture of chi-squares with weights from the
+eigenvalues of the projected Z, by Davies' method (here the equivalent
+Imhof integral) with Liu's approximation if that fails, as in R's SKAT.
+A binary response uses a logistic null model ("D" in SKAT), otherwise it
+is linear ("C"). Missing methylation values are replaced by the mean of
+that probe. A cluster that the covariates explain completely (e.g. every
+probe is constant) has no eigenvalues above TOL times the trace of its
+Z'Z and gets a p-value of NaN.
+"""
+import os
+import math
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import integrate, stats
+
+from .pyengine import split_model, r_types, batch_frame
+
+# eigenvalues (and Q) below TOL * trace(Z'Z) of a cluster are roundoff.
+TOL = 1e-10
+
+class NullModel(object):
+    """
+    the null model fit to the covariates. `rows` are the samples without
+    missing values.
+    """
+
+    def __init__(self, covs, model):
+        import patsy
+        import statsmodels.api as sm
+        lhs, fixed, random = split_model(model)
+        covs = r_types(covs).reset_index(drop=True)
+        X = patsy.dmatrix(fixed, covs, NA_action='drop',
+                          return_type='dataframe')
+        y = covs[lhs][X.index].astype(float)
+        keep = np.isfinite(y.values)
+        self.rows = np.asarray(y.index, dtype=int)[keep]
+        X, y = np.asarray(X, dtype=float)[keep], y.values[keep]
+        self.name = lhs
+        self.binary = len(np.unique(y)) == 2
+        if self.binary:
+            y = (y == y.max()).astype(float)
+            res = sm.GLM(y, X, family=sm.families.Binomial()).fit()
+            mu = res.fittedvalues
+            v = mu * (1 - mu)
+            self.res = y - mu
+            self.sigma2 = 1.0
+        else:
+            v = np.ones(len(y))
+            beta = np.linalg.lstsq(X, y, rcond=None)[0]
+            self.res = y - X.dot(beta)
+            self.sigma2 = self.res.dot(self.res) / (len(y) - X.shape[1])
+        # Z1 = (V^1/2 Z - V^1/2 X (X'VX)^-1 X'V Z) / sqrt(2)
+        self.sv = np.sqrt(v)
+        self.H = (self.sv[:, None] * X).dot(
+                   np.linalg.pinv(X.T.dot(v[:, None] * X))).dot(X.T * v)
+
+    def scale(self, Z):
+        "the trace of the Gram matrix of each column of Z before projection"
+        return ((self.sv[:, None] * Z) ** 2).sum(axis=0) / 2
+
+    def project(self, Z):
+        "the projected Z whose Gram matrix gives the eigenvalues"
+        return (self.sv[:, None] * Z - self.H.dot(Z)) / np.sqrt(2)
+
+    def Q(self, Z):
+        U = self.res.dot(Z)
+        return U, U ** 2 / (2 * self.sigma2)
+
+
+def liu(q, lambdas):
+    """
+    p-value for the sum of chi-squares with weights `lambdas` from Liu et
+    al. (2009) as in CompQuadForm::liu.
+    """
+    c1, c2, c3, c4 = [(lambdas ** i).sum() for i in range(1, 5)]
+    s1, s2 = c3 / c2 ** 1.5, c4 / c2 ** 2
+    tstar = (q - c1) / np.sqrt(2 * c2)
+    if s1 ** 2 > s2:
+        a = 1 / (s1 - np.sqrt(s1 ** 2 - s2))
+        delta = s1 * a ** 3 - a ** 2
+        l = a ** 2 - 2 * delta
+    else:
+        a, delta, l = 1 / s1, 0, c2 ** 3 / c3 ** 2
+    x = tstar * np.sqrt(2) * a + l + delta
+    if delta == 0:
+        return stats.chi2.sf(x, l)
+    return stats.ncx2.sf(x, l, delta)
+
+def davies(q, lambdas):
+    """
+    P(sum(lambdas * chi2_1) > q) by numerical integration (Imhof, 1961).
+    returns None if the integral does not converge.
+    The integrand is sin(phi(u) - q * u / 2) / (u * rho(u)) so, after the
+    first few periods, the tail is done as Fourier integrals of the smooth
+    sin(phi) / (u * rho) and cos(phi) / (u * rho).
+    """
+    if q <= 0:
+        return 1.0
+    w = 0.5 * q
+    # python floats and math are much faster than numpy for the few
+    # eigenvalues of a cluster.
+    lambdas = [float(l) for l in lambdas]
+
+    def parts(u):
+        phi, rho = 0., u
+        for l in lambdas:
+            lu = l * u
+            phi += math.atan(lu)
+            rho *= (1 + lu * lu) ** 0.25
+        return 0.5 * phi, rho
+
+    def f(u):
+        if u == 0: return 0.5 * (sum(lambdas) - q)
+        phi, rho = parts(u)
+        return math.sin(phi - w * u) / rho
+
+    def g_sin(u):
+        phi, rho = parts(u)
+        return math.sin(phi) / rho
+
+    def g_cos(u):
+        phi, rho = parts(u)
+        return math.cos(phi) / rho
+
+    a = 4 * np.pi / w
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", integrate.IntegrationWarning)
+        try:
+            head = integrate.quad(f, 0, a, limit=200)[0]
+            tail = (integrate.quad(g_sin, a, np.inf, weight='cos', wvar=w)[0]
+                  - integrate.quad(g_cos, a, np.inf, weight='sin', wvar=w)[0])
+        except integrate.IntegrationWarning:
+            return None
+    p = 0.5 + (head + tail) / np.pi
+    if not (0 < p <= 1):
+        return None
+    return p
+
+def pvalue(q, lambdas, tol=0):
+    """
+    p-value of `q` for the eigenvalues `lambdas`. Eigenvalues at or below
+    `tol` are dropped and, if none are left or `q` is at or below `tol`,
+    the p-value is NaN.
+    >>> pvalue(1e-22, np.array([5e-30, 1e-31]), tol=1e-9)
+    nan
+    """
+    if q <= tol or not (lambdas > tol).any():
+        return np.nan
+    lambdas = lambdas[lambdas > max(tol, 1e-8 * lambdas.max())]
+    if len(lambdas) == 1:
+        return stats.chi2.sf(q / lambdas[0], 1)
+    p = davies(q, lambdas)
+    return liu(q, lambdas) if p is None else p
+
+def impute(values):
+    "replace missing values with the mean of that row (probe)"
+    values = np.array(values, dtype=float)
+    mean = np.nanmean(values, axis=1)
+    i, j = np.where(np.isnan(values))
+    values[i, j] = mean[i]
+    return np.nan_to_num(values)
+
+# the null model is kept for the run.
+_NULL = {'key': None, 'null': None}
+
+def get_null(covs, model):
+    key = (model, covs.shape, int(pd.util.hash_pandas_object(covs).sum()))
+    if _NULL['key'] != key:
+        _NULL['null'], _NULL['key'] = NullModel(covs, model), key
+    return _NULL['null']
+
+def clustered_model(covs, meths, model):
+    """
+    SKAT of each cluster in `meths` against the null `model`. returns a
+    DataFrame like the one from R (coef is NaN).
+    """
+    t0, c0 = time.time(), os.times()
+    null = get_null(covs, model)
+    Zs = [impute(np.atleast_2d(np.asarray(m, dtype=float))[:, null.rows]).T
+          for m in meths]
+    sizes = np.array([Z.shape[1] for Z in Zs])
+    # all clusters at once then split into the blocks of each cluster.
+    Z = np.column_stack(Zs)
+    _, q = null.Q(Z)
+    Z1 = null.project(Z)
+    scale = null.scale(Z)
+
+    ps = []
+    ends = np.cumsum(sizes)
+    for s, e in zip(ends - sizes, ends):
+        z1 = Z1[:, s:e]
+        lambdas = np.linalg.eigvalsh(z1.T.dot(z1))
+        ps.append(pvalue(q[s:e].sum(), lambdas, TOL * scale[s:e].sum()))
+
+    return batch_frame({'p': np.array(ps, dtype=float), 'coef': np.nan},
+                       null.name, model, t0, c0)
@@ -1,6 +1,10 @@
 import numpy as np
 
-def send_array(arr, fh):
+# the first int64 of a tagged file. the count of the untagged format is
+# never negative.
+TAG = -1
+
+def send_array(arr, fh, dtype=np.float64):
     # number of probes (columns)
     arr = np.asarray(arr).T
     shape = arr.shape
@@ -8,21 +12,71 @@ def send_array(arr, fh):
         shape = (shape[0], 1)
     # send shape as int
     np.array(shape, dtype=np.int64).tofile(fh)
-    # send data as float64
-    np.asarray(arr).flatten().astype(np.float64).tofile(fh)
+    # send data as float64 (or float32 in a tagged file)
+    np.asarray(arr).flatten().astype(dtype).tofile(fh)
 
-def send_arrays(arrays, fh):
+def send_header(fh, n, dtype=np.float64, sparse=False):
+    """
+    the format of send_arrays is read by read.bin in clustermodelr so it
+    is only tagged if it isn't float64 values of full matrices:
+        + int64 TAG
+        + int64 of the size of each value (8 for float64, 4 for float32)
+        + int64 1 if the matrices are sparse (see send_sparse_arrays) else 0
+    then the number of matrices as in send_arrays.
+    """
+    fh.seek(0)
+    if sparse or np.dtype(dtype) != np.float64:
+        np.array([TAG, np.dtype(dtype).itemsize, int(sparse)],
+                 dtype=np.int64).tofile(fh)
+    np.array([n], dtype=np.int64).tofile(fh)
+
+def send_arrays(arrays, fh, dtype=np.float64):
     """
     format is to send:
         + int64 of number of matrices
         + for each matrix:
             + int64, int64 of shape
             + float64 * (int64 * int64) of values
+    with dtype=np.float32, the values are float32 and the file starts with
+    the header from send_header.
     """
-    fh.seek(0)
-    np.array([len(arrays)], dtype=np.int64).tofile(fh)
+    send_header(fh, len(arrays), dtype)
+    for array in arrays:
+        send_array(array, fh, dtype)
+    fh.flush()
+
+def missing_fraction(arrays, fill):
+    "fraction of the values in `arrays` that are `fill` (NaN if fill is NaN)"
+    n = sum(np.size(a) for a in arrays)
+    if n == 0: return 0
+    if fill != fill:
+        missing = sum(np.isnan(np.asarray(a, dtype=float)).sum() for a in arrays)
+    else:
+        missing = sum((np.asarray(a) == fill).sum() for a in arrays)
+    return missing / float(n)
+
+def send_sparse_arrays(arrays, fh, fill=np.nan, dtype=np.float64):
+    """
+    like send_arrays but only the values that are not `fill`. after the
+    header from send_header:
+        + int64 of number of matrices
+        + for each matrix:
+            + int64, int64 of shape (as in send_array)
+            + int64 of number of values sent
+            + int32 * n of their indexes in the flattened matrix
+            + dtype * n of values
+    read.tagged.bin in R fills in the rest.
+    """
+    send_header(fh, len(arrays), dtype, sparse=True)
     for array in arrays:
-        send_array(array, fh)
+        arr = np.asarray(array).T
+        shape = arr.shape if arr.ndim == 2 else (arr.shape[0], 1)
+        flat = arr.ravel()
+        keep = ~np.isnan(flat) if fill != fill else flat != fill
+        idx = np.where(keep)[0]
+        np.array(shape + (len(idx),), dtype=np.int64).tofile(fh)
+        idx.astype(np.int32).tofile(fh)
+        flat[idx].astype(dtype).tofile(fh)
     fh.flush()
 
 
@@ -1,4 +1,11 @@
+import os
 import sys
+import json
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import os.path as op
 from toolshed import nopen
 
 import numpy as np
@@ -78,30 +85,254 @@ def gen_arma(n_probes=20000, n_patients=80, corr=0.2, df=2, scale=0.2):
     # these parameters are taken from the Bump Hunting Paper
     from statsmodels.tsa.arima_process import ArmaProcess
     sigma = 0.5
-    rvs = ss.norm(df, loc=0.05 / sigma, scale=scale).rvs
+    rvs = ss.t(df, loc=0.05 / sigma, scale=scale).rvs
     corr = -abs(corr)
     return np.column_stack([
         sigma * ArmaProcess([1, corr], [1])
-                           .generate_sample(n_probes=n_probes, distrvs=rvs)
+                           .generate_sample(nsample=n_probes, distrvs=rvs)
                            for i in range(n_patients)])
 
+def _weighted_sample(p, n, rng):
+    """
+    for each row of weights `p`, the indexes of `n` columns drawn without
+    replacement with probability proportional to `p` (as by choice(...,
+    replace=False, p=...)). Uses the keys log(u) / p of Efraimidis and
+    Spirakis (2006) so all rows are drawn at once.
+    """
+    with np.errstate(divide='ignore'):
+        keys = np.log(rng.random_sample(p.shape)) / p
+    return np.argpartition(-keys, n - 1, axis=1)[:, :n]
+
+def simulate_batch(values, offsets, n, w, is_cluster=None, rng=np.random):
+    """
+    vectorized `simulate_cluster` for a batch of clusters. `values` are the
+    probes * samples of all clusters with cluster i in rows
+    offsets[i]:offsets[i + 1]. The samples of each cluster are drawn once
+    (with weight 0 for clusters where `is_cluster` is False) and all
+    probes are gathered with 1 fancy index. returns the probes * 2n
+    simulated values and the clusters * 2n chosen columns of `values`.
+    """
+    values = np.asarray(values)
+    N = values.shape[1]
+    assert 2 * n < N
+    sizes = np.diff(offsets)
+    C = len(sizes)
+    wc = np.ones(C) * w
+    if is_cluster is not None:
+        wc[~np.asarray(is_cluster)] = 0
+    wc = wc[:, None]
+
+    # the order of the samples in a random probe of each cluster.
+    chosen = offsets[:-1] + (rng.random_sample(C) * sizes).astype(int)
+    order = np.argsort(values[chosen], axis=1)
+
+    ranks = np.arange(1, N + 1) / (N + 1.0)
+    h = _weighted_sample((1.0 - ranks)[None, :] ** wc, n, rng)
+
+    # the weight of the j'th remaining rank (as in simulate_cluster).
+    rows = np.arange(C)[:, None]
+    taken = np.zeros((C, N), dtype=bool)
+    taken[rows, h] = True
+    remaining = np.cumsum(~taken, axis=1) - 1
+    lranks = np.arange(1, N + 1 - n) / (N + 1.0 - n)
+    pl = lranks[np.clip(remaining, 0, N - n - 1)] ** wc
+    l = _weighted_sample(np.where(taken, 0, pl), n, rng)
+
+    cols = order[rows, np.column_stack((h, l))]
+    cluster = np.repeat(np.arange(C), sizes)
+    return values[np.arange(offsets[-1])[:, None], cols[cluster]], cols
+
+def _cluster_arrays(methylation, path, rho, max_dist, linkage,
+                    min_cluster_size, batch):
+    """
+    cluster `methylation` with `rho` and save the probes of the clusters
+    (in order) as arrays in `path` for `_simulate_point`.
+    """
+    if not op.exists(path):
+        os.makedirs(path)
+    cluster_gen = aclust(feature.feature_gen(methylation, rho_min=rho,
+                                             dtype=np.float32),
+                         max_dist=max_dist, max_skip=1, linkage=linkage)
+    meta = dict((k, []) for k in ('offsets', 'chrom', 'start', 'end', 'pos'))
+    n_probes = 0
+    with open(op.join(path, "values.bin"), "wb") as fh:
+        for b in feature.batches(cluster_gen, batch):
+            b.values.astype(np.float32).tofile(fh)
+            meta['offsets'].append(b.offsets[:-1] + n_probes)
+            n_probes += len(b.pos)
+            for k in ('chrom', 'start', 'end', 'pos'):
+                meta[k].append(getattr(b, k))
+            n_samples = b.values.shape[1]
+    meta['offsets'].append([n_probes])
+    for k, v in meta.items():
+        np.save(op.join(path, k + ".npy"), np.concatenate(v).astype(
+                    str if k == 'chrom' else np.int64))
+    sizes = np.diff(np.load(op.join(path, "offsets.npy")))
+    np.save(op.join(path, "is_cluster.npy"), sizes >= min_cluster_size)
+    np.save(op.join(path, "shape.npy"), [n_probes, n_samples])
+    return rho, path
+
+def _load_arrays(path):
+    a = dict((k, np.load(op.join(path, k + ".npy"))) for k in
+             ('offsets', 'chrom', 'start', 'end', 'pos', 'is_cluster', 'shape'))
+    a['values'] = np.memmap(op.join(path, "values.bin"), dtype=np.float32,
+                            mode='r', shape=tuple(a.pop('shape')))
+    return a
+
+def _write_covs(prefix, n):
+    with nopen("%s.covs.txt" % prefix, "w") as fh_covs:
+        print >>fh_covs, "id\tcase"
+        print >>fh_covs, "\n".join(
+                         ["case_%i\t1" % i for i in range(n)] +
+                         ["ctrl_%i\t0" % i for i in range(n)])
+
+def _simulate_point(args):
+    """
+    simulate 1 point (n, rho, w) of the grid from the clusters saved in
+    `path`. writes prefix.meth.txt (or the numpy arrays in prefix.meth/),
+    prefix.covs.txt and prefix.clusters.txt.
+    """
+    from .methmatrix import format_rows
+    path, prefix, n, rho, w, fmt, batch, seed = args
+    rng = np.random.RandomState(seed)
+    a = _load_arrays(path)
+    d = op.dirname(prefix)
+    if d and not op.exists(d):
+        os.makedirs(d)
+    _write_covs(prefix, n)
+    samples = ["case_%i" % i for i in range(n)] + \
+              ["ctrl_%i" % i for i in range(n)]
+
+    if fmt == "text":
+        fh_meth = nopen("%s.meth.txt" % prefix, "w")
+        fh_meth.write("probe\t%s\n" % "\t".join(samples))
+    else:
+        store = "%s.meth" % prefix
+        if not op.exists(store):
+            os.makedirs(store)
+        blocks = []
+    fh_clst = nopen("%s.clusters.txt" % prefix, "w")
+    print >>fh_clst, "chrom\tstart\tend\tw\tprobes"
+
+    offsets, is_cluster = a['offsets'], a['is_cluster']
+    for s in range(0, len(offsets) - 1, batch):
+        e = min(s + batch, len(offsets) - 1)
+        o = offsets[s:e + 1]
+        sim, _ = simulate_batch(a['values'][o[0]:o[-1]], o - o[0], n, w,
+                                is_cluster[s:e], rng)
+        chroms = np.repeat(a['chrom'][s:e], np.diff(o))
+        pos = a['pos'][o[0]:o[-1]]
+        if fmt == "text":
+            fh_meth.write(format_rows(["%s:%i" % cp for cp in zip(chroms, pos)],
+                                      sim, "%.3f"))
+        else:
+            # a block for each chromosome as from meth-matrix --store.
+            bounds = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+            for bs, be in zip(np.r_[0, bounds], np.r_[bounds, len(pos)]):
+                pre = "%05i" % len(blocks)
+                np.save(op.join(store, pre + ".pos.npy"), pos[bs:be])
+                np.save(op.join(store, pre + ".methylation.npy"),
+                        sim[bs:be].astype(np.float32))
+                blocks.append(dict(chrom=chroms[bs], file=pre, n=int(be - bs)))
+
+        for k in np.flatnonzero(is_cluster[s:e]) + s:
+            probes = ",".join("%s:%i" % (a['chrom'][k], p) for p in
+                              a['pos'][offsets[k]:offsets[k + 1]])
+            fh_clst.write("%s\t%i\t%i\t%s\t%s\n" % (a['chrom'][k],
+                          a['start'][k], a['end'][k], w, probes))
+
+    fh_clst.close()
+    if fmt == "text":
+        fh_meth.close()
+        return "%s.meth.txt" % prefix
+    with open(op.join(store, "index.json"), "w") as fh:
+        json.dump(dict(samples=samples, blocks=blocks), fh)
+    return store
+
+def point_prefix(template, n, rho, w, single):
+    """
+    output prefix for a point of the grid. `template` can use {n}, {rho}
+    and {w}; otherwise these are appended unless there is a `single` point.
+    >>> point_prefix('sim/ns_{n}/rho_{rho}/w_{w}/sim', 10, 0.3, 0.8, False)
+    'sim/ns_10/rho_0.3/w_0.8/sim'
+    >>> point_prefix('sim', 10, 0.3, 0.8, False)
+    'sim.ns_10.rho_0.3.w_0.8'
+    """
+    if "{" not in template:
+        if single: return template
+        template += ".ns_{n}.rho_{rho}.w_{w}"
+    return template.format(n=n, rho="%g" % rho, w="%g" % w)
+
+def simulate_grid(methylation, template, n_samples, rhos, ws, procs=1,
+                  fmt="text", batch=2000, seed=None, max_dist=500,
+                  linkage='complete', min_cluster_size=2):
+    """
+    simulate every (n_samples, rho, w) in the grid from `methylation` in a
+    single process pool. The data are clustered once for each rho then
+    each point of the grid is a task. returns the files written.
+    """
+    if seed is None:
+        seed = np.random.randint(2**31)
+    # the clustered data are kept next to the output.
+    d = op.dirname(template.split("{")[0])
+    if d and not op.exists(d):
+        os.makedirs(d)
+    tmp = tempfile.mkdtemp(dir=d or ".", suffix=".simulate")
+    pool = multiprocessing.Pool(procs) if procs > 1 else None
+    imap = pool.imap_unordered if pool is not None else itertools.imap
+    try:
+        paths = dict(imap(_cluster_star,
+                          [(methylation, op.join(tmp, "rho_%s" % rho), rho,
+                            max_dist, linkage, min_cluster_size, batch)
+                           for rho in rhos]))
+        grid = list(itertools.product(n_samples, rhos, ws))
+        single = len(grid) == 1
+        tasks = [(paths[rho], point_prefix(template, n, rho, w, single), n,
+                  rho, w, fmt, batch, [seed, k])
+                 for k, (n, rho, w) in enumerate(grid)]
+        return list(imap(_simulate_point, tasks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(tmp)
+
+def _cluster_star(args):
+    return _cluster_arrays(*args)
+
+def _floats(s, type=float):
+    return [type(x) for x in s.split(",")]
+
 def main(argv=sys.argv[1:]):
     import argparse
+    from . import CPUS
     ap = argparse.ArgumentParser()
-    ap.add_argument("--n-samples", type=int, default=20,
-            help="number of samples from each group to simulate")
-    ap.add_argument("-w", type=float, default=0,
+    ap.add_argument("--n-samples", default="20",
+            help="number of samples from each group to simulate. a "
+            "comma-separated list simulates each")
+    ap.add_argument("-w", default="0",
             help="weight parameter 0 is random, 1 is strong separation"
-            " between simulated groups")
+            " between simulated groups. can be a comma-separated list")
+    ap.add_argument("--procs", type=int, default=CPUS,
+            help="number of processes for the grid (default: %(default)s)")
+    ap.add_argument("--format", choices=("text", "npy"), default="text",
+            help="write prefix.meth.txt or numpy arrays in prefix.meth/ "
+            "(as from meth-matrix --store)")
+    ap.add_argument("--batch", type=int, default=2000,
+            help="clusters simulated at once")
+    ap.add_argument("--seed", type=int, help="random seed")
     ap.add_argument("methylation",
             help="input methylation data from which to simulate data")
     ap.add_argument("prefix",
             help="output prefix. prefix.meth.txt, prefix.covs.txt "
-            "and prefix.clusters.txt" " be created")
+            "and prefix.clusters.txt" " be created. with more than 1 point "
+            "in the grid, it can use {n}, {rho} and {w}, e.g. "
+            "sims/ns_{n}/rho_{rho}/w_{w}/sim")
 
     cp = ap.add_argument_group('clustering parameters')
-    cp.add_argument('--rho-min', type=float, default=0.3,
-                   help="minimum correlation to merge 2 probes")
+    cp.add_argument('--rho-min', default="0.3",
+                   help="minimum correlation to merge 2 probes. can be a "
+                   "comma-separated list")
     cp.add_argument('--min-cluster-size', type=int, default=2,
                     help="minimum cluster size on which to run model: "
                    "must be at least 2")
@@ -113,41 +344,14 @@ def main(argv=sys.argv[1:]):
                     " added to a cluster")
 
     args = ap.parse_args(argv)
-
-    samples = np.array(nopen(args.methylation).readline().rstrip().split("\t")[1:])
-    cluster_gen = (c for c in aclust(feature.feature_gen(args.methylation,
-                                                         rho_min=args.rho_min),
-                                     max_dist=args.max_dist,
-                                     max_skip=1,
-                                     linkage=args.linkage))
-    def check_cluster(clust):
-        return len(clust) >= args.min_cluster_size
-
-    n, w = args.n_samples, args.w
-    fh_meth = nopen("%s.meth.txt" % args.prefix, "w")
-    fh_clst = nopen("%s.clusters.txt" % args.prefix, "w")
-    with nopen("%s.covs.txt" % args.prefix, "w") as fh_covs:
-        print >>fh_covs, "id\tcase"
-        print >>fh_covs, "\n".join(
-                         ["case_%i\t1" % i for i in range(n)] +
-                         ["ctrl_%i\t0" % i for i in range(n)])
-    print >>fh_meth, "probe\t" + "\t".join(
-            ["case_%i" % i for i in range(n)] +
-            ["ctrl_%i" % i for i in range(n)])
-
-    print >>fh_clst, "chrom\tstart\tend\tw\tprobes"
-
-    for i, ocluster in enumerate(cluster_gen):
-        is_cluster = check_cluster(ocluster)
-        cluster = simulate_cluster(ocluster, samples, n, w if is_cluster else 0)
-        cluster.to_csv(fh_meth, sep="\t", index=True, header=False,
-                float_format="%.3f")
-        chrom, start, end = ocluster[0].group, ocluster[0].start, ocluster[-1].end
-        probes = ",".join("%s:%i" % (o.group, o.end) for o in ocluster)
-        if is_cluster:
-            print >>fh_clst, "{chrom}\t{start}\t{end}\t{w}\t{probes}".format(**locals())
-
-    print >>sys.stderr, "wrote:", fh_meth.name
+    for f in simulate_grid(args.methylation, args.prefix,
+                           _floats(args.n_samples, int),
+                           _floats(args.rho_min), _floats(args.w),
+                           procs=args.procs, fmt=args.format,
+                           batch=args.batch, seed=args.seed,
+                           max_dist=args.max_dist, linkage=args.linkage,
+                           min_cluster_size=args.min_cluster_size):
+        print >>sys.stderr, "wrote:", f
 
 if __name__ == "__main__":
 
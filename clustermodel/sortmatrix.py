@@ -0,0 +1,173 @@
+"""
+sort a methylation matrix (and its weights matrix) by chromosome, in
+natural order (chr2 before chr10), and position:
+
+    python -m clustermodel sort --weights counts.txt.gz \\
+        --out methylation.sorted.txt.gz \\
+        --weights-out counts.sorted.txt.gz methylation.txt.gz
+
+This is an external merge sort so that large matrices can be sorted in
+bounded memory. Rows are read in runs of at most --memory MB of text; each
+run is sorted and written to a temporary file and the runs are then merged.
+The rows of the weights matrix are kept with the rows of the methylation
+matrix so the 2 outputs stay aligned. The first row (the header) is kept
+in place. Outputs ending in .gz are written block-gzipped (BGZF).
+"""
+import re
+import sys
+import heapq
+import shutil
+import tempfile
+import os.path as op
+
+from .bgzf import open_input, BgzfWriter
+
+MEMORY = 1024
+
+_DIGITS = re.compile(r"(\d+)")
+
+def chrom_key(chrom):
+    """
+    key for the natural order of chromosome names.
+    >>> sorted(['chrX', 'chr10', 'chr2', 'chr1'], key=chrom_key)
+    ['chr1', 'chr2', 'chr10', 'chrX']
+    """
+    return tuple(int(t) if t.isdigit() else t for t in _DIGITS.split(chrom))
+
+def probe_key(probe):
+    """
+    (chromosome key, position) of a probe id as parsed by
+    feature.row_handler: chrom:pos, chrom_pos or just pos.
+    >>> probe_key('chr10:123') > probe_key('chr2:4567')
+    True
+    """
+    sep = ":" if ":" in probe else "_"
+    if sep in probe:
+        chrom, pos = probe.rsplit(sep, 1)
+    else:
+        chrom, pos = "chrom", probe
+    return chrom_key(chrom), int(pos)
+
+def _probe(line, sep):
+    i = line.find(sep)
+    return line if i == -1 else line[:i]
+
+def _lines(fname):
+    for line in open_input(fname):
+        yield line if line.endswith("\n") else line + "\n"
+
+def _rows(lines, wlines, fname, weights, sep):
+    """
+    yield (key, index, line, weights line) for each row after the header.
+    the probes of the 2 files must match.
+    """
+    for i, line in enumerate(lines):
+        probe = _probe(line, sep)
+        wline = None
+        if wlines is not None:
+            wline = next(wlines, None)
+            if wline is None or _probe(wline, sep) != probe:
+                raise ValueError("%s line %i: %s does not match %s in %s"
+                                 % (weights, i + 2, wline and _probe(wline, sep),
+                                    probe, fname))
+        yield probe_key(probe), i, line, wline
+    if wlines is not None and next(wlines, None) is not None:
+        raise ValueError("%s has more rows than %s" % (weights, fname))
+
+def _write_run(rows, path):
+    "write a sorted run to `path` (+ '.w' for the weights)"
+    with open(path, "w") as fh:
+        fh.writelines(r[2] for r in rows)
+    if rows[0][3] is not None:
+        with open(path + ".w", "w") as fh:
+            fh.writelines(r[3] for r in rows)
+
+def _read_run(path, k, weighted, sep):
+    lines = open(path)
+    wlines = open(path + ".w") if weighted else None
+    for i, line in enumerate(lines):
+        yield (probe_key(_probe(line, sep)), k, i, line,
+               next(wlines) if weighted else None)
+
+def _open_out(fname):
+    if fname.endswith((".gz", ".bgz")):
+        return BgzfWriter(fname)
+    return open(fname, "w")
+
+def sort_matrix(fname, out, weights=None, weights_out=None, sep="\t",
+                memory=MEMORY, tmp=None):
+    """
+    sort `fname` (and `weights` in the same order) to `out` (and
+    `weights_out`) using about `memory` MB for each run of rows. returns
+    the number of rows and the number of runs.
+    """
+    assert (weights is None) == (weights_out is None)
+    lines = _lines(fname)
+    wlines = _lines(weights) if weights is not None else None
+    header = next(lines)
+    wheader = next(wlines) if wlines is not None else None
+    rows = _rows(lines, wlines, fname, weights, sep)
+    limit = memory * (1 << 20)
+
+    tmp = tempfile.mkdtemp(dir=tmp or op.dirname(op.abspath(out)),
+                           suffix=".sort")
+    try:
+        runs, run, size, n = [], [], 0, 0
+        for row in rows:
+            run.append(row)
+            size += len(row[2]) + len(row[3] or "")
+            n += 1
+            if size >= limit:
+                run.sort()
+                runs.append(op.join(tmp, "%i.txt" % len(runs)))
+                _write_run(run, runs[-1])
+                run, size = [], 0
+        if runs and run:
+            run.sort()
+            runs.append(op.join(tmp, "%i.txt" % len(runs)))
+            _write_run(run, runs[-1])
+            run = []
+
+        if runs:
+            merged = heapq.merge(*[_read_run(p, k, weights is not None, sep)
+                                   for k, p in enumerate(runs)])
+        else:
+            run.sort()
+            merged = ((r[0], 0) + r[1:] for r in run)
+
+        fh = _open_out(out)
+        wfh = _open_out(weights_out) if weights_out is not None else None
+        fh.write(header)
+        if wfh is not None:
+            wfh.write(wheader)
+        for row in merged:
+            fh.write(row[3])
+            if wfh is not None:
+                wfh.write(row[4])
+        fh.close()
+        if wfh is not None:
+            wfh.close()
+    finally:
+        shutil.rmtree(tmp)
+    return n, max(len(runs), 1)
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    p = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--weights", help="weights matrix with the same rows")
+    p.add_argument("--out", required=True, help="sorted matrix")
+    p.add_argument("--weights-out", help="sorted weights matrix")
+    p.add_argument("--memory", type=int, default=MEMORY,
+                   help="MB of rows sorted in memory at once (default: "
+                   "%(default)s)")
+    p.add_argument("--tmp", help="directory for the sorted runs (default: "
+                   "that of --out)")
+    p.add_argument("--sep", default="\t", help="column separator")
+    p.add_argument("matrix", help="methylation matrix")
+    a = p.parse_args(argv)
+    if (a.weights is None) != (a.weights_out is None):
+        p.error("--weights and --weights-out go together")
+    n, runs = sort_matrix(a.matrix, a.out, a.weights, a.weights_out, a.sep,
+                          a.memory, a.tmp)
+    sys.stderr.write("sorted %i rows in %i run(s)\n" % (n, runs))
@@ -0,0 +1,251 @@
+"""
+write and query a tabix (.tbi) index for block-gzipped BED-like output so
+results can be queried by region without re-reading the whole file:
+
+    python -m clustermodel query results.bed.gz chr1:1-2000000
+
+The index is compatible with `tabix` from htslib (and pysam).
+"""
+import sys
+import re
+import struct
+from cStringIO import StringIO
+import pandas as pd
+
+from .bgzf import BgzfWriter, BgzfReader
+
+# htslib uses 14 bit (16kb) windows for the linear index.
+LINEAR_SHIFT = 14
+# UCSC (0-based, half-open) coordinates with chrom, start, end as col 1, 2, 3
+BED_PRESET = 0x10000
+
+def reg2bin(beg, end):
+    """
+    UCSC binning scheme used by tabix; `end` is exclusive.
+    >>> reg2bin(0, 1), reg2bin(0, 1 << 14), reg2bin(0, (1 << 14) + 1)
+    (4681, 4681, 585)
+    """
+    end -= 1
+    if beg >> 14 == end >> 14: return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17: return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20: return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23: return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26: return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+def reg2bins(beg, end):
+    """
+    all bins that may overlap [beg, end)
+    >>> reg2bins(0, 1)
+    [0, 1, 9, 73, 585, 4681]
+    """
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+class TabixIndex(object):
+    """
+    accumulate (chrom, start, end, virtual-offset) for each record in order
+    and write them as a .tbi index. `add` raises a ValueError if records are
+    not sorted.
+    """
+
+    def __init__(self):
+        self.chroms = []
+        # chrom => {bin: [[chunk_start, chunk_end], ...]}
+        self.bins = {}
+        # chrom => {window: min offset}
+        self.linear = {}
+        self._last = None
+
+    def add(self, chrom, start, end, voff_start, voff_end):
+        if chrom not in self.bins:
+            self.chroms.append(chrom)
+            self.bins[chrom] = {}
+            self.linear[chrom] = {}
+        elif self._last[0] != chrom:
+            raise ValueError("%s appeared again after %s; output must be "
+                             "sorted to index" % (chrom, self._last[0]))
+        elif start < self._last[1]:
+            raise ValueError("unsorted output at %s:%i after %s:%i" % (chrom,
+                             start, chrom, self._last[1]))
+        self._last = (chrom, start)
+        end = max(end, start + 1)
+
+        chunks = self.bins[chrom].setdefault(reg2bin(start, end), [])
+        if chunks and chunks[-1][1] == voff_start:
+            chunks[-1][1] = voff_end
+        else:
+            chunks.append([voff_start, voff_end])
+
+        linear = self.linear[chrom]
+        for w in range(start >> LINEAR_SHIFT, ((end - 1) >> LINEAR_SHIFT) + 1):
+            if w not in linear:
+                linear[w] = voff_start
+
+    def write(self, fname, voffset=None):
+        """
+        write the index to `fname`. if given, `voffset` is applied to each
+        offset that was added (e.g. to convert uncompressed offsets to
+        virtual offsets once the blocks are written).
+        """
+        if voffset is None:
+            voffset = lambda o: o
+        fh = BgzfWriter(fname, threaded=False)
+        names = "".join(c + "\0" for c in self.chroms)
+        fh.write("TBI\1")
+        # n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm
+        fh.write(struct.pack("<8i", len(self.chroms), BED_PRESET, 1, 2, 3,
+                             ord("#"), 0, len(names)))
+        fh.write(names)
+        for chrom in self.chroms:
+            bins = self.bins[chrom]
+            fh.write(struct.pack("<i", len(bins)))
+            for b in sorted(bins):
+                chunks = bins[b]
+                fh.write(struct.pack("<Ii", b, len(chunks)))
+                for c in chunks:
+                    fh.write(struct.pack("<2Q", voffset(c[0]), voffset(c[1])))
+            linear = self.linear[chrom]
+            n_intv = max(linear) + 1 if linear else 0
+            offsets, last = [], 0
+            for w in range(n_intv):
+                # htslib fills empty windows with the previous offset.
+                last = linear.get(w, last)
+                offsets.append(voffset(last))
+            fh.write(struct.pack("<i", n_intv))
+            fh.write(struct.pack("<%iQ" % n_intv, *offsets))
+        fh.close()
+
+
+def read_index(fname):
+    """
+    read a .tbi file. returns (meta, {chrom: (bins, linear)})
+    where bins is {bin: [(chunk_start, chunk_end), ...]}
+    """
+    data = "".join(BgzfReader(fname))
+    if data[:4] != "TBI\1":
+        raise ValueError("not a tabix index: %s" % fname)
+    (n_ref, fmt, col_seq, col_beg, col_end, meta, skip,
+            l_nm) = struct.unpack_from("<8i", data, 4)
+    off = 36
+    names = data[off:off + l_nm].rstrip("\0").split("\0")
+    off += l_nm
+    refs = {}
+    for name in names:
+        n_bin, = struct.unpack_from("<i", data, off)
+        off += 4
+        bins = {}
+        for _ in range(n_bin):
+            b, n_chunk = struct.unpack_from("<Ii", data, off)
+            off += 8
+            chunks = struct.unpack_from("<%iQ" % (2 * n_chunk), data, off)
+            off += 16 * n_chunk
+            bins[b] = zip(chunks[::2], chunks[1::2])
+        n_intv, = struct.unpack_from("<i", data, off)
+        off += 4
+        linear = struct.unpack_from("<%iQ" % n_intv, data, off)
+        off += 8 * n_intv
+        refs[name] = (bins, linear)
+    meta = dict(format=fmt, col_seq=col_seq, col_beg=col_beg,
+                col_end=col_end, meta=chr(meta), skip=skip)
+    return meta, refs
+
+
+def parse_region(region):
+    """
+    >>> parse_region('chr1:1-2,000,000')
+    ('chr1', 0, 2000000)
+    >>> parse_region('chr2')
+    ('chr2', 0, 536870912)
+    """
+    m = re.match(r"^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$", region)
+    if m is None:
+        raise ValueError("bad region: %s" % region)
+    chrom, start, end = m.groups()
+    start = int(start.replace(",", "")) - 1 if start else 0
+    end = int(end.replace(",", "")) if end else 1 << 29
+    return chrom, max(0, start), end
+
+
+def query(fname, region, index=None):
+    """
+    generate the lines (as lists of tokens) from the block-gzipped `fname`
+    that overlap `region` (e.g. chr1:1-2000000) using the tabix index at
+    `fname + '.tbi'`. Only the blocks that may contain overlapping records
+    are read.
+    """
+    chrom, start, end = parse_region(region)
+    meta, refs = index or read_index(fname + ".tbi")
+    if not chrom in refs: return
+    bins, linear = refs[chrom]
+    w = start >> LINEAR_SHIFT
+    min_off = linear[w] if w < len(linear) else (linear[-1] if linear else 0)
+
+    chunks = sorted(c for b in reg2bins(start, end) for c in bins.get(b, ())
+                    if c[1] > min_off)
+    # merge overlapping chunks so no line is reported twice.
+    merged = []
+    for c in chunks:
+        if merged and c[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], c[1])
+        else:
+            merged.append(list(c))
+
+    cs, bs, be = meta['col_seq'] - 1, meta['col_beg'] - 1, meta['col_end'] - 1
+    fh = BgzfReader(fname)
+    for cstart, cend in merged:
+        fh.seek(max(cstart, min_off))
+        while fh.tell() < cend:
+            line = fh.readline()
+            if not line: break
+            toks = line.rstrip("\r\n").split("\t")
+            if toks[0].startswith(meta['meta']): continue
+            if toks[cs] != chrom: break
+            s, e = int(toks[bs]), int(toks[be])
+            if s >= end: break
+            if max(e, s + 1) > start:
+                yield toks
+    fh.close()
+
+
+def header(fname):
+    "the column names from the first line of the output"
+    fh = BgzfReader(fname)
+    line = fh.readline()
+    fh.close()
+    return line.lstrip("#").rstrip("\r\n").split("\t")
+
+
+def query_frame(fname, region):
+    """
+    like `query` but returns a pandas.DataFrame with the header from the
+    output as column names.
+    """
+    columns = header(fname)
+    rows = list(query(fname, region))
+    s = StringIO("\n".join("\t".join(r) for r in rows))
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    return pd.read_table(s, header=None, names=columns)
+
+
+def main(argv=sys.argv[1:]):
+    import argparse
+    p = argparse.ArgumentParser(description="query block-gzipped output "
+                                "indexed with --index")
+    p.add_argument("--header", action="store_true",
+                   help="print the header line first")
+    p.add_argument("bed", help="output of clustermodel written with --index")
+    p.add_argument("regions", nargs="+", help="regions like chr1:1-2000000")
+    a = p.parse_args(argv)
+
+    index = read_index(a.bed + ".tbi")
+    if a.header:
+        print("#" + "\t".join(header(a.bed)))
+    for region in a.regions:
+        for toks in query(a.bed, region, index):
+            print("\t".join(toks))
@@ -1,31 +1,116 @@
-from nose.tools import assert_raises
-from clustermodel.__main__ import distX
+from nose.tools import assert_raises, assert_equal
+import pandas as pd
+from clustermodel.__main__ import distX_frame
 
 
-def test_distX():
+def _dist(start, end, strand, chrom='chrA', X_dist=None):
+    res = pd.DataFrame({'X': ['g'], 'chrom': ['chrA'], 'start': [start],
+                        'end': [end]})
+    X_locs = pd.DataFrame({'chrom': [chrom], 'start': [2], 'end': [3],
+                           'strand': [strand]}, index=['g'])
+    return distX_frame(res, X_locs, X_dist)
 
-    expr = {'chrom': 'chrA', 'start': 2, 'end': 3, 'strand': '+'}
 
+def test_distX():
     for strand in ('+', '-'):
-        dmr = {'chrom': 'chrA', 'start': 1, 'end': 2}
-        expr['strand'] = strand
-        distX(dmr, expr)
-        assert dmr['distance'] == 0, (dmr, expr)
-
-    for attr in 'start end strand'.split():
-        assert dmr['X' + attr] == expr[attr]
+        res = _dist(1, 2, strand)
+        assert res['distance'].tolist() == [0], res
+        for attr in 'start end strand'.split():
+            assert res['X' + attr].tolist() == [{'start': 2, 'end': 3,
+                                                 'strand': strand}[attr]]
 
 
 def test_distX_gt0():
-    dmr = {'chrom': 'chrA', 'start': 1, 'end': 2}
-    expr = {'chrom': 'chrA', 'start': 4, 'end': 5, 'strand': '+'}
+    # left of X is upstream (negative) on +; right of X is upstream on -.
+    assert_equal(_dist(-2, -1, '+')['distance'].tolist(), [-3])
+    assert_equal(_dist(-2, -1, '-')['distance'].tolist(), [3])
+    assert_equal(_dist(5, 6, '+')['distance'].tolist(), [2])
+    assert_equal(_dist(5, 6, '-')['distance'].tolist(), [-2])
 
-    for strand in ('+', '-'):
-        expr['strand'] = strand
-        distX(dmr, expr)
 
-        if strand == "+":
-            assert dmr['distance'] == -2
-        else:
-            assert dmr['distance'] == 2
+def test_distX_filter():
+    assert len(_dist(1, 2, '+', chrom='chrB')) == 0
+    assert len(_dist(50, 60, '+', X_dist=10)) == 0
+    assert len(_dist(5, 6, '+', X_dist=10)) == 1
+
+
+def test_X_permutation():
+    from clustermodel.clustermodel import X_permutation
+    a = X_permutation(20, 1)
+    assert sorted(a) == range(20)
+    assert (a == X_permutation(20, 1)).all()
+    assert not (a == X_permutation(20, 2)).all()
+
+
+def test_X_permute_requires_X():
+    import os
+    import sys
+    from clustermodel.__main__ import main
+    stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+    try:
+        assert_raises(SystemExit, main, ["methylation ~ disease", "covs.txt",
+                                         "meth.txt", "--X-permute-seed", "1"])
+    finally:
+        sys.stderr = stderr
+
+
+class _R(object):
+    "records what is sent to R for an X of 41 samples"
+    def __init__(self):
+        self.sent = {}
+        self.calls = []
+    def __call__(self, expr):
+        self.calls.append(expr)
+    def __getitem__(self, expr):
+        assert expr == 'ncol(Xfull)', expr
+        return 41
+    def __setitem__(self, name, value):
+        self.sent[name] = value
+
+
+def test_X_permute_one_pass():
+    # with 2 seeds, each batch is sent once and the results of both
+    # permutations come back sorted by location, in seed order for each
+    # cluster.
+    import os.path as op
+    import numpy as np
+    import pandas as pd
+    from itertools import islice
+    from aclust import mclust
+    from clustermodel import __main__ as cm, feature_gen
+    HERE = op.dirname(__file__)
+    calls = []
+
+    def run_model(clusters, covs, model, X, outlier_sds, *args, **kwargs):
+        calls.append((X, outlier_sds, kwargs.get('X_perms')))
+        # R returns all the clusters for the first permutation, then the
+        # second.
+        n = len(clusters)
+        return pd.DataFrame({'chrom': np.tile(clusters.chrom, 2),
+                             'start': np.tile(clusters.start, 2),
+                             'cluster_id': np.tile(np.arange(1, n + 1), 2),
+                             'X_permute_i': np.repeat([1, 2], n),
+                             'p': 0.5})
 
+    fake_r = _R()
+    orig = cm.run_model, cm.r
+    cm.run_model, cm.r = run_model, fake_r
+    try:
+        features = feature_gen(op.join(HERE, "example-methylation.txt.gz"))
+        clusters = list(islice(mclust(features, max_dist=400), 20))
+        res = list(cm.clustermodelgen(
+            op.join(HERE, "example-covariates.txt"), iter(clusters),
+            "methylation ~ disease", X="expr.txt", outlier_sds=3,
+            frames=True, X_permute=[7, 3]))
+    finally:
+        cm.run_model, cm.r = orig
+    assert_equal(sorted(fake_r.sent), ['XXperm0', 'XXperm1'])
+    assert_equal(sorted(fake_r.sent['XXperm0']), range(1, 42))
+    assert 'XXperms = list(XXperm0, XXperm1)' in fake_r.calls
+    assert len(calls) == len(res) > 0
+    for X, sds, X_perms in calls:
+        assert_equal((X, sds, X_perms), ('Xfull', 3, 'XXperms'))
+    for df in res:
+        assert_equal(list(df['start']), sorted(df['start']))
+        assert_equal(list(df['X_permute_seed']), [7, 3] * (len(df) // 2))
+        assert 'X_permute_i' not in df.columns
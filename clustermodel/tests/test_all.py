@@ -1,5 +1,10 @@
+import tempfile
+import numpy as np
 from nose.tools import assert_raises
-from clustermodel import ClusterFeature
+from clustermodel import ClusterFeature, SparseFeature, ClusterBatch, \
+        feature_gen
+from clustermodel.send_bin import send_sparse_arrays, send_arrays, \
+        missing_fraction
 
 
 def test_cluster_feature():
@@ -33,5 +38,138 @@ def test_cluster_corr():
     assert not c1.is_correlated(c2)
 
 
+def test_sparse_feature():
+    c = SparseFeature('chr1', 1, 2, np.array([0, 2, 3]), np.arange(3.), 5,
+                      weights=np.array([4., 5, 6]))
+    assert np.allclose(c.values, [0, np.nan, 1, 2, np.nan], equal_nan=True)
+    assert np.allclose(c.weights, [4, 0, 5, 6, 0])
+    assert c.distance(ClusterFeature('chr1', 5, 6, range(5))) == 3
+
+def test_sparse_corr():
+    # only samples with values at both features are used.
+    idx = np.arange(0, 20, 2)
+    c1 = SparseFeature('chr1', 1, 2, idx, np.arange(10.), 30)
+    c2 = SparseFeature('chr1', 3, 4, np.arange(12), np.arange(12.)[::-1], 30)
+    c3 = SparseFeature('chr1', 3, 4, np.arange(20), np.arange(20.), 30)
+    assert c1.is_correlated(c3)
+    assert not c1.is_correlated(c2)
+    # too few shared samples
+    c4 = SparseFeature('chr1', 3, 4, np.arange(1, 9, 2), np.arange(4.), 30)
+    assert not c3.is_correlated(c4)
+
+def test_sparse_feature_gen():
+    fm = tempfile.NamedTemporaryFile(suffix=".txt")
+    fw = tempfile.NamedTemporaryFile(suffix=".txt")
+    fm.write("probe\ta\tb\tc\nchr1:10\t0.5\t\t1\nchr1:20\t\t\t0.25\n")
+    fw.write("probe\ta\tb\tc\nchr1:10\t2\t0\t0\nchr1:20\t0\t0\t4\n")
+    fm.flush(); fw.flush()
+    dense = list(feature_gen(fm.name, weights=fw.name))
+    sparse = list(feature_gen(fm.name, weights=fw.name, sparse=True))
+    # the value of c at chr1:10 has weight 0 so it's dropped.
+    assert sparse[0].idx.tolist() == [0]
+    for d, s in zip(dense, sparse):
+        assert (d.group, d.start, d.end) == (s.group, s.start, s.end)
+        assert np.allclose(d.weights, s.weights)
+    db = ClusterBatch.from_clusters([dense])
+    sb = ClusterBatch.from_clusters([sparse])
+    assert np.allclose(db.weights, sb.weights)
+    assert np.allclose(sb.values, [[0.5, np.nan, np.nan], [np.nan, np.nan, 0.25]],
+                       equal_nan=True)
+
+def test_send_sparse():
+    a = np.array([[np.nan, 1, np.nan], [np.nan, np.nan, 2.5]])
+    assert missing_fraction([a, a[:1]], np.nan) == 6 / 9.
+    fh = tempfile.TemporaryFile()
+    send_sparse_arrays([a], fh)
+    fh.seek(0)
+    # tag, size of values, sparse, number of matrices
+    assert np.fromfile(fh, np.int64, 4).tolist() == [-1, 8, 1, 1]
+    shape = np.fromfile(fh, np.int64, 3)
+    assert shape.tolist() == [3, 2, 2]
+    idx = np.fromfile(fh, np.int32, 2)
+    vals = np.fromfile(fh, np.float64, 2)
+    # same layout as send_array (the transpose, flattened).
+    flat = np.empty(6)
+    flat.fill(np.nan)
+    flat[idx] = vals
+    assert np.allclose(flat.reshape(3, 2).T, a, equal_nan=True)
+
+
+def test_send_float32():
+    a = np.arange(6.).reshape(2, 3)
+    fh = tempfile.TemporaryFile()
+    send_arrays([a], fh)
+    fh.seek(0)
+    # untagged for read.bin
+    assert np.fromfile(fh, np.int64, 3).tolist() == [1, 3, 2]
+    send_arrays([a.astype(np.float32)], fh, np.float32)
+    fh.seek(0)
+    assert np.fromfile(fh, np.int64, 6).tolist() == [-1, 4, 0, 1, 3, 2]
+    assert np.allclose(np.fromfile(fh, np.float32, 6).reshape(3, 2).T, a)
+
+def test_read_tagged_bin():
+    # the tagged formats read in R as the same matrices as read.bin.
+    from clustermodel.clustermodel import r
+    a = np.array([[np.nan, 1, 0.5], [np.nan, 0.25, 2.5]])
+    arrays = [a, a[:1], np.arange(8.).reshape(4, 2)]
+    names = []
+    for i, (send, dtype) in enumerate(((send_arrays, np.float64),
+                                       (send_arrays, np.float32),
+                                       (send_sparse_arrays, np.float64),
+                                       (send_sparse_arrays, np.float32))):
+        fh = tempfile.NamedTemporaryFile(suffix=".bin")
+        send(arrays, fh, dtype=dtype)
+        names.append(fh)
+        r('tagged%i = read.tagged.bin("%s")' % (i, fh.name))
+    assert r['identical(tagged0, read.bin("%s"))' % names[0].name]
+    for i in range(1, 4):
+        assert r['isTRUE(all.equal(tagged0, tagged%i, tolerance=1e-6))' % i], i
+    assert r['all(dim(tagged0[[1]]) == c(3, 2))']
+
+def test_float32_features():
+    fm = tempfile.NamedTemporaryFile(suffix=".txt")
+    fm.write("probe\ta\tb\tc\nchr1:10\t0.5\t\t1\nchr1:20\t0.1\t0.2\t0.25\n")
+    fm.flush()
+    for sparse in (False, True):
+        fs = list(feature_gen(fm.name, sparse=sparse, dtype=np.float32))
+        assert fs[0].values.dtype == np.float32
+        b = ClusterBatch.from_clusters([fs])
+        assert b.values.dtype == np.float32
+        assert np.allclose(b.values[1], [0.1, 0.2, 0.25])
+    assert ClusterBatch.from_clusters([list(feature_gen(fm.name))]).values.dtype \
+            == np.float64
+
+
 def check_equal(a, b, msg=None):
     assert a == b, msg
+
+def test_sparse_batch():
+    # a batch of sparse features is kept sparse: each cluster is made dense
+    # as it is used and outliers are masked as in the dense batch.
+    from clustermodel.feature import ClusterArrays, feature_arrays
+    from clustermodel.clustermodel import mask_outliers, mask_sparse_outliers
+    np.random.seed(3)
+    n = 30
+    clusters = []
+    for i in range(4):
+        c = []
+        for j in range(3):
+            idx = np.sort(np.random.choice(n, 20, replace=False)).astype(np.int32)
+            data = np.random.normal(size=len(idx))
+            data[0] = 8
+            c.append(SparseFeature('chr1', 10 * (3 * i + j), 10 * (3 * i + j) + 1,
+                                   idx, data, n, weights=data ** 2 + 1))
+        clusters.append(c)
+    sb = ClusterBatch.from_clusters(clusters)
+    db = ClusterBatch(*feature_arrays([f for c in clusters for f in c]) +
+                      (sb.offsets, sb.chrom, sb.start, sb.end, sb.pos))
+    assert sb.n_samples == n and sb.has_weights
+    for w in (False, True):
+        sa, da = sb.arrays(weights=w), db.arrays(weights=w)
+        assert isinstance(sa, ClusterArrays) and len(sa) == len(da) == 4
+        for s, d in zip(sa, da):
+            assert np.allclose(s, d, equal_nan=True)
+    assert np.allclose(sb.to_dataframe(2, weights=True), db.to_dataframe(2,
+                       weights=True))
+    assert mask_sparse_outliers(sb.sparse, 2) == mask_outliers(db.values, 2) > 0
+    assert np.allclose(sb.values, db.values, equal_nan=True)
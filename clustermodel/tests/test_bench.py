@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+import pandas as pd
+from clustermodel import bench, feature_gen
+
+
+def test_make_data():
+    d = tempfile.mkdtemp()
+    try:
+        files = bench.make_data(d + "/b", 400, 10, seed=1)
+        meth = pd.read_table(files['meth'], index_col=0)
+        assert meth.shape == (400, 10)
+        covs = pd.read_table(files['covs'], index_col=0)
+        assert list(covs.index) == list(meth.columns)
+        ratio = pd.read_table(files['ratio'], index_col=0)
+        assert ((ratio.values >= 0) & (ratio.values <= 1)).all()
+        assert len(list(feature_gen(files['meth']))) == 400
+
+        # same seed gives the same data and existing files are re-used.
+        again = bench.make_data(d + "/c", 400, 10, seed=1)
+        assert open(again['meth']).read() == open(files['meth']).read()
+    finally:
+        shutil.rmtree(d)
+
+def test_compare():
+    old = [dict(step='liptak', n_probes=2000, n_samples=80, per_second=100.,
+                maxrss_mb=100., unit='clusters', error=None),
+           dict(step='parse', n_probes=2000, n_samples=80, per_second=1000.,
+                maxrss_mb=100., unit='probes', error=None)]
+    new = [dict(old[0], per_second=90.), dict(old[1], per_second=500.)]
+    problems = bench.compare(old, new, 0.25)
+    assert len(problems) == 1 and problems[0].startswith('parse'), problems
+
+    new = [dict(old[0], maxrss_mb=200.)]
+    assert len(bench.compare(old, new, 0.25)) == 1
+    assert bench.compare(old, [dict(old[0], error='x', per_second=None)]) == []
@@ -0,0 +1,60 @@
+import gzip
+import os.path as op
+import tempfile
+from nose.tools import assert_equal
+from clustermodel import bgzf, feature_gen
+
+HERE = op.dirname(__file__)
+METH = op.join(HERE, "example-methylation.txt.gz")
+
+def test_bgzip():
+    # the converted file reads the same, by blocks on threads or with gzip.
+    text = gzip.open(METH).read()
+    out = tempfile.mktemp(suffix=".bgz")
+    assert_equal(bgzf.bgzip(METH, out, threads=2, chunk_blocks=3), len(text))
+    assert bgzf.is_bgzf(out) and not bgzf.is_bgzf(METH)
+    assert_equal(open(out, 'rb').read()[-len(bgzf.EOF_BLOCK):], bgzf.EOF_BLOCK)
+    assert_equal(gzip.open(out).read(), text)
+    for threads in (1, 3):
+        assert_equal("".join(bgzf.open_input(out, threads)), text)
+    fh = bgzf.open_input(out)
+    assert_equal(fh.readline(), text[:text.index("\n") + 1])
+    assert_equal(fh.read(10), text[text.index("\n") + 1:][:10])
+
+    a = [(f.group, f.start, list(f.values)) for f in feature_gen(METH)]
+    b = [(f.group, f.start, list(f.values)) for f in feature_gen(out)]
+    assert_equal(a, b)
+
+def test_gzip_members():
+    # concatenated gzip members (as from meth-matrix) are all read.
+    text = gzip.open(METH).read()
+    out = tempfile.mktemp(suffix=".gz")
+    with open(out, 'wb') as fh:
+        fh.write(open(METH, 'rb').read() * 2)
+    lines = list(bgzf.open_input(out))
+    assert_equal("".join(lines), text * 2)
+    assert all(l.endswith("\n") for l in lines)
+
+def test_line_reader():
+    r = bgzf.LineReader(["a\nb", "", "c\n", "d"])
+    assert_equal(list(r), ["a\n", "bc\n", "d"])
+    r = bgzf.LineReader(["ab\ncd", "e\nf\n", "gh"])
+    assert_equal(r.read(1), "a")
+    assert_equal(r.readline(), "b\n")
+    assert_equal(r.read(4), "cde\n")
+    assert_equal(r.next(), "f\n")
+    assert_equal(r.read(), "gh")
+    assert_equal(r.readline(), "")
+
+def test_gzip_chunks_bounded():
+    # each chunk is at most `size` however well the data compress and
+    # members that end exactly at the end of a read are followed.
+    member = open(METH, 'rb').read()
+    text = gzip.open(METH).read()
+    out = tempfile.mktemp(suffix=".gz")
+    with open(out, 'wb') as fh:
+        fh.write(member * 3)
+    for size in (len(member), 4096):
+        chunks = list(bgzf.gzip_chunks(open(out, 'rb'), size=size))
+        assert max(len(c) for c in chunks) <= size
+        assert_equal("".join(chunks), text * 3)
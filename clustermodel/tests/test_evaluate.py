@@ -0,0 +1,47 @@
+import os
+import time
+import tempfile
+import os.path as op
+import numpy as np
+import pandas as pd
+from nose.tools import assert_equal
+from clustermodel import evaluate
+from clustermodel.output import open_writer, result_columns
+
+def _simulation(d, n=500):
+    rng = np.random.RandomState(42)
+    starts = np.arange(n) * 1000
+    with open(op.join(d, "sim.clusters.txt"), "w") as fh:
+        fh.write("chrom\tstart\tend\tw\tprobes\n")
+        for s in starts[::2]:
+            fh.write("chr1\t%i\t%i\t0.8\tx\n" % (s, s + 100))
+    res = pd.DataFrame({'chrom': 'chr1', 'start': starts + 50,
+                        'end': starts + 200, 'coef': 0.1,
+                        'p': 10 ** -rng.uniform(0, 8, n), 'icoef': 0,
+                        'n_probes': rng.randint(2, 6, n),
+                        'model': 'm', 'covariate': 'c', 'method': 'x'})
+    os.makedirs(op.join(d, "real"))
+    for name in ("real/a.sim.covs.pvals.bed", "real/b.sim.covs.pvals.npz",
+                 "real/c.sim.covs.pvals.bgz"):
+        w = open_writer(op.join(d, name), result_columns())
+        w.write(res)
+        w.close()
+    return res
+
+def test_summarize():
+    d = tempfile.mkdtemp()
+    res = _simulation(d)
+    df = evaluate.summarize([d])
+    assert_equal(sorted(set(df['method'])), ['a', 'b', 'c'])
+    true = (np.arange(len(res)) % 2) == 0
+    for _, row in df.iterrows():
+        sel = (res['p'] <= row['cutoff']) & (res['n_probes'] == row['n_probes'])
+        assert_equal((row['tp'], row['fp']), ((sel & true).sum(),
+                                              (sel & ~true).sum()))
+    # the tables are cached and re-used.
+    cache = op.join(d, "real", "a.sim.covs.pvals.bed.summary.txt")
+    mtime = op.getmtime(cache)
+    time.sleep(0.01)
+    again = evaluate.summarize([d])
+    assert_equal(op.getmtime(cache), mtime)
+    assert (again[['tp', 'fp']].values == df[['tp', 'fp']].values).all()
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import tempfile
+import os.path as op
+from nose.tools import assert_equal
+from clustermodel import grid
+
+SPEC = {"model": "methylation ~ disease",
+        "data": [{"covs": "d/covs.txt", "meth": "d/meth.txt", "out": "res"}],
+        "X": "expr.txt.gz", "X_locs": "locs.bed", "outlier_sds": [0, 3],
+        "cores": 4, "X_permute_seeds": [1, 2],
+        "methods": {"gee": {"args": "--gee-args ar,id"},
+                    "both": {"model": "+ (1|CpG) + (1|id)", "cores": 2},
+                    "bumping": {"args": "--bumping", "outlier_sds": [30]}}}
+
+def test_runs():
+    runs = grid.runs(SPEC)
+    # (2 methods * 2 sds + bumping) * real and shuffled X
+    assert_equal(len(runs), 10)
+    outs = set(r["out"] for r in runs)
+    assert "res/shuffled/gee-sds_3.covs.pvals.bed" in outs
+    assert "res/real/bumping-sds_30.covs.pvals.bed" in outs
+    both = [r for r in runs if r["name"] == "both-sds_0"
+            and r["X"] == "shuffled"][0]
+    assert_equal(both["cores"], 2)
+    assert_equal(both["cmd"][3], "methylation ~ disease + (1|CpG) + (1|id)")
+    assert_equal(both["cmd"][-7:], ["--X", "expr.txt.gz", "--X-permute-seed",
+                                    "1", "2", "--X-locs", "locs.bed"])
+    real = [r for r in runs if r["name"] == "both-sds_0" and r["X"] == "real"][0]
+    assert "--X-permute-seed" not in real["cmd"]
+
+def _run(name, out, cores, code=0):
+    # writes its --out (the last argument) and exits with `code`.
+    script = ("import sys, time; time.sleep(0.3); "
+              "open(sys.argv[-1], 'w').write('x'); sys.exit(%i)" % code)
+    return dict(name=name, out=out, cores=cores,
+                cmd=[sys.executable, "-c", script])
+
+def test_run_grid():
+    d = tempfile.mkdtemp()
+    manifest = op.join(d, "manifest.json")
+    runs = [_run("a", op.join(d, "a.bed"), 2), _run("b", op.join(d, "b.bed"), 2),
+            _run("c", op.join(d, "c.bed"), 8, code=1)]
+    out = open(os.devnull, "w")
+    res = grid.run_grid(runs, 3, manifest, poll=0.05, out=out)
+    assert_equal([r["status"] for r in res], ["done", "done", "failed"])
+    # a and b take 2 of the 3 cpus so they did not run together.
+    a, b = res[0], res[1]
+    assert abs(a["start"] - b["start"]) >= 0.3, (a["start"], b["start"])
+    assert not op.exists(op.join(d, "c.bed"))
+    saved = json.load(open(manifest))
+    assert_equal(saved["cpus"], 3)
+    assert all(r["seconds"] > 0.25 for r in saved["runs"])
+
+    res = grid.run_grid([_run("a", op.join(d, "a.bed"), 2)], 3, manifest,
+                        poll=0.05, out=out)
+    assert_equal(res[0]["status"], "skipped")
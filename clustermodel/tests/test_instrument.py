@@ -0,0 +1,106 @@
+import json
+import time
+import tempfile
+import pandas as pd
+from cStringIO import StringIO
+from clustermodel import instrument
+
+
+def test_disabled():
+    prof = instrument.Profiler(enabled=False)
+    items = [1, 2, 3]
+    assert prof.timed('parse', items) is items
+    with prof.stage('R'):
+        pass
+    prof.add('clusters', 10)
+    assert prof.report()['stages'] == {}
+    assert prof.report()['counters'] == {}
+
+def test_exclusive_stages():
+    prof = instrument.Profiler(enabled=True)
+
+    def slow_gen():
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+
+    with prof.stage('cluster'):
+        assert list(prof.timed('parse', slow_gen())) == [0, 1, 2]
+    stages = prof.report()['stages']
+    # 3 items + the final StopIteration
+    assert stages['parse']['calls'] == 4
+    assert stages['parse']['seconds'] >= 0.03
+    assert stages['cluster']['seconds'] < stages['parse']['seconds']
+
+def test_fits_and_progress():
+    out = StringIO()
+    prof = instrument.Profiler(enabled=True, progress=0, total=20, out=out)
+    for i in range(10):
+        prof.fit('liptak', 3, 0.02)
+    prof.fit('lm', 1, 500)
+    prof.add('clusters', 10)
+    assert "ETA" in out.getvalue()
+
+    rep = json.loads(json.dumps(prof.report()))
+    liptak = rep['fit_latency']['liptak']['3']
+    assert liptak['n'] == 10
+    assert sum(liptak['counts']) == 10
+    assert rep['fit_latency']['lm']['1']['counts'][-1] == 1
+    assert rep['counters']['clusters'] == 10
+
+def test_enable():
+    prof = instrument.enable()
+    assert instrument.get_profiler() is prof and prof.enabled
+    instrument.disable()
+    assert not instrument.get_profiler().enabled
+
+def test_trace():
+    res = pd.DataFrame({'chrom': ['chr1'] * 3 + ['chr2'],
+        'start': [10, 10, 500, 20], 'end': [40, 40, 600, 30],
+        'p': [0.1, 0.1, 0.5, 1e-5], 'n_probes': [2, 2, 3, 1],
+        'method': ['liptak', 'liptak', 'liptak', 'lm'],
+        'r_start': [1e9, 1e9, 1e9 + 0.5, 1e9 + 1], 'r_wall': [0.5, 0.5, 0.1, 2.],
+        'r_cpu': [0.4, 0.4, 0.1, 1.9], 'r_pid': [101, 101, 102, 101]})
+    with tempfile.NamedTemporaryFile(suffix='.json') as fh:
+        trace = instrument.TraceWriter(fh.name)
+        trace.add_clusters(res)
+        trace.add_clusters(res[:0])
+        trace.close()
+        events = json.load(open(fh.name))
+    # metadata event + 1 for each cluster
+    assert len(events) == 4, events
+    ev = events[-1]
+    assert ev['name'] == 'chr2:20-30' and ev['cat'] == 'lm'
+    assert ev['tid'] == 101 and ev['dur'] == 2e6 and ev['ph'] == 'X'
+
+def test_fit_latency_from_results():
+    # the histogram has the time of each fit when the results have one and
+    # is empty for batches fit in a single call to R.
+    import os.path as op
+    import numpy as np
+    from itertools import islice
+    from aclust import mclust
+    from clustermodel import __main__ as cm, feature_gen
+    HERE = op.dirname(__file__)
+    features = feature_gen(op.join(HERE, "example-methylation.txt.gz"))
+    clusters = list(islice(mclust(features, max_dist=400), 20))
+
+    def fit_latency(columns):
+        def run_model(clusters, *args, **kwargs):
+            n = len(clusters)
+            return pd.DataFrame(dict((c, np.arange(1, n + 1)) for c in columns))
+        orig = cm.run_model
+        cm.run_model = run_model
+        prof = instrument.enable()
+        try:
+            list(cm.clustermodelgen(op.join(HERE, "example-covariates.txt"),
+                                    iter(clusters), "methylation ~ disease",
+                                    combine='liptak', frames=True))
+            return prof.report()['fit_latency']
+        finally:
+            cm.run_model = orig
+            instrument.disable()
+
+    fits = fit_latency(['cluster_id', 'r_wall'])
+    assert sum(f['n'] for m in fits.values() for f in m.values()) == 20
+    assert fit_latency(['cluster_id']) == {}
@@ -0,0 +1,87 @@
+import os.path as op
+import gzip
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from nose.tools import assert_equal
+from clustermodel import methmatrix
+
+# chrom, start, end, percent, methylated, unmethylated
+SAMPLES = {
+    'a': [('chr1', 10, 11, 50, 1, 1), ('chr1', 20, 21, 0, 0, 4),
+          ('chr2', 5, 6, 100, 3, 0)],
+    'b': [('chr1', 20, 21, 25, 1, 3), ('chr1', 10, 11, 0, 0, 2),
+          ('chr1', 30, 31, 100, 2, 0), ('chr2', 5, 6, 0, 0, 0)],
+    'c': [('chr1', 30, 31, 50, 2, 2), ('chr2', 5, 6, 50, 1, 1)],
+}
+
+def write_samples(d):
+    fnames = []
+    for name in sorted(SAMPLES):
+        fname = op.join(d, "%s.methylation.txt" % name)
+        with open(fname, "w") as fh:
+            fh.write("chrom\tstart\tend\tpct\tmeth\tunmeth\n")
+            for row in SAMPLES[name]:
+                fh.write("\t".join(map(str, row)) + "\n")
+        fnames.append(fname)
+    return fnames
+
+def test_meth_matrix():
+    d = tempfile.mkdtemp()
+    try:
+        fnames = write_samples(d)
+        for procs, window in ((1, 2000000), (2, 15)):
+            prefix = op.join(d, "out%i/" % procs)
+            store = op.join(d, "store%i" % procs)
+            n = methmatrix.meth_matrix(fnames, prefix, min_samples=2,
+                                       procs=procs, window=window, store=store)
+            yield check_meth_matrix, prefix, store, n
+    finally:
+        shutil.rmtree(d)
+
+def check_meth_matrix(prefix, store, n):
+    # chr2:5 is only covered in 2 samples; every site is kept.
+    assert_equal(n, 4)
+    meth = pd.read_table(prefix + "methylation.txt.gz", index_col=0)
+    counts = pd.read_table(prefix + "counts.txt.gz", index_col=0)
+    methylated = pd.read_table(prefix + "methylated.txt.gz", index_col=0)
+    assert_equal(list(meth.columns), ['a', 'b', 'c'])
+    assert_equal(list(meth.index), ['chr1:10', 'chr1:20', 'chr1:30', 'chr2:5'])
+    assert_equal(counts.values.tolist(),
+                 [[2, 2, 0], [4, 4, 0], [0, 2, 4], [3, 0, 2]])
+    assert_equal(methylated.values.tolist(),
+                 [[1, 0, 0], [0, 1, 0], [0, 2, 2], [3, 0, 1]])
+    assert np.allclose(meth.values, methylated.values / counts.values.astype(float),
+                       equal_nan=True)
+
+    blocks = list(methmatrix.read_store(store, 'counts'))
+    assert_equal([b[0] for b in blocks], sorted(b[0] for b in blocks))
+    assert_equal(np.concatenate([b[2] for b in blocks]).tolist(),
+                 counts.values.tolist())
+    pos = np.concatenate([b[1] for b in blocks])
+    assert_equal(pos.tolist(), [10, 20, 30, 5])
+
+def test_min_samples():
+    d = tempfile.mkdtemp()
+    try:
+        fnames = write_samples(d)
+        n = methmatrix.meth_matrix(fnames, op.join(d, "x."), min_samples=3)
+        assert_equal(n, 0)
+        n = methmatrix.meth_matrix(fnames[:1], op.join(d, "y."), min_samples=1)
+        assert_equal(n, 3)
+        # sites not covered in any sample are not written.
+        n = methmatrix.meth_matrix(fnames[1:2], op.join(d, "z."), min_samples=1)
+        assert_equal(n, 3)
+    finally:
+        shutil.rmtree(d)
+
+def test_merge_window():
+    a = (np.array([5, 10, 20], dtype=np.int32),
+         np.array([[1, 2], [0, 3], [4, 4]], dtype=np.int32))
+    b = (np.array([10, 15], dtype=np.int32),
+         np.array([[2, 2], [1, 5]], dtype=np.int32))
+    pos, meth, total = methmatrix.merge_window([a, None, b], 10, 20)
+    assert_equal(pos.tolist(), [10, 15])
+    assert_equal(meth.tolist(), [[0, 0, 2], [0, 0, 1]])
+    assert_equal(total.tolist(), [[3, 0, 2], [0, 0, 5]])
@@ -1,4 +1,4 @@
-from clustermodel.clustermodel import clustered_model
+from clustermodel.clustermodel import clustered_model, set_outlier_nan, mask_batch
 from clustermodel.__main__ import fix_name
 import os.path as op
 import pandas as pd
@@ -172,6 +172,19 @@ def test_weighted_model():
     #yield check_weight_m, covs, meth, weights, model, {'bumping': True}
 
 
+def test_timing():
+    covs, meth = _make_data(1.0)
+    meths = [meth, meth.ix[:3, :], meth.ix[:1, :]]
+    model = "methylation ~ disease"
+    res = clustered_model(covs, meths, model, combine='liptak')
+    rest = clustered_model(covs, meths, model, combine='liptak', timing=True)
+    assert list(rest['cluster_id']) == [1, 2, 3], rest['cluster_id']
+    assert np.allclose(rest['p'], res['p'])
+    for k in 'r_start r_wall r_cpu r_pid'.split():
+        assert k in rest, k
+    assert (rest['r_wall'] >= 0).all()
+
+
 def check_weight_m(covs, meth, weights, model, kwargs):
 
     res = clustered_model(covs, meth, model, **kwargs)
@@ -191,6 +204,20 @@ def check_weight_m(covs, meth, weights, model, kwargs):
 
 
 
+def test_outliers():
+    meth = pd.read_csv(op.join(HERE, "example-meth.csv"), index_col=0).T
+    meth.ix[1, 3] = 100.0
+    meths, n = mask_batch([meth, meth.ix[1, :]], 4)
+    assert n == 2, n
+    assert meths[0].shape == meth.shape and meths[1].shape == meth.ix[1].shape
+    assert np.isnan(meths[0][1, 3]) and np.isnan(meths[1][3])
+    assert np.isnan(meths[0]).sum() == 1
+
+    # in-place on a DataFrame
+    assert set_outlier_nan(meth, 4) == 1
+    assert np.isnan(meth.ix[1, 3])
+    assert set_outlier_nan(meth, 4) == 0
+
 def check_clustered(r, model):
     assert 'p' in r
     assert 'coef' in r
@@ -201,3 +228,24 @@ def check_clustered(r, model):
 def check_clustered_df(df, model, exp):
     for gene, (i, row) in zip(exp.index, df.iterrows()):
         assert row['X'] == fix_name(gene)
+
+def test_cluster_batch():
+    from itertools import islice
+    from aclust import mclust
+    from clustermodel import feature_gen, cluster_to_dataframe
+    from clustermodel.feature import batches
+    features = feature_gen(op.join(HERE, "example-methylation.txt.gz"))
+    clusters = list(islice(mclust(features, max_dist=400), 25))
+    bs = list(batches(iter(clusters), 10))
+    assert [len(b) for b in bs] == [10, 10, 5]
+    b = bs[1]
+    assert list(b.sizes) == [len(c) for c in clusters[10:20]]
+    for i, (c, m) in enumerate(zip(clusters[10:20], b.arrays())):
+        # views of the batch matrix.
+        assert m.base is b.values
+        df = cluster_to_dataframe(c)
+        assert np.allclose(m, df.values)
+        assert list(b.to_dataframe(i).index) == list(df.index)
+        assert (b.chrom[i], b.start[i], b.end[i]) == (c[0].group, c[0].start,
+                                                       c[-1].end)
+    assert b.arrays(weights=True) is None
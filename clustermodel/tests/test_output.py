@@ -0,0 +1,122 @@
+import gzip
+import tempfile
+import numpy as np
+import pandas as pd
+from nose.tools import assert_raises
+from clustermodel.output import open_writer, result_columns, read_npz, \
+        NpzWriter, BgzfBedWriter
+from clustermodel.bgzf import EOF_BLOCK
+from clustermodel.tabix import query, query_frame
+
+
+def _make_res(n=10):
+    return pd.DataFrame({'chrom': ['chr1'] * n, 'start': np.arange(n) * 10,
+        'end': np.arange(n) * 10 + 5, 'coef': np.linspace(-1, 1, n) / 3.,
+        'p': np.linspace(0, 1, n), 'icoef': np.zeros(n),
+        'n_probes': np.arange(n) + 1, 'model': ['methylation ~ disease'] * n,
+        'covariate': ['diseaseTRUE'] * n, 'method': ['liptak'] * n,
+        'extra': np.arange(n)})
+
+def _check_rows(lines, res, columns):
+    assert len(lines) == len(res)
+    fmt = "\t".join("{%s}" % c for c in columns)
+    for line, (_, row) in zip(lines, res.iterrows()):
+        expected = fmt.format(**dict(row)).split("\t")
+        for val, exp in zip(line.split("\t"), expected):
+            try:
+                assert float(val) == float(exp) or (np.isnan(float(val))
+                        and np.isnan(float(exp))), (val, exp)
+            except ValueError:
+                assert val == exp, (val, exp)
+
+def test_text_matches_format():
+    res = _make_res()
+    res.ix[3, 'p'] = np.nan
+    columns = result_columns()
+    with tempfile.NamedTemporaryFile(suffix='.bed') as fh:
+        w = open_writer(fh.name, columns)
+        w.write(res)
+        w.close()
+        lines = open(fh.name).read().rstrip("\n").split("\n")
+    assert lines[0] == "#" + "\t".join(columns)
+    _check_rows(lines[1:], res, columns)
+
+def test_bgzf():
+    res = pd.concat([_make_res(5000)] * 4, ignore_index=True)
+    columns = result_columns()
+    with tempfile.NamedTemporaryFile(suffix='.bed.gz') as fh:
+        w = open_writer(fh.name, columns)
+        assert isinstance(w, BgzfBedWriter)
+        for i in range(0, len(res), 1000):
+            w.write(res[i:i + 1000])
+        w.close()
+        assert len(w.bgzf.block_offsets) > 1
+        raw = open(fh.name, 'rb').read()
+        lines = gzip.open(fh.name).read().rstrip("\n").split("\n")
+    assert raw.endswith(EOF_BLOCK)
+    _check_rows(lines[1:], res, columns)
+
+def test_npz():
+    res = _make_res()
+    columns = result_columns()
+    with tempfile.NamedTemporaryFile(suffix='.npz') as fh:
+        w = open_writer(fh.name, columns)
+        assert isinstance(w, NpzWriter)
+        w.write(res[:4])
+        w.write(res[4:])
+        w.close()
+        df = read_npz(fh.name)
+        # each chunk is its own array in the archive.
+        assert 'p.1' in np.load(fh.name).files
+    assert list(df.columns) == columns
+    assert np.allclose(df['p'], res['p'])
+    assert list(df['model']) == list(res['model'])
+
+    with tempfile.NamedTemporaryFile(suffix='.npz') as fh:
+        with open_writer(fh.name, columns) as w:
+            w.write(res[:0])
+        df = read_npz(fh.name)
+    assert list(df.columns) == columns and len(df) == 0
+
+def test_index_query():
+    np.random.seed(42)
+    res = []
+    for chrom in ('chr1', 'chr10', 'chr2'):
+        r = _make_res(20000)
+        r['chrom'] = chrom
+        r['start'] = np.sort(np.random.randint(0, 5000000, len(r)))
+        r['end'] = r['start'] + np.random.randint(1, 3000, len(r))
+        res.append(r)
+    res = pd.concat(res, ignore_index=True)
+
+    with tempfile.NamedTemporaryFile(suffix='.bed.gz') as fh:
+        w = open_writer(fh.name, result_columns(), index=True)
+        for i in range(0, len(res), 3000):
+            w.write(res[i:i + 3000])
+        w.close()
+
+        for chrom, start, end in (('chr1', 1, 2000000), ('chr10', 4000000,
+            4000100), ('chr2', 1, 1), ('chr3', 1, 100)):
+            region = "%s:%i-%i" % (chrom, start, end)
+            got = list(query(fh.name, region))
+            exp = res[(res.chrom == chrom) & (res.start < end) &
+                      (res.end > start - 1)]
+            assert len(got) == len(exp), (region, len(got), len(exp))
+            assert [int(g[1]) for g in got] == list(exp.start)
+
+        df = query_frame(fh.name, 'chr2')
+        assert list(df.columns) == result_columns()
+        assert len(df) == (res.chrom == 'chr2').sum()
+
+def test_index_unsorted():
+    res = _make_res(10)
+    res['chrom'] = 'chr1'
+    res['start'] = np.arange(10) * 100
+    res['end'] = res['start'] + 10
+    with tempfile.NamedTemporaryFile(suffix='.bed.gz') as fh:
+        w = open_writer(fh.name, result_columns(), index=True)
+        w.write(res[5:])
+        # found when the chunk is written, not at close.
+        assert_raises(ValueError, w.write, res[:5])
+        assert w.n_written == 5
+        w.close()
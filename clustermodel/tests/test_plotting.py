@@ -0,0 +1,89 @@
+import os.path as op
+import tempfile
+import numpy as np
+import pandas as pd
+from nose.tools import assert_equal
+from clustermodel.plotting import PlotPool, PlotBook, plot_path, \
+        read_book_index
+
+HERE = op.dirname(__file__)
+
+def _data(n=3):
+    covs = pd.read_table(op.join(HERE, "example-covariates.txt"), index_col=0)
+    rng = np.random.RandomState(42)
+    regions = []
+    for i in range(n):
+        res = dict(chrom="chr1", start=100 * i, end=100 * i + 50,
+                   p=0.01 * (i + 1), coef=0.5)
+        cluster_df = pd.DataFrame(rng.uniform(size=(3, len(covs))),
+                                  index=[100 * i, 100 * i + 20, 100 * i + 50],
+                                  columns=covs.index)
+        regions.append((res, cluster_df))
+    return covs, regions
+
+def test_plot_pool_bounded():
+    covs, _ = _data(0)
+    png_path = op.join(tempfile.mkdtemp(), "plot")
+    pool = PlotPool(png_path, covs, "disease", procs=2)
+    assert_equal(pool.queue._maxsize, 8)
+    pool.close()
+    pool = PlotPool(png_path, covs, "disease", procs=1, max_pending=2)
+    assert_equal(pool.queue._maxsize, 2)
+    pool.close()
+
+def test_plot_pool_writes():
+    covs, regions = _data()
+    for procs in (0, 1):
+        png_path = op.join(tempfile.mkdtemp(), "plot.png")
+        pool = PlotPool(png_path, covs, "disease", procs=procs)
+        for res, cluster_df in regions:
+            pool.submit(res, cluster_df)
+        pool.close()
+        for res, _ in regions:
+            assert op.exists(plot_path(res, png_path)), (procs, res)
+
+def test_plot_pool_skip_existing():
+    covs, regions = _data(2)
+    png_path = op.join(tempfile.mkdtemp(), "plot.png")
+    done = plot_path(regions[0][0], png_path)
+    open(done, "w").write("x")
+    pool = PlotPool(png_path, covs, "disease", procs=0, skip_existing=True)
+    assert pool.skip(regions[0][0])
+    assert not pool.skip(regions[1][0])
+    for res, cluster_df in regions:
+        pool.submit(res, cluster_df)
+    pool.close()
+    # the existing plot is not re-drawn.
+    assert_equal(open(done).read(), "x")
+    assert op.exists(plot_path(regions[1][0], png_path))
+    assert not PlotPool(png_path, covs, "disease", procs=0).skip(regions[0][0])
+
+def test_plot_book():
+    covs, regions = _data()
+    for mode, ext in (("pdf", "pdf"), ("sheet", "png")):
+        png_path = op.join(tempfile.mkdtemp(), "plot.png")
+        prefix = png_path[:-4]
+        book = PlotBook(prefix, png_path, covs[["disease"]], "disease",
+                        mode=mode, size=2)
+        for res, cluster_df in regions:
+            book.add(res, cluster_df)
+        book.close()
+        for i in (1, 2):
+            assert op.getsize("%s.%i.%s" % (prefix, i, ext)) > 0, (mode, i)
+        assert not op.exists("%s.3.%s" % (prefix, ext))
+        index = read_book_index(prefix)
+        assert_equal(sorted(index.values()),
+                     [("%s.1.%s" % (prefix, ext), 1),
+                      ("%s.1.%s" % (prefix, ext), 2),
+                      ("%s.2.%s" % (prefix, ext), 1)])
+        assert_equal(index["chr1:100-150"], ("%s.1.%s" % (prefix, ext), 2))
+
+        # regions in the index are skipped and new files follow the old ones.
+        book = PlotBook(prefix, png_path, covs[["disease"]], "disease",
+                        mode=mode, size=2, skip_existing=True)
+        assert book.skip(regions[0][0])
+        res = dict(regions[0][0], start=1000, end=1050)
+        book.add(res, regions[0][1])
+        book.close()
+        assert_equal(read_book_index(prefix)["chr1:1000-1050"],
+                     ("%s.3.%s" % (prefix, ext), 1))
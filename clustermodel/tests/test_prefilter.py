@@ -0,0 +1,41 @@
+import numpy as np
+from nose.tools import assert_equal
+from clustermodel import ClusterFeature, SparseFeature
+from clustermodel.prefilter import Prefilter
+
+def features():
+    np.random.seed(42)
+    fs = []
+    for i in range(100):
+        v = np.random.randn(20)
+        if i % 4 == 1: v[:15] = np.nan
+        if i % 4 == 2: v *= 0.01
+        if i % 4 == 3: v[:16] = 0; v[16:] = 5
+        fs.append(ClusterFeature('chr1', i, i + 1, v,
+                                 weights=np.ones(20) * (i % 5 != 0)))
+    return fs
+
+def test_prefilter():
+    fs = features()
+    pf = Prefilter(max_nan=0.5, min_var=0.1, chunksize=7, out=None)
+    kept = list(pf(fs))
+    assert_equal(pf.counts['seen'], 100)
+    assert_equal(pf.counts['nan'], 25)
+    assert_equal(pf.counts['var'], 25)
+    assert_equal([f.start for f in kept], [f.start for f in fs
+                                           if f.start % 4 in (0, 3)])
+    # IQR is 0 (but the variance is not) with 16 zeros and 4 fives.
+    pf = Prefilter(min_iqr=1, out=None)
+    assert all(f.start % 4 != 3 and f.start % 4 != 2 for f in pf(fs))
+
+def test_min_samples():
+    fs = features()
+    pf = Prefilter(min_samples=10, out=None)
+    kept = list(pf(fs))
+    assert_equal(pf.counts['samples'], len([f for f in fs if f.start % 5 == 0
+                                            or f.start % 4 == 1]))
+    assert not Prefilter().active
+
+    f = SparseFeature('chr1', 1, 2, np.arange(5), np.arange(5.), 20)
+    assert_equal(list(Prefilter(min_samples=6, out=None)([f])), [])
+    assert_equal(list(Prefilter(min_samples=5, out=None)([f])), [f])
@@ -0,0 +1,242 @@
+import os.path as op
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from nose.tools import assert_equal
+from scipy import optimize, stats
+from scipy.special import gammaln
+from clustermodel import pyengine, pygee, pylmm, pybetareg, pyskat
+from clustermodel.clustermodel import clustered_model
+
+HERE = op.dirname(__file__)
+
+def read_data():
+    meth = pd.read_csv(op.join(HERE, "example-meth.csv"), index_col=0).T
+    covs = pd.read_table(op.join(HERE, "example-covariates.txt"), index_col=0)
+    return covs, meth
+
+def test_names():
+    assert_equal(pyengine.r_name('disease[T.True]'), 'diseaseTRUE')
+    assert_equal(pyengine.split_model('methylation ~ disease + (1|CpG)'),
+                 ('methylation', 'disease', ['CpG']))
+    assert_equal(pyengine.split_model('methylation ~ (1|id)'),
+                 ('methylation', '1', ['id']))
+
+def test_design():
+    covs, meth = read_data()
+    covs = pyengine.r_types(covs)
+    d = pyengine.Design(covs, 'disease + gender', len(meth))
+    assert_equal(d.covariate, 'diseaseTRUE')
+    assert_equal(d.X.shape, (meth.size, 3))
+
+    values = meth.values.copy()
+    values[0, 0] = np.nan
+    y, X, cpg, sample, w = d.take(values, np.ones_like(values))
+    assert_equal(len(y), meth.size - 1)
+    assert_equal(len(w), meth.size - 1)
+    assert cpg[0] == 0 and sample[0] == 1
+
+def test_gee_statsmodels():
+    # with no weights, the result is that of statsmodels GEE on the long data.
+    covs, meth = read_data()
+    d = pyengine.Design(pyengine.r_types(covs), 'disease', len(meth))
+    y = meth.values.ravel()
+    coef, p = pygee.fit(d, meth.values, corstr='ex', idvar='id')
+    res = sm.GEE(y, d.X, d.sample, family=sm.families.Gaussian(),
+                 cov_struct=sm.cov_struct.Exchangeable()).fit()
+    assert np.allclose([coef, p], [res.params[1], res.pvalues[1]])
+
+def test_weights():
+    # equal weights give the same result as no weights.
+    covs, meth = read_data()
+    d = pyengine.Design(pyengine.r_types(covs), 'disease', len(meth))
+    for corstr, idvar in (('ex', 'CpG'), ('ar', 'id'), ('in', 'id')):
+        a = pygee.fit(d, meth.values, corstr=corstr, idvar=idvar)
+        b = pygee.fit(d, meth.values, 2 * np.ones(meth.shape), corstr=corstr,
+                      idvar=idvar)
+        assert np.allclose(a, b), (corstr, a, b)
+
+def test_lmm_statsmodels():
+    covs, meth = read_data()
+    d = pyengine.Design(pyengine.r_types(covs), 'disease', len(meth))
+    values = meth.values.copy()
+    values[1, 3] = np.nan
+    y, X, cpg, sample, w = d.take(values)
+    for random, groups in ((('CpG',), cpg), (('id',), sample)):
+        coef, p = pylmm.fit(d, values, random=random)
+        res = sm.MixedLM(y, X, groups=groups).fit(reml=True)
+        assert np.allclose([coef, p], [res.params[1], res.pvalues[1]],
+                           rtol=1e-3), (random, coef, p)
+        # refitting gives the same answer.
+        assert_equal(pylmm.fit(d, values, random=random), (coef, p))
+
+def _dense_reml(y, X, Ks, log_ratios):
+    V = np.eye(len(y)) + sum(np.exp(r) * K for r, K in zip(log_ratios, Ks))
+    Vi = np.linalg.inv(V)
+    XtViX = X.T.dot(Vi).dot(X)
+    beta = np.linalg.solve(XtViX, X.T.dot(Vi).dot(y))
+    r = y - X.dot(beta)
+    dof = len(y) - X.shape[1]
+    sigma2 = r.dot(Vi).dot(r) / dof
+    ll = (dof * np.log(sigma2) + np.linalg.slogdet(V)[1]
+          + np.linalg.slogdet(XtViX)[1])
+    return ll, beta, sigma2 * np.linalg.inv(XtViX)
+
+def test_lmm_both():
+    # (1|CpG) + (1|id) with missing values against the REML of the full V.
+    covs, meth = read_data()
+    d = pyengine.Design(pyengine.r_types(covs), 'disease', len(meth))
+    values = meth.values.copy()
+    values[1, 3] = values[0, 7] = np.nan
+    y, X, cpg, sample, w = d.take(values)
+    Ks = [np.equal.outer(g, g).astype(float) for g in (cpg, sample)]
+    sums = pylmm.GroupSums(y, X, [cpg, sample])
+    for log_ratios in ([0, 0], [-3, 1], [2, -5]):
+        ll, beta, cov = sums.reml(np.exp(log_ratios))
+        ell, ebeta, ecov = _dense_reml(y, X, Ks, log_ratios)
+        assert np.allclose([ll], [ell]) and np.allclose(beta, ebeta) \
+                and np.allclose(cov, ecov), log_ratios
+    best = optimize.minimize(lambda r: _dense_reml(y, X, Ks, r)[0],
+                             np.zeros(2), method='L-BFGS-B',
+                             bounds=[pylmm.LOG_BOUNDS] * 2).x
+    _, beta, cov = _dense_reml(y, X, Ks, best)
+    coef, p = pylmm.fit(d, values, random=('CpG', 'id'))
+    assert np.allclose([coef, p], [beta[1],
+                       2 * stats.norm.sf(abs(beta[1] / np.sqrt(cov[1, 1])))],
+                       rtol=1e-3), (coef, p)
+    assert np.allclose(pylmm.fit(d, values, random=('id', 'CpG')), (coef, p))
+
+def test_engines():
+    covs, meth = read_data()
+    model = "methylation ~ disease"
+    for gee_args in (('ex', 'CpG'), ('ar', 'id'), ('in', 'id')):
+        for m in (meth, meth.ix[1, :]):
+            yield check_engines, covs, m, model, dict(gee_args=gee_args)
+    for random_effects in ("(1|CpG)", "(1|id)", "(1|id) + (1|CpG)"):
+        for m in (meth, meth.ix[1, :]):
+            yield check_engines, covs, m, model + " + " + random_effects, {}
+
+    ratio = 1 / (1 + np.exp(-meth))
+    depth = pd.DataFrame(10.0, index=meth.index, columns=meth.columns)
+    for combine in ('liptak', 'z-score'):
+        yield (check_engines, covs, ratio, model,
+               dict(betareg=True, combine=combine, weights=depth))
+
+    for model in ("disease ~ 1", "anumber ~ gender"):
+        yield check_skat, covs, meth, model
+
+def check_skat(covs, meth, model):
+    r = clustered_model(covs.copy(), meth.copy(), model, skat=True)
+    py = clustered_model(covs.copy(), meth.copy(), model, skat=True,
+                         engine='python')
+    assert np.allclose(r['p'], py['p'], rtol=1e-3), (r['p'], py['p'])
+
+def check_engines(covs, meth, model, kwargs):
+    r = clustered_model(covs.copy(), meth.copy(), model, **kwargs)
+    py = clustered_model(covs.copy(), meth.copy(), model, engine='python',
+                         **kwargs)
+    assert_equal(r['covariate'][0], py['covariate'][0])
+    assert np.allclose(r['coef'], py['coef'], rtol=0.02), (r['coef'], py['coef'])
+    assert np.allclose(np.log10(r['p']), np.log10(py['p']), rtol=0.1)
+
+def test_betareg():
+    # the batched fit of each site is the maximum-likelihood estimate.
+    np.random.seed(42)
+    X = np.column_stack((np.ones(30), np.arange(30) % 2))
+    mu = 1 / (1 + np.exp(-(0.3 + 0.5 * X[:, 1])))
+    y = np.random.beta(mu * 15, (1 - mu) * 15, size=(4, 30))
+    w = np.random.poisson(10, size=y.shape) + 1.
+    beta, se, _ = pybetareg.fit(X, y, w)
+
+    def nll(theta, y, w):
+        m = 1 / (1 + np.exp(-X.dot(theta[:2])))
+        phi = np.exp(theta[2])
+        return -(w * (gammaln(phi) - gammaln(m * phi) - gammaln((1 - m) * phi)
+                 + (m * phi - 1) * np.log(y) + ((1 - m) * phi - 1)
+                 * np.log1p(-y))).sum()
+    for i in range(len(y)):
+        res = optimize.minimize(nll, [0, 0, 1], args=(y[i], w[i]))
+        assert np.allclose(beta[i], res.x[:2], atol=1e-4), (beta[i], res.x)
+
+def test_combine_p():
+    p = np.array([0.01, 0.02, 0.5])
+    w = np.array([10., 20., 30.])
+    for method in ('liptak', 'z-score'):
+        indep = pybetareg.combine_p(p, w, np.eye(3), method)
+        corr = pybetareg.combine_p(p, w, np.full((3, 3), 0.5) + 0.5 * np.eye(3),
+                                   method)
+        # correlated sites give less evidence.
+        assert indep < corr < 0.5, (method, indep, corr)
+    assert np.allclose(pybetareg.combine_p(p[:1], w[:1], np.eye(1), 'liptak'),
+                       p[0])
+
+def test_skat_pvalue():
+    # equal weights give a chi-square with that many degrees of freedom.
+    for q in (0.5, 3, 10, 30):
+        for m in (2, 5):
+            expected = stats.chi2.sf(q, m)
+            assert np.allclose(pyskat.davies(q, np.ones(m)), expected,
+                               rtol=1e-4), (q, m)
+            assert np.allclose(pyskat.pvalue(q, 2 * np.ones(m)),
+                               stats.chi2.sf(q / 2., m), rtol=1e-4)
+    lambdas = np.array([3, 1, 0.5, 0.2])
+    assert abs(pyskat.liu(5, lambdas) - pyskat.davies(5, lambdas)) < 0.02
+
+def test_skat_constant():
+    # constant probes are explained by the intercept: no eigenvalues and
+    # Q = 0 so the p-value is NaN and not (highly) significant.
+    covs, _ = read_data()
+    n = len(covs)
+    good = np.random.RandomState(1).randn(3, n)
+    const = np.ones((3, n)) * 0.5
+    df = pyengine.clustered_model(covs, [good, const, const[:1]],
+                                  "disease ~ 1", skat=True)
+    assert 0.05 < df['p'][0] < 1, df
+    assert np.isnan(df['p'][1:]).all(), df
+    # a constant probe does not change the test of the others.
+    df = pyengine.clustered_model(covs, [np.vstack((good, const[:1]))],
+                                  "disease ~ 1", skat=True)
+    assert 0.05 < df['p'][0] < 1, df
+
+def test_skat_zero_q():
+    assert_equal(pyskat.davies(0, np.ones(3)), 1.0)
+    assert np.isnan(pyskat.pvalue(0, np.ones(3), tol=1e-12))
+    assert np.isnan(pyskat.pvalue(1.0, np.array([1e-30, 1e-31]), tol=1e-12))
+    assert np.allclose(pyskat.pvalue(3.0, np.ones(2), tol=1e-12),
+                       stats.chi2.sf(3, 2), rtol=1e-4)
+
+def test_skat_null():
+    # the null model is fit once and p-values are uniform under the null.
+    np.random.seed(42)
+    covs = pd.DataFrame({'disease': np.where(np.arange(60) % 2, 'T', 'F'),
+                         'age': np.random.randn(60)})
+    meths = [np.random.randn(4, 60) for i in range(300)]
+    df = pyskat.clustered_model(covs, meths, "disease ~ age")
+    assert pyskat.get_null(covs, "disease ~ age").binary
+    assert_equal(df['covariate'][0], 'disease')
+    assert 0.02 < (df['p'] < 0.1).mean() < 0.2
+    assert 0.35 < df['p'].mean() < 0.65
+
+def test_unsupported():
+    covs, meth = read_data()
+    assert pyengine.clustered_model(covs, [meth], "methylation ~ disease",
+                                    combine='liptak') is None
+    assert pyengine.clustered_model(covs, [meth],
+                                    "methylation ~ disease + (1|gender)") is None
+
+def test_run_model():
+    # coordinates of each cluster are put on its results.
+    from itertools import islice
+    from aclust import mclust
+    from clustermodel import feature_gen
+    from clustermodel.__main__ import run_model
+    covs = pd.read_table(op.join(HERE, "example-covariates.txt"), index_col=0)
+    features = feature_gen(op.join(HERE, "example-methylation.txt.gz"))
+    clusters = list(islice(mclust(features, max_dist=400), 40))
+    res = run_model(clusters, covs, "methylation ~ disease", None, 30, False,
+                    False, False, ('ex', 'CpG'), False, False,
+                    engine='python')
+    assert_equal(len(res), len(clusters))
+    for c, (i, row) in zip(clusters, res.iterrows()):
+        assert_equal((row['chrom'], row['start'], row['end'], row['n_probes']),
+                     (c[0].group, c[0].start, c[-1].end, len(c)))
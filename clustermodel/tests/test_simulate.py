@@ -0,0 +1,61 @@
+import json
+import os.path as op
+import tempfile
+import numpy as np
+from nose.tools import assert_equal
+from clustermodel import simulate
+from clustermodel.methmatrix import read_store
+
+HERE = op.dirname(__file__)
+
+def test_simulate_batch():
+    rng = np.random.RandomState(42)
+    values = rng.randn(30, 25)
+    offsets = np.array([0, 3, 4, 12, 30])
+    sim, cols = simulate.simulate_batch(values, offsets, 5, 0.8, rng=rng)
+    assert_equal(sim.shape, (30, 10))
+    assert_equal(cols.shape, (4, 10))
+    for k, (s, e) in enumerate(zip(offsets[:-1], offsets[1:])):
+        # the samples of a cluster are drawn once for all of its probes.
+        assert_equal(len(set(cols[k])), 10)
+        assert (sim[s:e] == values[s:e][:, cols[k]]).all()
+
+def test_weighted_sample():
+    # the same distribution as sequential draws with np.random.choice.
+    rng = np.random.RandomState(42)
+    p = np.array([8., 4., 2., 1., 1.])
+    idx = simulate._weighted_sample(np.tile(p, (20000, 1)), 2, rng)
+    got = np.bincount(idx.ravel(), minlength=5) / 20000.
+    exp = np.bincount(np.concatenate([rng.choice(5, 2, replace=False,
+                                                 p=p / p.sum())
+                                      for i in range(20000)]),
+                      minlength=5) / 20000.
+    assert np.allclose(got, exp, atol=0.02), (got, exp)
+
+def test_separation():
+    # with w > 0, the 2 groups are separated; with w == 0 they are not.
+    rng = np.random.RandomState(0)
+    values = np.tile(np.arange(60.), (2000, 1))
+    offsets = np.arange(0, 2001, 2)
+    for w, lo, hi in ((0, -3, 3), (1, -40, -10)):
+        sim, _ = simulate.simulate_batch(values, offsets, 10, w, rng=rng)
+        diff = sim[:, :10].mean() - sim[:, 10:].mean()
+        assert lo < diff < hi, (w, diff)
+
+def test_grid():
+    d = tempfile.mkdtemp()
+    meth = op.join(HERE, "example-methylation.txt.gz")
+    tmpl = op.join(d, "ns_{n}/w_{w}/sim")
+    files = simulate.simulate_grid(meth, tmpl, [4], [0.3], [0, 0.5],
+                                   fmt="npy", batch=100, seed=1)
+    assert_equal(sorted(files), sorted([op.join(d, "ns_4/w_0/sim.meth"),
+                                        op.join(d, "ns_4/w_0.5/sim.meth")]))
+    for f in files:
+        index = json.load(open(op.join(f, "index.json")))
+        assert_equal(len(index['samples']), 8)
+        n = sum(len(m) for _, _, m in read_store(f))
+        assert_equal(n, 7000)
+    again = simulate.simulate_grid(meth, tmpl, [4], [0.3], [0.5], fmt="text",
+                                   seed=1)
+    assert_equal(again, [op.join(d, "ns_4/w_0.5/sim.meth.txt")])
+    assert_equal(len(open(again[0]).readlines()), 7001)
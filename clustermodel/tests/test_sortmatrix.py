@@ -0,0 +1,63 @@
+import gzip
+import random
+import os.path as op
+import tempfile
+from nose.tools import assert_equal, assert_raises
+from clustermodel import feature_gen
+from clustermodel.sortmatrix import sort_matrix, chrom_key
+
+HERE = op.dirname(__file__)
+METH = op.join(HERE, "example-methylation.txt.gz")
+
+def _shuffled(lines, chroms=('chr1', 'chr2', 'chr10', 'chrX')):
+    "lines with the probes spread over `chroms` and shuffled"
+    rows = ["%s:%s" % (chroms[i % len(chroms)], l.split(":", 1)[1])
+            for i, l in enumerate(lines[1:])]
+    random.Random(42).shuffle(rows)
+    return [lines[0]] + rows
+
+def _write(lines, suffix=".txt"):
+    fname = tempfile.mktemp(suffix=suffix)
+    with open(fname, "w") as fh:
+        fh.writelines(lines)
+    return fname
+
+def test_sort():
+    lines = _shuffled(gzip.open(METH).readlines()[:3000])
+    meth = _write(lines)
+    # the weights are the methylation with the position appended so rows
+    # can be matched after sorting.
+    wlines = [lines[0]] + [l.rstrip("\n") + "\t%i\n" % i
+                           for i, l in enumerate(lines[1:])]
+    weights = _write(wlines)
+    exp = sorted(lines[1:], key=lambda l: (chrom_key(l.split(":")[0]),
+                                           int(l.split(":")[1].split("\t")[0])))
+    for memory in (0.05, 100):
+        out, wout = tempfile.mktemp(suffix=".gz"), tempfile.mktemp()
+        n, runs = sort_matrix(meth, out, weights, wout, memory=memory)
+        assert_equal(n, len(lines) - 1)
+        assert (runs > 1) == (memory < 1), runs
+        got = gzip.open(out).readlines()
+        assert_equal(got[0], lines[0])
+        assert_equal(got[1:], exp)
+        wgot = open(wout).readlines()
+        for l, w in zip(got, wgot)[1:]:
+            assert w.startswith(l.rstrip("\n") + "\t")
+        # the sorted output parses.
+        assert_equal(len(list(feature_gen(out))), n)
+
+def test_unsorted():
+    lines = _shuffled(gzip.open(METH).readlines()[:100])
+    meth = _write(lines)
+    assert_raises(ValueError, list, feature_gen(meth))
+    assert_raises(ValueError, list, feature_gen(meth, sparse=True))
+    try:
+        list(feature_gen(meth))
+    except ValueError, e:
+        assert "line 3:" in str(e), e
+
+def test_misaligned():
+    lines = gzip.open(METH).readlines()[:100]
+    meth, weights = _write(lines), _write(lines[:50] + lines[51:])
+    assert_raises(ValueError, sort_matrix, meth, tempfile.mktemp(), weights,
+                  tempfile.mktemp())
@@ -0,0 +1,13 @@
+import sys
+import subprocess
+
+def test_lazy_imports():
+    # importing the CLI module shouldn't start R or load the plotting,
+    # statsmodels or simulation code.
+    code = ("import sys; import clustermodel.__main__ as m; "
+            "assert not m.r.started; "
+            "assert 'clustermodel.plotting' not in sys.modules, 'plotting'; "
+            "assert 'matplotlib.pyplot' not in sys.modules, 'pyplot'; "
+            "assert 'statsmodels' not in sys.modules, 'statsmodels'; "
+            "assert 'clustermodel.simulate' not in sys.modules, 'simulate'")
+    subprocess.check_call([sys.executable, "-c", code])
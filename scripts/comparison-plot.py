@@ -1,12 +1,10 @@
 import sys
 import os.path as op
-from toolshed import reader
 from matplotlib import pyplot as plt
 from mpltools import style
 style.use('ggplot')
-from glob import glob
-import operator
 import numpy as np
+from clustermodel.evaluate import summarize
 
 
 path = "%s/ns_{ns}/rho_{rho}/w_{w}/" % (sys.argv[1])
@@ -17,10 +15,22 @@ COLORS = '#348ABD #7A68A6 #A60628 #467821 #CF4457 #188487 #E24A33'.split()
 
 f, axes = plt.subplots(nrows=4, ncols=2, figsize=(10, 5))
 
-def count_lt(fname, n_probes=2, check=operator.eq, p_cutoff=1e-5):
-    return sum(1 for d in reader(fname) if float(d['p']) <= p_cutoff
-                                           and check(int(d['n_probes']),
-                                                   n_probes))
+def count_lt(table, n_probes=2, p_cutoff=1e-5):
+    """
+    the number of regions (true and false positives) of each file in
+    `table` (from evaluate.summarize) with this many probes and
+    p <= p_cutoff.
+    """
+    t = table[(table['n_probes'] == n_probes) & (table['cutoff'] == p_cutoff)]
+    return [(f, (t['tp'] + t['fp'])[t['file'] == f].sum())
+            for f in beds_of(table)]
+
+def beds_of(table):
+    # only the .bed files directly in the directory; summarize also finds
+    # those in its subdirectories (e.g. real/ and shuffled/ from grid).
+    return sorted(set(f for d, f in zip(table['dir'], table['file'])
+                      if f.endswith('.bed') and op.dirname(f) == d
+                      and not ("sds_3" in f or "skat" in f or "bump" in f)))
 
 def basename(f):
     return op.basename(f).rstrip('.sim.covs.pvals.bed').rsplit('-', 1)[0]
@@ -29,18 +39,16 @@ def basename(f):
 regions = (2, 3, 4, 5)
 
 rho = 0.3
+# each result file is read once (or not at all if its summary is cached).
+tables = dict(((ns, w), summarize([path.format(ns=ns, rho=rho, w=w)]))
+              for ns in (10, 20, 40) for w in (0, 0.8))
+
 for ix, region_size in enumerate(regions):
-    check = operator.ge if region_size == 5 else operator.eq
-    check = operator.eq
     for ins, ns in enumerate((10, 20, 40)):
 
         for iw, w in enumerate((0, 0.8)):
-            directory = path.format(**locals())
-            beds = sorted([x for x in glob("%s/*.bed" % directory)
-                                                    if not ("sds_3" in x or
-                                                            "skat" in x or
-                                                            "bump" in x)])
-            counts = [(f, count_lt(f, region_size, check)) for f in beds]
+            counts = count_lt(tables[ns, w], region_size)
+            beds = [c[0] for c in counts]
 
             ax = axes[ix, iw]
             leftish = len(counts) + 1.0
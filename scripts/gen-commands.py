@@ -4,33 +4,13 @@ methods on a cluster in order to compare them.
 """
 import os
 import sys
-import pandas as pd
-import numpy as np
-
-np.random.seed(42)
-
-def shuffle_expr(fexpr):
-    """
-    break the relation between expression and methylation.
-    """
-    df = pd.read_table(fexpr, index_col=0)
-    orig_cols = list(df.columns)
-    cols = np.array(df.columns)
-    np.random.shuffle(cols)
-    df.columns = cols
-    new_f = fexpr.replace('.txt', '.shuffled.txt')
-    df[orig_cols].to_csv(new_f, sep="\t", index=True,
-            quote=False, float_format="%.4f")
-    return new_f
-
 
 base_model = "methylation ~ 1"
 
 covs = sys.argv[1]
 meth = sys.argv[2]
 
-orig_expr = "/proj/Schwartz/brentp/2013/tcga-methex/brca-expr.matrix.txt"
-fake_expr = shuffle_expr(orig_expr)
+expr = "/proj/Schwartz/brentp/2013/tcga-methex/brca-expr.matrix.txt"
 
 
 expr_locs = "/proj/Schwartz/brentp/2013/tcga-methex/expr-probe-locs.bed"
@@ -41,7 +21,7 @@ group = os.path.splitext(os.path.basename(covs))[0]
 extra = "| bsub -J {name}.{fr} -e logs/{name}.{fr}.err -o logs/{name}.{fr}.out -M 20000000 -n 11"
 
 base_cmd = ("echo 'python -m clustermodel \"{model}\" {covs} {meth} {method} {sds}"
-           " --X {expr} --X-locs {expr_locs} --X-dist 50000"
+           " --X {expr}{permute} --X-locs {expr_locs} --X-dist 50000"
            " > {out}/{name}.{group}.pvals.bed "
            "'" + extra)
 
@@ -52,8 +32,9 @@ sk_model = base_model.split("~")[1].strip()
 sk_model = sk_model.split()
 sk_model = sk_model[0] + " ~ " + (" + ".join(t for t in sk_model[1:] if t != "+") or "1")
 
-for expr in (orig_expr, fake_expr):
-    fr = "fake" if "shuff" in expr else "real"
+# the fake runs permute the samples of expr (in R) to break the relation
+# between expression and methylation.
+for fr, permute in (("real", ""), ("fake", " --X-permute-seed 42")):
     out = sys.argv[3] + fr + "/"
     try:
         os.makedirs(out)
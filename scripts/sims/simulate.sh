@@ -1,20 +1,20 @@
-
 linkage=complete
 meth=work/tcga.matrix.txt
 base=work/simulated
 
+# all of the grid is simulated in 1 run; the data are clustered once per rho.
+python -m clustermodel simulate --n-samples 10,20,40 --rho-min 0.3,0.6 -w 0,0.8 \
+    --linkage $linkage $meth "$base/ns_{n}/rho_{rho}/w_{w}/sim"
+
+# then every method is run on every simulation on this machine; runs that
+# have finished are skipped if this is re-run.
+data=""
 for ns in 10 20 40; do
     for rho in 0.3 0.6; do
         for w in 0 0.8; do
-            name=ns_${ns}-rho_${rho}-w_${w}
-
             prefix=$base/ns_${ns}/rho_${rho}/w_${w}
-            mkdir -p $prefix
-
-            gen_cmd="python -m clustermodel simulate --n-samples $ns --rho-min $rho -w $w --linkage $linkage $meth $prefix/sim"
-            fit_cmd="python scripts/gen-commands.py $prefix/sim.covs.txt $prefix/sim.meth.txt $prefix/ | bash"
-            echo "set -xe; $gen_cmd ; $fit_cmd" \
-                | bsub -J $name -e logs/$name.err -o logs/$name.out
+            data="$data --data $prefix/sim.covs.txt $prefix/sim.meth.txt $prefix/"
         done
     done
 done
+python -m clustermodel grid --manifest $base/manifest.json $data scripts/method-grid.json
@@ -0,0 +1,34 @@
+"""
+time how long it takes to start clustermodel. We call the CLI many times on
+small shards so this should stay small. Usage:
+
+    python scripts/startup-time.py [n_runs]
+"""
+import sys
+import time
+import subprocess
+
+COMMANDS = [
+    ("import", [sys.executable, "-c", "import clustermodel"]),
+    ("import __main__", [sys.executable, "-c", "import clustermodel.__main__"]),
+    ("--help", [sys.executable, "-m", "clustermodel", "--help"]),
+    ("python", [sys.executable, "-c", "pass"]),
+]
+
+def timeit(cmd, n):
+    times = []
+    for i in range(n):
+        t = time.time()
+        subprocess.check_call(cmd, stdout=open("/dev/null", "w"))
+        times.append(time.time() - t)
+    return sorted(times)
+
+def main(n=10):
+    print("command\tmedian\tmin\tmax")
+    for name, cmd in COMMANDS:
+        times = timeit(cmd, n)
+        print("%s\t%.3f\t%.3f\t%.3f" % (name, times[len(times) // 2], times[0],
+                                        times[-1]))
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))